@@ -1,14 +1,139 @@
 import chip64_util as c64u
+import chip64_decode as c64d
 import numpy as np
+import collections
+import functools
 import itertools as itt
-import warnings
 import random
+import time
+
+# Templates for a freshly zeroed machine. numpy scalars are immutable, so one
+# shared instance can back every cell and a reset is a plain slice copy.
+ZERO_MEMORY = [np.uint8(0)] * 4096
+ZERO_REGISTERS = [np.uint64(0)] * 16
+MASK = 0xFFFFFFFFFFFFFFFF
+
+# Why execute() last stopped, kept in Chip64.halt_reason.
+HALTED = "halted"
+CYCLE_LIMIT = "cycle limit"
+NON_TERMINATING = "non-terminating"
+BREAKPOINT = "breakpoint"
+WATCHPOINT = "watchpoint"
+DEADLINE = "deadline"
+ERROR = "error"
+
+# What execute() returns: the cycles it ran, why it stopped and the seconds
+# it took.
+ExecutionResult = collections.namedtuple(
+    "ExecutionResult", ["cycles", "halt_reason", "elapsed"]
+)
+
+# Cycles run between checks of execute()'s deadline.
+DEADLINE_INTERVAL = 1024
+# A cycle budget no run reaches, standing in for an unlimited one.
+UNLIMITED = 1 << 62
+
+# Events that hooks can be added for, see Chip64.add_hook().
+HOOK_EVENTS = ("instruction", "call", "return", "memory_write", "io", "halt")
+
+# The numpy scalar for each byte value, for filling memory without building
+# new scalars.
+BYTES = [np.uint8(i) for i in range(256)]
+
+# How the DX0Q opcodes format a value, keyed by numeric base.
+OUTPUT_FORMATS = {16: hex, 10: str, 2: bin, 8: oct}
+
+
+def nondeterministic(opcode: int) -> bool:
+    """
+    Returns True if opcode takes input, a random byte or calls a host
+    function, so that what follows it does not depend on the machine state
+    alone.
+    """
+    return opcode >> 12 in (0xC, 0xF) or (0 < opcode < 0x1000 and opcode != 0x01EE)
+
+
+class RepeatDetector:
+    """
+    Spots a machine coming back to a state it was in before, using Brent's
+    cycle finding algorithm.
+    seen() is given the state at every back edge. The state is saved at the
+    1st, 2nd, 4th, 8th... back edge since the last clear() and each later one
+    is compared with it, so a loop that repeats exactly is found within a few
+    times its length for one comparison per back edge. key holds everything
+    but memory and is compared first, memory is a function returning a copy
+    of memory that is only called when the keys match or a state is saved.
+    """
+
+    def __init__(self):
+        """
+        The default constructor for the class.
+        """
+        self.clear()
+
+    def clear(self) -> None:
+        """
+        Forgets the saved state, for when the machine has read something from
+        outside.
+        """
+        self._key = None
+        self._memory = None
+        self._count = 0
+        self._next = 1
+
+    def seen(self, key, memory) -> bool:
+        """
+        Returns True if the state is the saved state, saving it if it is due
+        otherwise.
+        """
+        if key == self._key and memory() == self._memory:
+            return True
+        self._count += 1
+        if self._count == self._next:
+            self._key, self._memory = key, memory()
+            self._next *= 2
+        return False
+
+
+def ignore_overflow(method):
+    """
+    Runs method with numpy's overflow warnings turned off.
+    Writing code to emulate low level hardware often requires using things
+    like well modelled integer overflow, which numpy warns about. numpy's
+    error state is per thread, so unlike a warnings filter this leaves the
+    rest of the process alone.
+    """
 
-# Writing code to emulate low level hardware often requires using things like
-# well modelled integer overflow. Numpy warns when this happens and thereby
-# clogs the console with warnings about expected behaviour. This imperative
-# prevents this.
-warnings.filterwarnings("ignore")
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with np.errstate(over="ignore"):
+            return method(*args, **kwargs)
+
+    return wrapper
+
+
+def measured(method):
+    """
+    Makes an execute() method return an ExecutionResult for the call, with
+    numpy's overflow warnings turned off as ignore_overflow() does. If it
+    raises, halt_reason is set to ERROR and cycles still counts the cycles
+    that completed.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cycles, start = self.cycles, time.perf_counter()
+        try:
+            with np.errstate(over="ignore"):
+                method(self, *args, **kwargs)
+        except BaseException:
+            self.halt_reason = ERROR
+            raise
+        return ExecutionResult(
+            self.cycles - cycles, self.halt_reason, time.perf_counter() - start
+        )
+
+    return wrapper
 
 
 class Chip64:
@@ -19,24 +144,199 @@ class Chip64:
     instructions that do numerical i/o in various formats.
     """
 
-    def __init__(self, code=[]):
+    def __init__(self, code=[], detect_loops=False):
         """
         The default constructor for the class.
+        A jump to itself always stops execute(), if detect_loops is True any
+        loop that comes back to exactly the same state does too.
         """
-        self.memory = [np.uint8(0) for _ in range(4096)]
-        self.registers = [np.uint64(0) for _ in range(16)]
+        self.memory = list(ZERO_MEMORY)
+        self.registers = list(ZERO_REGISTERS)
         self.stack = []
         self.code_ptr = 0
         self.memory_ptr = 0
+        # The original program image, kept so reset() can reload it.
+        self.program = list(code)
+        # Functions called by the 0NNN opcode, keyed by NNN.
+        self.host_functions = {}
+        self.detect_loops = detect_loops
+        # Why the last execute() stopped, one of HALTED, CYCLE_LIMIT,
+        # NON_TERMINATING, BREAKPOINT, WATCHPOINT, DEADLINE or ERROR.
+        # loop_address is the address of the loop found in the last.
+        self.halt_reason = None
+        self.loop_address = None
+        # The breakpoint, or the instruction that wrote to a watchpoint, that
+        # stopped the last execute().
+        self.stop_address = None
+        # Cycles run by execute() since the machine was built or reset.
+        self.cycles = 0
+        self._hooks = {event: [] for event in HOOK_EVENTS}
+        self._breakpoints = set()
+        self._watchpoints = []
+        self._observed = False
+        # The source of the CXNN opcode's random bytes, seed it for
+        # repeatable runs.
+        self.rng = random.Random()
 
         for i, byte in enumerate(code):
             self.memory[i] = byte
 
-    def reset(self):
+    def reset(self, reload_program=False) -> None:
+        """
+        Resets the Chip64 object to its power on state, typically called in
+        tests and by Chip64Pool between runs.
+        Memory and registers are restored in place from shared zero templates
+        rather than rebuilt. If reload_program is True the program image the
+        machine was constructed with is written back into memory, otherwise
+        memory is left zeroed.
+        """
+        self.memory[:] = ZERO_MEMORY
+        self.registers[:] = ZERO_REGISTERS
+        self.stack.clear()
+        self.code_ptr = 0
+        self.memory_ptr = 0
+        self.halt_reason = None
+        self.loop_address = None
+        self.stop_address = None
+        self.cycles = 0
+        if reload_program:
+            self.memory[: len(self.program)] = self.program
+
+    def read_input(self, prompt: str) -> str:
+        """
+        Reads a line of input for the FX0Q opcodes, from the console unless
+        overridden.
+        """
+        return c64u.console_input(prompt)
+
+    def write_output(self, value, base: int) -> None:
         """
-        A small helper class that resets the Chip64 object, typically called in tests.
+        Writes a register value for the DX0Q opcodes in the given base, to
+        the console unless overridden.
         """
-        self.__init__()
+        c64u.console_output(OUTPUT_FORMATS[base](value))
+
+    def random_byte(self) -> int:
+        """
+        Returns a random byte for the CXNN opcode.
+        """
+        return self.rng.randint(0, 255)
+
+    def add_hook(self, event: str, function) -> None:
+        """
+        Calls function whenever event happens during execute(), event being
+        one of HOOK_EVENTS:
+        instruction: function(c64, address, opcode) before each instruction.
+        call, return: function(c64, address, target) after a CALL or RET at
+        address has jumped to target.
+        memory_write: function(c64, address, low, high) after the instruction
+        at address has written memory from low up to but excluding high.
+        io: function(c64, address, kind, value) after an input or output,
+        kind being "input" or "output" and value the register's value.
+        halt: function(c64, reason) when execute() returns, reason being the
+        halt_reason.
+        While any hook, breakpoint or watchpoint is installed execute() runs
+        one instruction at a time in the interpreter, otherwise hooks cost
+        nothing.
+        """
+        if event not in self._hooks:
+            raise ValueError("%r is not a hook event" % event)
+        self._hooks[event].append(function)
+        self._update_observed()
+
+    def remove_hook(self, event: str, function) -> None:
+        """
+        Removes a hook added with add_hook().
+        """
+        self._hooks[event].remove(function)
+        self._update_observed()
+
+    def add_breakpoint(self, address: int) -> None:
+        """
+        Stops execute() with halt_reason BREAKPOINT before the instruction at
+        address runs, unless it is the first instruction of the call, so
+        that execution can be resumed from a breakpoint.
+        """
+        self._breakpoints.add(address)
+        self._update_observed()
+
+    def remove_breakpoint(self, address: int) -> None:
+        """
+        Removes a breakpoint added with add_breakpoint().
+        """
+        self._breakpoints.discard(address)
+        self._update_observed()
+
+    def add_watchpoint(self, low: int, high: int) -> None:
+        """
+        Stops execute() with halt_reason WATCHPOINT after any instruction
+        that writes memory from low up to but excluding high.
+        """
+        self._watchpoints.append((low, high))
+        self._update_observed()
+
+    def remove_watchpoint(self, low: int, high: int) -> None:
+        """
+        Removes a watchpoint added with add_watchpoint().
+        """
+        self._watchpoints.remove((low, high))
+        self._update_observed()
+
+    def remove_observers(self) -> None:
+        """
+        Removes every hook, breakpoint and watchpoint.
+        """
+        for hooks in self._hooks.values():
+            hooks.clear()
+        self._breakpoints.clear()
+        self._watchpoints.clear()
+        self._update_observed()
+
+    def _update_observed(self) -> None:
+        self._observed = bool(
+            self._breakpoints or self._watchpoints or any(self._hooks.values())
+        )
+
+    def load_table(self, address: int, values, dtype=np.uint64) -> None:
+        """
+        Writes an array of values of an unsigned integer dtype, uint64,
+        uint32 or uint8, to memory at address, each value big endian as the
+        EX55 opcode writes registers.
+        """
+        data = c64u.split_array(values, dtype)
+        end = address + len(data)
+        if address < 0 or end > len(self.memory):
+            raise IndexError(
+                "table of %d bytes at $%03X runs past the end of memory"
+                % (len(data), address)
+            )
+        self.memory[address:end] = map(BYTES.__getitem__, data.tobytes())
+
+    def extract_table(self, address: int, count: int, dtype=np.uint64) -> np.ndarray:
+        """
+        Returns the count values of an unsigned integer dtype stored big
+        endian in memory at address, as an array of that dtype.
+        """
+        end = address + count * np.dtype(dtype).itemsize
+        if address < 0 or end > len(self.memory):
+            raise IndexError(
+                "table of %d bytes at $%03X runs past the end of memory"
+                % (end - address, address)
+            )
+        return c64u.build_array(bytearray(self.memory[address:end]), dtype)
+
+    def register_host_function(self, number: int, function) -> None:
+        """
+        Registers function to be called by the 0NNN opcode with NNN equal to
+        number, which may be anything from 0x001 to 0xFFF except 0x1EE.
+        function is called as function(registers, memory) with a list of the
+        16 registers as Python ints and the memory as a numpy uint8 array.
+        Changes it makes to either are written back to the machine, registers
+        modulo 2**64. It must not write memory that holds code.
+        """
+        if not 0 < number <= 0xFFF or number == 0x1EE:
+            raise ValueError("0x%03X is not a host function number" % number)
+        self.host_functions[number] = function
 
     def subroutine_return(self) -> None:
         """
@@ -46,12 +346,29 @@ class Chip64:
         """
         self.code_ptr = self.stack.pop()
 
+    def host_call(self, number: np.uint16) -> None:
+        """
+        Implements the 0NNN opcode, other than 0000 and 01EE.
+        Calls the host function registered as number, doing nothing if there
+        is none.
+        """
+        function = self.host_functions.get(int(number))
+        if function is None:
+            return
+        registers = [int(value) for value in self.registers]
+        memory = np.array(self.memory, dtype=np.uint8)
+        before = memory.copy()
+        function(registers, memory)
+        self.registers[:] = [np.uint64(int(value) & MASK) for value in registers]
+        for i in np.flatnonzero(memory != before):
+            self.memory[i] = memory[i]
+
     def goto(self, address: np.uint16) -> None:
         """
         Implements the 1NNN opcode.
         Sets the instruction pointer to address and then resumes execution.
         """
-        self.code_ptr = address
+        self.code_ptr = int(address)
 
     def subroutine_call(self, address: np.uint16) -> None:
         """
@@ -60,7 +377,7 @@ class Chip64:
         Pushes the code_ptr onto the call stack, then sets the code_ptr to NNN.
         """
         self.stack.append(self.code_ptr)
-        self.code_ptr = address
+        self.code_ptr = int(address)
 
     def skip_next_if_equal_const(
         self, register_index: np.uint16, constant: np.uint16
@@ -108,7 +425,9 @@ class Chip64:
         Adds byte constant to registers[dest_index] without setting the
         carry flag.
         """
-        self.registers[dest_index] += np.uint64(constant)
+        self.registers[dest_index] = np.uint64(
+            (int(self.registers[dest_index]) + int(constant)) & MASK
+        )
 
     def assign_register(self, dest_index: np.uint16, src_index: np.uint16) -> None:
         """
@@ -143,13 +462,9 @@ class Chip64:
         Implements the 8XY4 opcode.
         Adds registers X and Y together and sets carry flag if needed.
         """
-        tmp = self.registers[dest_index] + self.registers[src_index]
-        if tmp < self.registers[dest_index]:
-
-            self.registers[0xF] = np.uint64(1)
-        else:
-            self.registers[0xF] = np.uint64(0)
-        self.registers[dest_index] = np.uint64(tmp)
+        tmp = int(self.registers[dest_index]) + int(self.registers[src_index])
+        self.registers[0xF] = np.uint64(tmp >> 64)
+        self.registers[dest_index] = np.uint64(tmp & MASK)
 
     def subtract_registers(self, dest_index: np.uint16, src_index: np.uint16) -> None:
         """
@@ -161,21 +476,53 @@ class Chip64:
             self.registers[0xF] = np.uint64(1)
         else:
             self.registers[0xF] = np.uint64(0)
-        self.registers[dest_index] -= self.registers[src_index]
+        self.registers[dest_index] = np.uint64(
+            (int(self.registers[dest_index]) - int(self.registers[src_index])) & MASK
+        )
+
+    def add_with_carry(self, dest_index: np.uint16, src_index: np.uint16) -> None:
+        """
+        Implements the 8XY8 opcode.
+        Adds register Y and the low bit of the flag register to register X
+        and sets the carry flag if needed, so limbs of a wider number can be
+        added in a chain starting with an ADD.
+        """
+        tmp = (
+            int(self.registers[dest_index])
+            + int(self.registers[src_index])
+            + (int(self.registers[0xF]) & 1)
+        )
+        self.registers[0xF] = np.uint64(tmp >> 64)
+        self.registers[dest_index] = np.uint64(tmp & MASK)
+
+    def subtract_with_borrow(self, dest_index: np.uint16, src_index: np.uint16) -> None:
+        """
+        Implements the 8XY9 opcode.
+        Subtracts register Y from register X, less one more if the low bit of
+        the flag register is clear, and sets the flag register if there was
+        no borrow, so limbs can be subtracted in a chain starting with a SUB.
+        """
+        tmp = (
+            int(self.registers[dest_index])
+            - int(self.registers[src_index])
+            - (1 - (int(self.registers[0xF]) & 1))
+        )
+        self.registers[0xF] = np.uint64(1 if tmp >= 0 else 0)
+        self.registers[dest_index] = np.uint64(tmp & MASK)
 
     def bitwise_right_shift(self, dest_index: np.uint16, src_value: np.uint16) -> None:
         """
         Implemements the 8XY6 opcode.
         """
         if src_value == 0:
-            self.registers[0xF] = 0
+            self.registers[0xF] = np.uint64(0)
             return
         # The following code assumes that src_Value > 0
         tmp = self.registers[dest_index] & np.uint64(1 << (src_value - 1))
         if tmp != 0:
-            self.registers[0xF] = 1
+            self.registers[0xF] = np.uint64(1)
         else:
-            self.registers[0xF] = 0
+            self.registers[0xF] = np.uint64(0)
         self.registers[dest_index] >>= np.uint64(src_value)
 
     def bitwise_left_shift(self, dest_index: np.uint16, src_value: np.uint16) -> None:
@@ -183,13 +530,13 @@ class Chip64:
         Implements the 8XYE opcode.
         """
         if src_value == 0:
-            self.registers[0xF] = 0
+            self.registers[0xF] = np.uint64(0)
             return
         tmp = self.registers[dest_index] & np.uint64(1 << (64 - src_value))
         if tmp != 0:
-            self.registers[0xF] = 1
+            self.registers[0xF] = np.uint64(1)
         else:
-            self.registers[0xF] = 0
+            self.registers[0xF] = np.uint64(0)
         self.registers[dest_index] <<= np.uint64(src_value)
 
     def skip_next_if_unequal(self, dest_index: np.uint16, src_index: np.uint16) -> None:
@@ -211,16 +558,17 @@ class Chip64:
     def set_code_ptr_to_acc_plus_const(self, constant: np.uint16) -> None:
         """
         Implements the BNNN opcode.
-        Adds registers[0] and constant and sets code_ptr to this.
+        Adds registers[0] and constant and sets code_ptr to this, as a
+        Python int like every other jump.
         """
-        self.code_ptr = self.registers[0] + constant
+        self.code_ptr = (int(self.registers[0]) + int(constant)) & MASK
 
     def bitwise_and_rand(self, dest_index: np.uint16, constant: np.uint16) -> None:
         """
         Implements the CXNN opcode.
         sets registers[dest_index] to randint(0, 255) & constant.
         """
-        self.registers[dest_index] = np.uint64(random.randint(0, 255)) & np.uint64(
+        self.registers[dest_index] = np.uint64(self.random_byte()) & np.uint64(
             constant
         )
 
@@ -230,7 +578,7 @@ class Chip64:
         Prints the contents of the register_index register to the console in
         hexadecimal.
         """
-        c64u.console_output(hex(self.registers[register_index]))
+        self.write_output(self.registers[register_index], 16)
 
     def display_register_dec(self, register_index: np.uint16) -> None:
         """
@@ -238,7 +586,7 @@ class Chip64:
         Prints the contents of the register_index register to the console in
         decimal.
         """
-        c64u.console_output(str(self.registers[register_index]))
+        self.write_output(self.registers[register_index], 10)
 
     def display_register_bin(self, register_index: np.uint16) -> None:
         """
@@ -246,7 +594,7 @@ class Chip64:
         Prints the contents of the register_index register to the console in
         binary.
         """
-        c64u.console_output(bin(self.registers[register_index]))
+        self.write_output(self.registers[register_index], 2)
 
     def display_register_oct(self, register_index: np.uint16) -> None:
         """
@@ -254,14 +602,16 @@ class Chip64:
         Prints the contents of the register_index register to the console in
         octal.
         """
-        c64u.console_output(oct(self.registers[register_index]))
+        self.write_output(self.registers[register_index], 8)
 
     def add_register_to_memory_ptr(self, register_index: np.uint16) -> None:
         """
         Implements the EX1E opcode.
         Adds the value held in registers[register_index] to memory_ptr.
         """
-        self.memory_ptr += self.registers[register_index]
+        self.memory_ptr = (
+            int(self.memory_ptr) + int(self.registers[register_index])
+        ) & MASK
 
     def spill_registers(self, register_index: np.uint16) -> None:
         """
@@ -290,13 +640,50 @@ class Chip64:
             tmp_bytes = [self.memory[self.memory_ptr + 8*register + i] for i in range(8)]
             self.registers[register] = c64u.build_uint64(tmp_bytes)
 
+    def _memory_operands(self, register_index: np.uint16) -> tuple:
+        """
+        Returns (ptr, size, a, b) for the EXA4 and EXA5 opcodes, a and b being
+        the two numbers of register X limbs stored from memory_ptr.
+        """
+        ptr = int(self.memory_ptr)
+        size = 8 * int(self.registers[register_index])
+        if ptr + 2 * size > len(self.memory):
+            raise IndexError("operands at $%03X run past the end of memory" % ptr)
+        a = int.from_bytes(bytearray(self.memory[ptr : ptr + size]), "big")
+        b = int.from_bytes(bytearray(self.memory[ptr + size : ptr + 2 * size]), "big")
+        return ptr, size, a, b
+
+    def add_memory(self, register_index: np.uint16) -> None:
+        """
+        Implements the EXA4 opcode.
+        Adds two numbers of N 64 bit limbs, N being the value of register X,
+        stored one after the other from memory_ptr in the layout EX55 uses.
+        The sum replaces the first number and the carry flag is set if needed.
+        """
+        ptr, size, a, b = self._memory_operands(register_index)
+        total = (a + b).to_bytes(size + 1, "big")
+        self.memory[ptr : ptr + size] = [np.uint8(byte) for byte in total[1:]]
+        self.registers[0xF] = np.uint64(total[0])
+
+    def subtract_memory(self, register_index: np.uint16) -> None:
+        """
+        Implements the EXA5 opcode.
+        Subtracts the second of two numbers laid out as for EXA4 from the
+        first, replacing the first, and sets the flag register if there was
+        no borrow.
+        """
+        ptr, size, a, b = self._memory_operands(register_index)
+        difference = ((a - b) % (1 << 8 * size)).to_bytes(size, "big")
+        self.memory[ptr : ptr + size] = [np.uint8(byte) for byte in difference]
+        self.registers[0xF] = np.uint64(1 if a >= b else 0)
+
     def input_to_register_hex(self, register_index: np.uint16) -> None:
         """
         Implements the FX00 opcode.
         Takes input from the console and places it into the register indicated
         by register_index. Input is expected in hexadecimal
         """
-        self.registers[register_index] = np.uint64(int(c64u.console_input(">"), 16))
+        self.registers[register_index] = np.uint64(int(self.read_input(">"), 16))
 
     def input_to_register_dec(self, register_index: np.uint16) -> None:
         """
@@ -304,7 +691,7 @@ class Chip64:
         Takes input from the console and places it into the register indicated
         by register_index. Input is expected in decimal
         """
-        self.registers[register_index] = np.uint64(int(c64u.console_input(">")))
+        self.registers[register_index] = np.uint64(int(self.read_input(">")))
 
     def input_to_register_bin(self, register_index: np.uint16) -> None:
         """
@@ -312,7 +699,7 @@ class Chip64:
         Takes input from the console and places it into the register indicated
         by register_index. Input is expected in binary
         """
-        self.registers[register_index] = np.uint64(int(c64u.console_input(">"), 2))
+        self.registers[register_index] = np.uint64(int(self.read_input(">"), 2))
 
     def input_to_register_oct(self, register_index: np.uint16) -> None:
         """
@@ -320,134 +707,305 @@ class Chip64:
         Takes input from the console and places it into the register indicated
         by register_index. Input is expected in octal
         """
-        self.registers[register_index] = np.uint64(int(c64u.console_input(">"), 8))
+        self.registers[register_index] = np.uint64(int(self.read_input(">"), 8))
 
-    def execute(self, num_of_cycles=None) -> None:
+    @ignore_overflow
+    def step(self) -> bool:
         """
-        The main execution loop of the emulator.
-        num_of_cycles gives the number of cycles you'd like the emulator to run for.
-        If no parameter is passed then the emulator will cycle indefinitely.
+        Executes the instruction at code_ptr.
+        Returns False without doing anything if it is a HALT, True otherwise.
         """
-        while num_of_cycles is None or num_of_cycles > 0:
-            opcode = c64u.concat(
-                self.memory[self.code_ptr], self.memory[self.code_ptr + 1]
-            )
+        return self._step()
 
-            # Flag dictates if we want to increment the code ptr at the end of this iteration.
-            # This prevents irritating -2 terms in code_ptr modifying instructions.
-            code_ptr_increment_flag = True
+    def _step(self) -> bool:
+        """
+        step() for callers that have already turned off overflow warnings.
+        """
+        opcode = c64u.concat(
+            self.memory[self.code_ptr], self.memory[self.code_ptr + 1]
+        )
+
+        # Flag dictates if we want to increment the code ptr at the end of this iteration.
+        # This prevents irritating -2 terms in code_ptr modifying instructions.
+        code_ptr_increment_flag = True
 
-            if opcode == 0x0000: # pragma: no cover
-                return
-            elif opcode == 0x01EE:
-                self.subroutine_return()
-                code_ptr_increment_flag = True
-
-            nib3 = c64u.get_nibble(opcode, 3)
-            if nib3 == 1:
-                self.goto(opcode & np.uint16(0xFFF))
-                code_ptr_increment_flag = False
-            elif nib3 == 2:
-                self.subroutine_call(opcode & np.uint16(0xFFF))
-                code_ptr_increment_flag = False
-            elif nib3 == 3:
-                self.skip_next_if_equal_const(
-                    c64u.get_nibble(opcode, 2), c64u.low_byte(opcode)
+        if opcode == 0x0000: # pragma: no cover
+            return False
+        elif opcode == 0x01EE:
+            self.subroutine_return()
+            code_ptr_increment_flag = True
+        elif opcode < 0x1000:
+            self.host_call(opcode & np.uint16(0xFFF))
+
+        nib3 = c64u.get_nibble(opcode, 3)
+        if nib3 == 1:
+            self.goto(opcode & np.uint16(0xFFF))
+            code_ptr_increment_flag = False
+        elif nib3 == 2:
+            self.subroutine_call(opcode & np.uint16(0xFFF))
+            code_ptr_increment_flag = False
+        elif nib3 == 3:
+            self.skip_next_if_equal_const(
+                c64u.get_nibble(opcode, 2), c64u.low_byte(opcode)
+            )
+        elif nib3 == 4:
+            self.skip_next_if_unequal_const(
+                c64u.get_nibble(opcode, 2), c64u.low_byte(opcode)
+            )
+        elif nib3 == 5:
+            self.skip_next_if_equal(
+                c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
+            )
+        elif nib3 == 6:
+            self.assign_const_to_register(
+                c64u.get_nibble(opcode, 2), c64u.low_byte(opcode)
+            )
+        elif nib3 == 7:
+            self.add_const_to_register(
+                c64u.get_nibble(opcode, 2), c64u.low_byte(opcode)
+            )
+        elif nib3 == 8:
+            nib0 = c64u.get_nibble(opcode, 0)
+            if nib0 == 0:
+                self.assign_register(
+                    c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
+                )
+            elif nib0 == 1:
+                self.bitwise_or(
+                    c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
+                )
+            elif nib0 == 2:
+                self.bitwise_and(
+                    c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
+                )
+            elif nib0 == 3:
+                self.bitwise_xor(
+                    c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
                 )
-            elif nib3 == 4:
-                self.skip_next_if_unequal_const(
-                    c64u.get_nibble(opcode, 2), c64u.low_byte(opcode)
+            elif nib0 == 4:
+                self.add_registers(
+                    c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
                 )
-            elif nib3 == 5:
-                self.skip_next_if_equal(
+            elif nib0 == 5:
+                self.subtract_registers(
                     c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
                 )
-            elif nib3 == 6:
-                self.assign_const_to_register(
-                    c64u.get_nibble(opcode, 2), c64u.low_byte(opcode)
+            elif nib0 == 6:
+                self.bitwise_right_shift(
+                    c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
+                )
+            elif nib0 == 7:
+                self.subtract_registers(
+                    c64u.get_nibble(opcode, 1), c64u.get_nibble(opcode, 2)
+                )
+            elif nib0 == 8:
+                self.add_with_carry(
+                    c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
                 )
-            elif nib3 == 7:
-                self.add_const_to_register(
-                    c64u.get_nibble(opcode, 2), c64u.low_byte(opcode)
+            elif nib0 == 9:
+                self.subtract_with_borrow(
+                    c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
                 )
-            elif nib3 == 8:
-                nib0 = c64u.get_nibble(opcode, 0)
-                if nib0 == 0:
-                    self.assign_register(
-                        c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
-                    )
-                elif nib0 == 1:
-                    self.bitwise_or(
-                        c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
-                    )
-                elif nib0 == 2:
-                    self.bitwise_and(
-                        c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
-                    )
-                elif nib0 == 3:
-                    self.bitwise_xor(
-                        c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
-                    )
-                elif nib0 == 4:
-                    self.add_registers(
-                        c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
-                    )
-                elif nib0 == 5:
-                    self.subtract_registers(
-                        c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
-                    )
-                elif nib0 == 6:
-                    self.bitwise_right_shift(
-                        c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
-                    )
-                elif nib0 == 7:
-                    self.subtract_registers(
-                        c64u.get_nibble(opcode, 1), c64u.get_nibble(opcode, 2)
-                    )
-                elif nib0 == 0xE:
-                    self.bitwise_left_shift(
-                        c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
-                    )
-            elif nib3 == 9:
-                self.skip_next_if_unequal(
+            elif nib0 == 0xE:
+                self.bitwise_left_shift(
                     c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
                 )
-            elif nib3 == 0xA:
-                self.set_memory_ptr(opcode & np.uint16(0xFFF))
-            elif nib3 == 0xB:
-                self.set_code_ptr_to_acc_plus_const(opcode & np.uint16(0xFFF))
-                code_ptr_increment_flag = False
-            elif nib3 == 0xC:
-                self.bitwise_and_rand(c64u.get_nibble(opcode, 2), c64u.low_byte(opcode))
-            elif nib3 == 0xD:
-                nib0 = c64u.get_nibble(opcode, 0)
-                if nib0 == 0:
-                    self.display_register_hex(c64u.get_nibble(opcode, 2))
-                elif nib0 == 1:
-                    self.display_register_dec(c64u.get_nibble(opcode, 2))
-                elif nib0 == 2:
-                    self.display_register_bin(c64u.get_nibble(opcode, 2))
-                elif nib0 == 3:
-                    self.display_register_oct(c64u.get_nibble(opcode, 2))
-            elif nib3 == 0xE:
-                if c64u.low_byte(opcode) == 0x1E:
-                    self.add_register_to_memory_ptr(c64u.get_nibble(opcode, 2))
-                elif c64u.low_byte(opcode) == 0x55:
-                    self.spill_registers(c64u.get_nibble(opcode, 2))
-                elif c64u.low_byte(opcode) == 0x65:
-                    self.load_registers(c64u.get_nibble(opcode, 2))
-            elif nib3 == 0xF:
-                nib0 = c64u.get_nibble(opcode, 0)
-                if nib0 == 0:
-                    self.input_to_register_hex(c64u.get_nibble(opcode, 2))
-                elif nib0 == 1:
-                    self.input_to_register_dec(c64u.get_nibble(opcode, 2))
-                elif nib0 == 2:
-                    self.input_to_register_bin(c64u.get_nibble(opcode, 2))
-                elif nib0 == 3:
-                    self.input_to_register_oct(c64u.get_nibble(opcode, 2))
-
-            if code_ptr_increment_flag:
-                self.code_ptr += 2
+        elif nib3 == 9:
+            self.skip_next_if_unequal(
+                c64u.get_nibble(opcode, 2), c64u.get_nibble(opcode, 1)
+            )
+        elif nib3 == 0xA:
+            self.set_memory_ptr(opcode & np.uint16(0xFFF))
+        elif nib3 == 0xB:
+            self.set_code_ptr_to_acc_plus_const(opcode & np.uint16(0xFFF))
+            code_ptr_increment_flag = False
+        elif nib3 == 0xC:
+            self.bitwise_and_rand(c64u.get_nibble(opcode, 2), c64u.low_byte(opcode))
+        elif nib3 == 0xD:
+            nib0 = c64u.get_nibble(opcode, 0)
+            if nib0 == 0:
+                self.display_register_hex(c64u.get_nibble(opcode, 2))
+            elif nib0 == 1:
+                self.display_register_dec(c64u.get_nibble(opcode, 2))
+            elif nib0 == 2:
+                self.display_register_bin(c64u.get_nibble(opcode, 2))
+            elif nib0 == 3:
+                self.display_register_oct(c64u.get_nibble(opcode, 2))
+        elif nib3 == 0xE:
+            if c64u.low_byte(opcode) == 0x1E:
+                self.add_register_to_memory_ptr(c64u.get_nibble(opcode, 2))
+            elif c64u.low_byte(opcode) == 0x55:
+                self.spill_registers(c64u.get_nibble(opcode, 2))
+            elif c64u.low_byte(opcode) == 0x65:
+                self.load_registers(c64u.get_nibble(opcode, 2))
+            elif c64u.low_byte(opcode) == 0xA4:
+                self.add_memory(c64u.get_nibble(opcode, 2))
+            elif c64u.low_byte(opcode) == 0xA5:
+                self.subtract_memory(c64u.get_nibble(opcode, 2))
+        elif nib3 == 0xF:
+            nib0 = c64u.get_nibble(opcode, 0)
+            if nib0 == 0:
+                self.input_to_register_hex(c64u.get_nibble(opcode, 2))
+            elif nib0 == 1:
+                self.input_to_register_dec(c64u.get_nibble(opcode, 2))
+            elif nib0 == 2:
+                self.input_to_register_bin(c64u.get_nibble(opcode, 2))
+            elif nib0 == 3:
+                self.input_to_register_oct(c64u.get_nibble(opcode, 2))
+
+        if code_ptr_increment_flag:
+            self.code_ptr += 2
+        return True
+
+    @measured
+    def execute(self, num_of_cycles=None, deadline=None) -> ExecutionResult:
+        """
+        The main execution loop of the emulator.
+        num_of_cycles gives the number of cycles you'd like the emulator to run for.
+        If no parameter is passed then the emulator will cycle indefinitely.
+        deadline is a time.monotonic() value to stop at, checked every
+        DEADLINE_INTERVAL cycles.
+        Execution also stops at a jump to itself and, if detect_loops is set,
+        when a back edge returns to an earlier state, as neither can ever
+        halt. halt_reason then says why it stopped. Returns an
+        ExecutionResult.
+        """
+        if self._observed:
+            self._execute_observed(num_of_cycles, deadline)
+            return
+        self.halt_reason = self.loop_address = self.stop_address = None
+        repeats = RepeatDetector() if self.detect_loops else None
+        remaining = UNLIMITED if num_of_cycles is None else num_of_cycles
+        while remaining > 0:
+            count = remaining
+            if deadline is not None:
+                if time.monotonic() >= deadline:
+                    self.halt_reason = DEADLINE
+                    return
+                count = min(remaining, DEADLINE_INTERVAL)
+            remaining -= count
+            for _ in range(count):
+                pc, depth = self.code_ptr, len(self.stack)
+                if repeats is not None and nondeterministic(
+                    c64u.concat(self.memory[pc], self.memory[pc + 1])
+                ):
+                    repeats.clear()
+                if not self._step():
+                    self.halt_reason = HALTED
+                    return
+                self.cycles += 1
+                if self.code_ptr > pc:
+                    continue
+                if self.code_ptr == pc and len(self.stack) == depth:
+                    self._stop_loop(pc)
+                    return
+                if repeats is not None and repeats.seen(self._state(), self._memory_copy):
+                    self._stop_loop(self.code_ptr)
+                    return
+        self.halt_reason = CYCLE_LIMIT
+
+    @ignore_overflow
+    def _execute_observed(self, num_of_cycles, deadline=None) -> None:
+        """
+        execute() with hooks, breakpoints and watchpoints, used while any are
+        installed.
+        """
+        self.halt_reason = self.loop_address = self.stop_address = None
+        repeats = RepeatDetector() if self.detect_loops else None
+        hooks = self._hooks
+        watching = bool(hooks["memory_write"] or self._watchpoints)
+        first = True
+        check_at = self.cycles
+        while num_of_cycles is None or num_of_cycles > 0:
+            if deadline is not None and self.cycles >= check_at:
+                if time.monotonic() >= deadline:
+                    self.halt_reason = DEADLINE
+                    break
+                check_at = self.cycles + DEADLINE_INTERVAL
+            pc, depth = int(self.code_ptr), len(self.stack)
+            if pc in self._breakpoints and not first:
+                self.halt_reason, self.stop_address = BREAKPOINT, pc
+                break
+            first = False
+            opcode = c64d.fetch(self.memory, pc)
+            m, x = c64d.mnemonic(opcode), (opcode >> 8) & 0xF
+            for hook in hooks["instruction"]:
+                hook(self, pc, opcode)
+            written = self._write_range(m, x) if watching else None
+            if watching and m == "HOST":
+                before = np.array(self.memory, dtype=np.uint8)
+            if repeats is not None and m in c64d.NONDETERMINISTIC:
+                repeats.clear()
+            if not self._step():
+                self.halt_reason = HALTED
+                break
+            self.cycles += 1
             if num_of_cycles is not None:
                 num_of_cycles -= 1
+            if m == "CALL" or m == "RET":
+                for hook in hooks["call" if m == "CALL" else "return"]:
+                    hook(self, pc, int(self.code_ptr))
+            elif m in c64d.INPUTS or m in c64d.OUTPUTS:
+                kind = "input" if m in c64d.INPUTS else "output"
+                for hook in hooks["io"]:
+                    hook(self, pc, kind, int(self.registers[x]))
+            elif watching and m == "HOST":
+                changed = np.flatnonzero(np.array(self.memory, dtype=np.uint8) != before)
+                if len(changed):
+                    written = int(changed[0]), int(changed[-1]) + 1
+            if written is not None:
+                low, high = written
+                for hook in hooks["memory_write"]:
+                    hook(self, pc, low, high)
+                if any(a < high and low < b for a, b in self._watchpoints):
+                    self.halt_reason, self.stop_address = WATCHPOINT, pc
+                    break
+            if self.code_ptr > pc:
+                continue
+            if self.code_ptr == pc and len(self.stack) == depth:
+                self._stop_loop(pc)
+                break
+            if repeats is not None and repeats.seen(self._state(), self._memory_copy):
+                self._stop_loop(self.code_ptr)
+                break
+        else:
+            self.halt_reason = CYCLE_LIMIT
+        for hook in hooks["halt"]:
+            hook(self, self.halt_reason)
+
+    def _write_range(self, m: str, x: int):
+        """
+        Returns the [low, high) range of memory the instruction m with
+        register operand x is about to write, None if it writes none.
+        """
+        low = int(self.memory_ptr)
+        if m == "SPILL":
+            return low, low + 8 * (x + 1)
+        if m == "ADDM" or m == "SUBM":
+            return low, low + 8 * int(self.registers[x])
+        return None
+
+    def _state(self) -> tuple:
+        """
+        Returns the machine state other than memory for RepeatDetector.
+        """
+        return (
+            int(self.code_ptr),
+            int(self.memory_ptr),
+            tuple(int(value) for value in self.registers),
+            tuple(int(address) for address in self.stack),
+        )
+
+    def _memory_copy(self) -> bytes:
+        return bytes(bytearray(self.memory))
+
+    def _stop_loop(self, address: int) -> None:
+        self.halt_reason = NON_TERMINATING
+        self.loop_address = int(address)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    import sys
+    import chip64_cli
+
+    sys.exit(chip64_cli.main())
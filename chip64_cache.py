@@ -0,0 +1,225 @@
+"""
+Caches of verified and compiled programs.
+Short lived processes that run the same programs over and over can share a
+DiskCache so that each program is analysed and its blocks compiled once,
+rather than once per process. Entries are keyed by the code of a program,
+with a small entry per memory image pointing at them, so images differing
+only in their data are analysed again but share compiled code. Machines running on the threads of one process
+can share a MemoryCache instead.
+"""
+
+import collections
+import hashlib
+import importlib.util
+import marshal
+import os
+import pickle
+import tempfile
+import threading
+
+# Raise whenever the analysis or the generated code changes meaning, entries
+# written by another engine version are then ignored.
+ENGINE_VERSION = 5
+SUFFIX = ".c64c"
+
+
+class DiskCache:
+    """
+    A directory of cache entries, one file per program, bounded in size by
+    evicting the least recently used entries.
+    Entries are written to a temporary file and renamed into place, so any
+    number of processes may read and write the same directory at once. A
+    reader sees either a whole entry or none. Entries are unpickled, so the
+    directory must only be writable by trusted users. hits and misses count
+    the lookups of load().
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 64 << 20):
+        """
+        Creates a cache in directory, making it if needed, holding at most
+        max_bytes of entries.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(image: bytes, analysis=None) -> str:
+        """
+        Returns the cache key for a memory image, covering the engine and
+        Python versions as well as the program. Given the image's analysis
+        the key covers only the bytes it read, see Analysis.read_bytes(), so
+        images holding the same code and different data share it.
+        """
+        digest = hashlib.sha256()
+        digest.update(b"chip64 %d " % ENGINE_VERSION)
+        digest.update(importlib.util.MAGIC_NUMBER)
+        if analysis is None:
+            digest.update(bytes(image))
+        else:
+            digest.update(b"code ")
+            for address in sorted(analysis.read_bytes()):
+                digest.update(address.to_bytes(2, "little") + image[address : address + 1])
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def load(self, key: str):
+        """
+        Returns the entry stored under key, or None if there is none.
+        Unreadable entries are removed and treated as missing.
+        """
+        entry = self.load_object(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        analysis, codes = entry
+        return analysis, {source: marshal.loads(code) for source, code in codes.items()}
+
+    def store(self, key: str, analysis, codes: dict) -> None:
+        """
+        Stores an analysis and a dictionary mapping generated source to its
+        compiled code object under key, then evicts old entries if the cache
+        has grown too large.
+        """
+        self.store_object(
+            key, (analysis, {source: marshal.dumps(code) for source, code in codes.items()})
+        )
+
+    def load_object(self, key: str):
+        """
+        Returns the object stored under key by store_object(), or None if
+        there is none.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            self._remove(path)
+            return None
+        return value
+
+    def store_object(self, key: str, value) -> None:
+        """
+        Stores any picklable object under key, then evicts old entries if
+        the cache has grown too large.
+        """
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temporary, self._path(key))
+        except BaseException:
+            self._remove(temporary)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries until the cache fits in
+        max_bytes.
+        """
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(SUFFIX):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self) -> None:
+        """
+        Removes every entry.
+        """
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(SUFFIX):
+                    self._remove(entry.path)
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class MemoryCache:
+    """
+    An in-process cache with the interface of DiskCache, holding at most
+    max_entries programs and evicting the least recently used. Any number of
+    threads may use one at once.
+    """
+
+    key = staticmethod(DiskCache.key)
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, key: str):
+        """
+        Returns the entry stored under key, or None if there is none.
+        """
+        entry = self.load_object(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        analysis, codes = entry
+        return analysis, dict(codes)
+
+    def store(self, key: str, analysis, codes: dict) -> None:
+        """
+        Stores an analysis and a dictionary mapping generated source to its
+        compiled code object under key.
+        """
+        self.store_object(key, (analysis, dict(codes)))
+
+    def load_object(self, key: str):
+        """
+        Returns the object stored under key by store_object(), or None if
+        there is none.
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def store_object(self, key: str, value) -> None:
+        """
+        Stores an object under key, which must not be modified afterwards.
+        """
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        Removes every entry.
+        """
+        with self._lock:
+            self._entries.clear()
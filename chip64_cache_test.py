@@ -0,0 +1,140 @@
+import chip64_cache
+import chip64_fast
+import chip64_fast_test
+import chip64_verify
+import concurrent.futures
+import os
+import unittest.mock
+
+
+def run_cached(directory):
+    """
+    Runs the multiply program on a cached FastChip64 and returns r2.
+    """
+    (_, c64), _ = run_with(chip64_cache.DiskCache(directory))
+    return int(c64.registers[2])
+
+
+def run_with(cache):
+    """
+    Runs the multiply program on Chip64 and on a FastChip64 using cache.
+    """
+    original = chip64_fast.FastChip64
+    try:
+        chip64_fast.FastChip64 = lambda code: original(code, cache=cache)
+        return chip64_fast_test.run_both(chip64_fast_test.MULTIPLY, ["6", "7"])
+    finally:
+        chip64_fast.FastChip64 = original
+
+
+def test_cache_round_trip(tmp_path, monkeypatch):
+    """
+    Test that a second machine loads the analysis and code from the cache,
+    and that one holding different data shares the compiled code.
+    """
+    cache = chip64_cache.DiskCache(str(tmp_path))
+    (a, b), _ = run_with(cache)
+    chip64_fast_test.assert_same_state(a, b)
+    # One entry for the image and one for its code.
+    assert len(list(tmp_path.glob("*.c64c"))) == 2
+    cache = chip64_cache.DiskCache(str(tmp_path))
+    c64 = chip64_fast.FastChip64(chip64_fast_test.MULTIPLY + [0x12, 0x34], cache=cache)
+    c64.read_input = unittest.mock.MagicMock(side_effect=["6", "7"])
+    c64.write_output = unittest.mock.MagicMock()
+    c64.execute()
+    assert int(c64.registers[2]) == 42
+    assert (cache.hits, cache.misses) == (1, 0)
+    assert len(list(tmp_path.glob("*.c64c"))) == 3
+
+    def fail(*args, **kwargs):
+        raise AssertionError("program was analysed again")
+
+    monkeypatch.setattr(chip64_verify, "check", fail)
+    (a, b), _ = run_with(chip64_cache.DiskCache(str(tmp_path)))
+    chip64_fast_test.assert_same_state(a, b)
+    assert int(b.registers[2]) == 42
+
+
+def test_cache_key():
+    """
+    Test that keys depend on the program, and given its analysis only on
+    the code and jump tables read by it.
+    """
+    key = chip64_cache.DiskCache.key
+    assert key(b"\x60\x01") == key(bytearray(b"\x60\x01"))
+    assert key(b"\x60\x01") != key(b"\x60\x02")
+
+    def code_key(image):
+        return key(image, chip64_verify.check(image))
+
+    # Dispatches through a two entry table at $006 ended by the HALT at $00A.
+    dispatch = b"\xC0\x02\xB0\x06\x00\x00\x10\x04\x10\x04\x00\x00"
+    assert code_key(dispatch + b"\x12") == code_key(dispatch + b"\x34")
+    assert code_key(dispatch + b"\x12") != key(dispatch + b"\x12")
+    assert code_key(dispatch) != code_key(dispatch[:10] + b"\x10\x04")
+
+
+def test_cache_corrupt_entry(tmp_path):
+    """
+    Test that an unreadable entry is removed and treated as a miss.
+    """
+    cache = chip64_cache.DiskCache(str(tmp_path))
+    path = tmp_path / ("0" * 64 + chip64_cache.SUFFIX)
+    path.write_bytes(b"not a cache entry")
+    assert cache.load("0" * 64) is None
+    assert not path.exists()
+    assert cache.load("1" * 64) is None
+
+
+def test_cache_eviction(tmp_path):
+    """
+    Test that the least recently used entries are evicted first.
+    """
+    cache = chip64_cache.DiskCache(str(tmp_path))
+    for i, name in enumerate("abc"):
+        cache.store(name, None, {"x = %d" % i: compile("x = 1", "", "exec")})
+        os.utime(tmp_path / (name + chip64_cache.SUFFIX), (i, i))
+    size = (tmp_path / ("a" + chip64_cache.SUFFIX)).stat().st_size
+    assert cache.load("a") is not None
+    cache.max_bytes = 2 * size
+    cache.evict()
+    assert cache.load("b") is None
+    assert cache.load("a") is not None
+    assert cache.load("c") is not None
+    cache.clear()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_cache_concurrent_writers(tmp_path):
+    """
+    Test that processes sharing a cache directory all get the right answer
+    and leave whole entries for the image and its code behind.
+    """
+    directory = str(tmp_path)
+    with concurrent.futures.ProcessPoolExecutor(4) as pool:
+        results = list(pool.map(run_cached, [directory] * 8))
+    assert results == [42] * 8
+    assert [p.suffix for p in tmp_path.iterdir()] == [chip64_cache.SUFFIX] * 2
+
+
+def test_memory_cache(monkeypatch):
+    """
+    Test that machines sharing a MemoryCache analyse a program once and that
+    the least recently used entries are evicted.
+    """
+    cache = chip64_cache.MemoryCache(max_entries=2)
+    (a, b), _ = run_with(cache)
+    chip64_fast_test.assert_same_state(a, b)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("program was analysed again")
+
+    monkeypatch.setattr(chip64_verify, "check", fail)
+    (a, b), _ = run_with(cache)
+    assert int(b.registers[2]) == 42
+    cache.store("a", None, {})
+    cache.store("b", None, {})
+    assert cache.load("a") == (None, {})
+    assert cache.load(cache.key(bytes(b.memory), b.analysis)) is None
+    cache.clear()
+    assert cache.load("a") is None
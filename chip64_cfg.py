@@ -0,0 +1,396 @@
+"""
+Control flow and constant analysis of Chip64 programs.
+analyse() walks every path reachable from an entry point, tracking the call
+stack exactly and register and memory_ptr values where they are constant.
+The result is the shared starting point for the verifier, the optimiser and
+the other static tools.
+"""
+
+import chip64_decode as c64d
+
+MASK = 0xFFFFFFFFFFFFFFFF
+MEMORY_SIZE = 4096
+# The architecture guarantees a call stack at least this deep, deeper call
+# chains (including any recursion) are reported as faults.
+MAX_CALL_DEPTH = 16
+# Bounds the number of (address, call stack) pairs explored.
+MAX_CONTEXTS = 200000
+
+# Index of the memory pointer in an abstract state, registers take 0 to 15.
+MP = 16
+
+# Mnemonics with no effect beyond the registers and memory_ptr they write.
+PURE = frozenset(
+    ["ACR", "ADCR", "AR", "OR", "AND", "XOR", "ADD", "SUB", "RSUB", "SHR", "SHL",
+     "ADC", "SBB", "SMP", "MPAR", "LOAD"]
+)
+# Mnemonics that read or write the memory at memory_ptr.
+MEMORY_ACCESSES = frozenset(["SPILL", "LOAD", "ADDM", "SUBM"])
+ALL_LOCATIONS = (1 << 17) - 1
+
+
+def reset_state() -> tuple:
+    """
+    Returns the abstract state of a freshly constructed Chip64, every register
+    and the memory pointer are zero.
+    """
+    return (0,) * 17
+
+
+def unknown_state() -> tuple:
+    """
+    Returns an abstract state with unknown registers and a zero memory pointer.
+    """
+    return (None,) * 16 + (0,)
+
+
+def join(a: tuple, b: tuple) -> tuple:
+    """
+    Merges two abstract states, values that disagree become unknown (None).
+    """
+    return tuple(p if p == q else None for p, q in zip(a, b))
+
+
+def _binary(op, a, b):
+    if a is None or b is None:
+        return None
+    return op(a, b) & MASK
+
+
+def transfer(instruction: c64d.Instruction, state: tuple) -> tuple:
+    """
+    Returns the abstract state after instruction executes in state.
+    Control flow is not modelled here, see analyse().
+    The order of flag and destination writes follows Chip64 exactly, which
+    matters when an operand is register 0xF.
+    """
+    m, x, y = instruction.mnemonic, instruction.x, instruction.y
+    s = list(state)
+    if m == "ACR":
+        s[x] = instruction.nn
+    elif m == "ADCR":
+        s[x] = _binary(int.__add__, s[x], instruction.nn)
+    elif m == "AR":
+        s[x] = s[y]
+    elif m == "OR":
+        s[x] = s[x] if x == y else _binary(int.__or__, s[x], s[y])
+    elif m == "AND":
+        s[x] = s[x] if x == y else _binary(int.__and__, s[x], s[y])
+    elif m == "XOR":
+        s[x] = 0 if x == y else _binary(int.__xor__, s[x], s[y])
+    elif m == "ADD":
+        a, b = s[x], s[y]
+        if a is None or b is None:
+            s[15] = None
+            s[x] = None
+        else:
+            s[15] = (a + b) >> 64
+            s[x] = (a + b) & MASK
+    elif m in ("ADC", "SBB"):
+        a, b, f = s[x], s[y], s[15]
+        if a is None or b is None or f is None:
+            s[15] = None
+            s[x] = None
+        elif m == "ADC":
+            s[15] = (a + b + (f & 1)) >> 64
+            s[x] = (a + b + (f & 1)) & MASK
+        else:
+            s[15] = int(a - b - (1 - (f & 1)) >= 0)
+            s[x] = (a - b - (1 - (f & 1))) & MASK
+    elif m in ("ADDM", "SUBM"):
+        s[15] = None
+    elif m in ("SUB", "RSUB"):
+        dest, src = (x, y) if m == "SUB" else (y, x)
+        a, b = s[dest], s[src]
+        if dest == src:
+            s[15] = 1
+        else:
+            s[15] = None if a is None or b is None else int(a >= b)
+        s[dest] = 0 if dest == src else _binary(int.__sub__, s[dest], s[src])
+    elif m == "SHR":
+        if y == 0:
+            s[15] = 0
+        else:
+            s[15] = None if s[x] is None else (s[x] >> (y - 1)) & 1
+            s[x] = None if s[x] is None else s[x] >> y
+    elif m == "SHL":
+        if y == 0:
+            s[15] = 0
+        else:
+            s[15] = None if s[x] is None else (s[x] >> (64 - y)) & 1
+            s[x] = _binary(int.__lshift__, s[x], y)
+    elif m == "SMP":
+        s[MP] = instruction.nnn
+    elif m == "MPAR":
+        s[MP] = _binary(int.__add__, s[MP], s[x])
+    elif m == "BAR":
+        s[x] = 0 if instruction.nn == 0 else None
+    elif m == "LOAD":
+        for i in range(x + 1):
+            s[i] = None
+    elif m in c64d.INPUTS:
+        s[x] = None
+    elif m == "HOST":
+        s[:16] = [None] * 16
+    return tuple(s)
+
+
+def skip_taken(instruction: c64d.Instruction, state: tuple):
+    """
+    Returns True or False if a skip instruction's outcome is known in state,
+    None otherwise.
+    """
+    m, x, y = instruction.mnemonic, instruction.x, instruction.y
+    if m in ("SNE", "SNUE") and x == y:
+        return m == "SNE"
+    a = state[x]
+    b = instruction.nn if m in ("SNEC", "SNUEC") else state[y]
+    if a is None or b is None:
+        return None
+    return (a == b) == (m in ("SNEC", "SNE"))
+
+
+def _bits(*locations) -> int:
+    rv = 0
+    for location in locations:
+        rv |= 1 << location
+    return rv
+
+
+def uses_and_defs(instruction: c64d.Instruction) -> tuple:
+    """
+    Returns (uses, defs) bit masks of the registers and memory_ptr (bit MP)
+    that instruction reads and always writes. HALT and RET read nothing here,
+    callers decide what is live at those points.
+    """
+    m, x, y = instruction.mnemonic, instruction.x, instruction.y
+    if m in ("ACR", "BAR") or m in c64d.INPUTS:
+        return 0, _bits(x)
+    if m == "ADCR":
+        return _bits(x), _bits(x)
+    if m == "AR":
+        return _bits(y), _bits(x)
+    if m in ("OR", "AND", "XOR"):
+        return _bits(x, y), _bits(x)
+    if m in ("ADD", "SUB"):
+        return _bits(x, y), _bits(x, 15)
+    if m in ("ADC", "SBB"):
+        return _bits(x, y, 15), _bits(x, 15)
+    if m in ("ADDM", "SUBM"):
+        return _bits(x, MP), _bits(15)
+    if m == "RSUB":
+        return _bits(x, y), _bits(y, 15)
+    if m in ("SHR", "SHL"):
+        return (0, _bits(15)) if y == 0 else (_bits(x), _bits(x, 15))
+    if m in ("SNEC", "SNUEC") or m in c64d.OUTPUTS:
+        return _bits(x), 0
+    if m in ("SNE", "SNUE"):
+        return _bits(x, y), 0
+    if m == "SMP":
+        return 0, _bits(MP)
+    if m == "MPAR":
+        return _bits(x, MP), _bits(MP)
+    if m == "SPILL":
+        return _bits(MP, *range(x + 1)), 0
+    if m == "LOAD":
+        return _bits(MP), _bits(*range(x + 1))
+    if m == "CPAC":
+        return _bits(0), 0
+    if m == "HOST":
+        # A host function may read any register and write none of them.
+        return _bits(*range(16)), 0
+    return 0, 0
+
+
+def jump_table(memory, address: int) -> tuple:
+    """
+    Returns the targets of the jump table at address, the run of GOTOs a
+    BNNN with NNN equal to address dispatches into with r0 the byte offset
+    of the entry. A GOTO to itself ends the run, the table may be empty.
+    """
+    targets = []
+    while address + 1 < min(len(memory), MEMORY_SIZE):
+        instruction = c64d.decode_at(memory, address)
+        if instruction.mnemonic != "GOTO" or instruction.nnn == address:
+            break
+        targets.append(instruction.nnn)
+        address += 2
+    return tuple(targets)
+
+
+def memory_range(instruction: c64d.Instruction, state: tuple):
+    """
+    Returns the [low, high) byte range touched by a SPILL, LOAD, ADDM or SUBM
+    in state, or None if it depends on unknown values.
+    """
+    if state[MP] is None:
+        return None
+    if instruction.mnemonic in ("ADDM", "SUBM"):
+        limbs = state[instruction.x]
+        if limbs is None:
+            return None
+        return state[MP], state[MP] + 16 * limbs
+    return state[MP], state[MP] + 8 * (instruction.x + 1)
+
+
+def written_range(instruction: c64d.Instruction, span: tuple) -> tuple:
+    """
+    Returns the part of the range touched by an instruction that it writes,
+    None if it writes no memory.
+    """
+    if instruction.mnemonic == "SPILL":
+        return span
+    if instruction.mnemonic in ("ADDM", "SUBM"):
+        return span[0], (span[0] + span[1]) // 2
+    return None
+
+
+class Analysis:
+    """
+    The result of analyse().
+    instructions maps every reachable address to its Instruction.
+    states maps every reachable address to the abstract state before the
+    instruction there, merged over all paths and call stacks.
+    successors maps every reachable address to the set of addresses control
+    can move to next, returns included.
+    faults lists (address, message) pairs for paths the analysis could not
+    follow or that would fault at run time.
+    accesses maps the address of every reachable instruction in
+    MEMORY_ACCESSES to the byte ranges it touches, None standing for an
+    unknown range.
+    jump_tables maps the address of every BNNN reached with r0 unknown to
+    the targets of the jump table at its NNN, see jump_table(). Such jumps
+    are only followed into the table, engines check r0 against it.
+    """
+
+    def __init__(self, memory, entry):
+        self.memory = memory
+        self.entry = entry
+        self.instructions = {}
+        self.states = {}
+        self.successors = {}
+        self.faults = []
+        self.accesses = {}
+        self.call_sites = set()
+        self.jump_tables = {}
+
+    def code_bytes(self) -> set:
+        """
+        Returns the set of byte addresses occupied by reachable instructions.
+        """
+        return {a + i for a in self.instructions for i in (0, 1)}
+
+    def read_bytes(self) -> set:
+        """
+        Returns the set of byte addresses the analysis depends on, those of
+        reachable instructions and of every jump table along with the
+        instruction ending it.
+        """
+        found = self.code_bytes()
+        for address, table in self.jump_tables.items():
+            start = self.instructions[address].nnn
+            end = min(start + 2 * len(table) + 2, len(self.memory), MEMORY_SIZE)
+            found.update(range(start, end))
+        return found
+
+    def fault(self, address: int, message: str) -> None:
+        """
+        Records a fault once.
+        """
+        if (address, message) not in self.faults:
+            self.faults.append((address, message))
+
+
+def _targets(analysis, instruction, state, stack):
+    """
+    Yields the (address, stack) pairs that follow instruction.
+    """
+    m, address = instruction.mnemonic, instruction.address
+    if m == "HALT":
+        return
+    elif m == "RET":
+        if not stack:
+            analysis.fault(address, "RET with an empty call stack")
+            return
+        yield stack[-1] + 2, stack[:-1]
+    elif m == "GOTO":
+        yield instruction.nnn, stack
+    elif m == "CALL":
+        if len(stack) >= MAX_CALL_DEPTH:
+            analysis.fault(
+                address, "call depth exceeds %d, recursion cannot be verified"
+                % MAX_CALL_DEPTH
+            )
+            return
+        analysis.call_sites.add(address)
+        yield instruction.nnn, stack + (address,)
+    elif m == "CPAC":
+        if state[0] is None:
+            table = jump_table(analysis.memory, instruction.nnn)
+            if not table:
+                analysis.fault(address, "computed jump target cannot be determined")
+                return
+            analysis.jump_tables[address] = table
+            for i in range(len(table)):
+                yield instruction.nnn + 2 * i, stack
+            return
+        yield (state[0] + instruction.nnn) & MASK, stack
+    elif m in c64d.SKIPS:
+        taken = skip_taken(instruction, state)
+        if taken is not True:
+            yield address + 2, stack
+        if taken is not False:
+            yield address + 4, stack
+    else:
+        yield address + 2, stack
+
+
+def analyse(memory, entry: int = 0, state: tuple = None) -> Analysis:
+    """
+    Explores every path through the program in memory starting at entry.
+    state is the abstract state at entry, by default that of a freshly
+    constructed Chip64.
+    """
+    analysis = Analysis(memory, entry)
+    if state is None:
+        state = reset_state()
+    contexts = {(entry, ()): state}
+    worklist = [(entry, ())]
+    size = min(len(memory), MEMORY_SIZE)
+    while worklist:
+        key = worklist.pop()
+        address, stack = key
+        current = contexts[key]
+        instruction = analysis.instructions.get(address)
+        if instruction is None:
+            instruction = c64d.decode_at(memory, address)
+            analysis.instructions[address] = instruction
+        if instruction.mnemonic in MEMORY_ACCESSES:
+            analysis.accesses.setdefault(address, set()).add(
+                memory_range(instruction, current)
+            )
+        after = transfer(instruction, current)
+        for target, target_stack in _targets(analysis, instruction, current, stack):
+            analysis.successors.setdefault(address, set()).add(target)
+            if target % 2:
+                analysis.fault(address, "jump target $%03X is odd" % target)
+                continue
+            if target + 1 >= size:
+                analysis.fault(address, "execution runs off the end of memory")
+                continue
+            target_key = (target, target_stack)
+            previous = contexts.get(target_key)
+            merged = after if previous is None else join(previous, after)
+            if merged != previous:
+                if previous is None and len(contexts) >= MAX_CONTEXTS:
+                    analysis.fault(address, "program is too large to analyse")
+                    continue
+                contexts[target_key] = merged
+                worklist.append(target_key)
+        analysis.successors.setdefault(address, set())
+    for (address, _), current in contexts.items():
+        previous = analysis.states.get(address)
+        analysis.states[address] = (
+            current if previous is None else join(previous, current)
+        )
+    return analysis
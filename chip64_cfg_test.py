@@ -0,0 +1,114 @@
+import chip64_cfg
+import chip64_decode as c64d
+import chip64_test
+
+# The shift and add multiply from c_mul.py followed by a HALT.
+MULTIPLY = [
+    0xF0, 0x01, 0xF1, 0x01, 0x62, 0x00, 0x63, 0x00,
+    0x43, 0x40, 0x10, 0x18, 0x80, 0x16, 0x3F, 0x00,
+    0x82, 0x14, 0x81, 0x1E, 0x73, 0x01, 0x10, 0x08,
+    0xD2, 0x01, 0x00, 0x00,
+]
+
+
+def test_transfer_flags():
+    """
+    Test the transfer() function, ensure that flags are computed and that
+    unknown operands give unknown results.
+    """
+    state = chip64_cfg.reset_state()
+    state = chip64_cfg.transfer(c64d.decode(0x60FF), state)
+    state = chip64_cfg.transfer(c64d.decode(0x8016), state)
+    assert state[0] == 0x7F
+    assert state[0xF] == 1
+    state = chip64_cfg.transfer(c64d.decode(0xF101), state)
+    state = chip64_cfg.transfer(c64d.decode(0x8014), state)
+    assert state[0] is None
+    assert state[0xF] is None
+
+
+def test_transfer_register_f_operand():
+    """
+    Test the transfer() function when register 0xF is the destination, the
+    flag write must happen before the result is stored.
+    """
+    state = chip64_cfg.reset_state()
+    state = chip64_cfg.transfer(c64d.decode(0x6F05), state)
+    state = chip64_cfg.transfer(c64d.decode(0x6102), state)
+    state = chip64_cfg.transfer(c64d.decode(0x8F15), state)
+    assert state[0xF] == 0xFFFFFFFFFFFFFFFF
+
+
+def test_skip_taken():
+    """
+    Test the skip_taken() function.
+    """
+    state = chip64_cfg.unknown_state()
+    assert chip64_cfg.skip_taken(c64d.decode(0x3001), state) is None
+    assert chip64_cfg.skip_taken(c64d.decode(0x5110), state) is True
+    assert chip64_cfg.skip_taken(c64d.decode(0x9110), state) is False
+    state = chip64_cfg.reset_state()
+    assert chip64_cfg.skip_taken(c64d.decode(0x3001), state) is False
+
+
+def test_analyse():
+    """
+    Test the analyse() function on the multiply loop.
+    """
+    analysis = chip64_cfg.analyse(MULTIPLY)
+    assert analysis.faults == []
+    assert sorted(analysis.instructions) == list(range(0, 28, 2))
+    assert analysis.successors[0x08] == {0x0A, 0x0C}
+    assert analysis.successors[0x16] == {0x08}
+    assert analysis.successors[0x1A] == set()
+    # r3 counts up in the loop but r2 is only known before it.
+    assert analysis.states[0x08][3] is None
+    assert analysis.states[0x08][2] is None
+    assert analysis.states[0x06][2] == 0
+
+
+def test_analyse_calls():
+    """
+    Test the analyse() function, ensure that returns go back to the caller
+    and that an unbalanced return is reported.
+    """
+    code = [0x20, 0x06, 0x00, 0x00, 0x00, 0x00, 0x60, 0x01, 0x01, 0xEE]
+    analysis = chip64_cfg.analyse(code)
+    assert analysis.faults == []
+    assert analysis.successors[0x08] == {0x02}
+    assert analysis.call_sites == {0x00}
+
+    analysis = chip64_cfg.analyse([0x01, 0xEE])
+    assert analysis.faults == [(0, "RET with an empty call stack")]
+
+
+def test_analyse_computed_jump():
+    """
+    Test the analyse() function, a computed jump is followed when register 0
+    is known.
+    """
+    code = [0x60, 0x02, 0xB0, 0x04, 0x00, 0x00, 0x00, 0x00]
+    analysis = chip64_cfg.analyse(code)
+    assert analysis.successors[0x02] == {0x06}
+    analysis = chip64_cfg.analyse([0xF0, 0x01] + code[2:])
+    assert analysis.faults == [(2, "computed jump target cannot be determined")]
+
+
+def test_analyse_jump_table():
+    """
+    Test the jump_table() function and that a computed jump with register 0
+    unknown is followed into the jump table at its target.
+    """
+    memory = chip64_test.DISPATCH + [0x10, 0x3A, 0x10, 0x3E]
+    assert chip64_cfg.jump_table(memory, 0x18) == (0x28, 0x2C, 0x30, 0x20)
+    assert chip64_cfg.jump_table(memory, 0x1E) == (0x20,)
+    assert chip64_cfg.jump_table(memory, 0x14) == ()
+    assert chip64_cfg.jump_table(memory, 0x3A) == ()
+    assert chip64_cfg.jump_table(memory, 0x3C) == (0x3A,)
+    analysis = chip64_cfg.analyse(chip64_test.DISPATCH)
+    assert analysis.faults == []
+    assert analysis.jump_tables == {0x16: (0x28, 0x2C, 0x30, 0x20)}
+    assert analysis.successors[0x16] == {0x18, 0x1A, 0x1C, 0x1E}
+    assert analysis.jump_tables == chip64_cfg.analyse(
+        chip64_test.DISPATCH, state=chip64_cfg.unknown_state()
+    ).jump_tables
@@ -0,0 +1,349 @@
+"""
+The command line tool run by python -m chip64.
+Runs one or more program files once for every line of an input file, on any
+engine, in parallel if asked, streaming the results to a chip64_sink sink.
+Each line of the input file holds the whitespace separated values one job
+reads with the FX0Q opcodes, in order.
+Jobs run in worker processes by default. Machines share no state, so on
+free-threaded Python builds they run in threads instead, sharing one process
+and its compiled code.
+"""
+
+import argparse
+import concurrent.futures
+import cProfile
+import functools
+import itertools
+import os
+import pickle
+import re
+import sys
+import time
+import chip64
+import chip64_cache
+import chip64_fast
+import chip64_memo
+import chip64_metrics
+import chip64_sink
+import chip64_tiered
+
+ENGINES = {
+    "reference": chip64.Chip64,
+    "fast": chip64_fast.FastChip64,
+    "tiered": chip64_tiered.TieredChip64,
+}
+FORMATS = {
+    "jsonl": chip64_sink.JsonLinesSink,
+    "binary": chip64_sink.BinarySink,
+    "columns": chip64_sink.ColumnarSink,
+}
+
+EXECUTORS = ("auto", "process", "thread")
+
+# The memory available to a program.
+MAX_PROGRAM_SIZE = 4096
+
+
+def parse_hex(text: str) -> list:
+    """
+    Returns the bytes written in text as hex, pairs of digits optionally
+    prefixed with 0x and separated by whitespace or commas. Everything after
+    a # on a line is ignored.
+    """
+    code = []
+    for token in re.split(r"[\s,]+", re.sub(r"#.*", "", text)):
+        token = token[2:] if token[:2].lower() == "0x" else token
+        if token:
+            try:
+                code += bytes.fromhex(token)
+            except ValueError:
+                raise ValueError("%r is not a hex byte string" % token) from None
+    return code
+
+
+def load_program(path: str, program_format: str = "auto") -> list:
+    """
+    Returns the program in a file, read as raw bytes or as hex text. In auto
+    format files ending in .hex are read as hex and others as raw bytes.
+    """
+    if program_format == "auto":
+        program_format = "hex" if path.lower().endswith(".hex") else "binary"
+    with open(path, "rb") as f:
+        data = f.read()
+    code = parse_hex(data.decode("ascii")) if program_format == "hex" else list(data)
+    if len(code) > MAX_PROGRAM_SIZE:
+        raise ValueError(
+            "%s is %d bytes, more than the %d bytes of memory"
+            % (path, len(code), MAX_PROGRAM_SIZE)
+        )
+    return code
+
+
+def parse_inputs(lines) -> list:
+    """
+    Returns the inputs of each job, one list of strings per line. Blank lines
+    and lines starting with # are skipped.
+    """
+    return [
+        line.split() for line in lines if line.strip() and not line.lstrip().startswith("#")
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def _disk_cache(directory: str) -> chip64_cache.DiskCache:
+    """
+    Returns this process's compiled code cache in directory.
+    """
+    return chip64_cache.DiskCache(directory)
+
+
+@functools.lru_cache(maxsize=None)
+def _result_cache(directory: str) -> chip64_memo.ResultCache:
+    """
+    Returns this process's result cache in directory.
+    """
+    return chip64_memo.ResultCache(directory)
+
+
+def run_job(job: tuple):
+    """
+    Runs one job, (number, code, inputs, options), and returns (number,
+    result, error, usage) with exactly one of result and error set and usage
+    a chip64_metrics.Usage.
+    Called in worker processes, so everything it needs comes in job.
+    """
+    number, code, inputs, options = job
+    kwargs = {}
+    cache = None
+    if options.engine == "fast" and options.cache:
+        cache = options.cache
+        if isinstance(cache, str):
+            cache = _disk_cache(cache)
+        kwargs["cache"] = cache
+    engine = functools.partial(ENGINES[options.engine], **kwargs)
+    built = []
+
+    def factory(*args, **keywords):
+        built.append(True)
+        return engine(*args, **keywords)
+
+    results = options.result_cache
+    if isinstance(results, str):
+        results = _result_cache(results)
+    profile = cProfile.Profile() if options.profile else None
+    deadline = None if options.timeout is None else time.monotonic() + options.timeout
+    start = time.perf_counter()
+    run, error = None, None
+    try:
+        if profile is not None:
+            profile.enable()
+        try:
+            run = chip64_memo.run(
+                results, factory, code, inputs, options.cycles,
+                options.detect_loops, options.seed, deadline,
+            )
+        finally:
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(os.path.join(options.profile, "job-%d.prof" % number))
+    except Exception as exception:
+        error = "%s: %s" % (type(exception).__name__, exception)
+    usage = chip64_metrics.Usage(
+        time.perf_counter() - start, bool(built), len(inputs), os.getpid(),
+        chip64_metrics.cache_counters(cache, results),
+    )
+    if run is None:
+        return number, None, error, usage
+    if options.snapshot:
+        path = os.path.join(options.snapshot, "job-%d.snapshot" % number)
+        with open(path, "wb") as f:
+            pickle.dump(run.final, f)
+    return number, run.result, None, usage
+
+
+class _Inline:
+    """
+    Stands in for an executor when jobs run one at a time in this process.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def map(self, function, iterable, chunksize=1):
+        return map(function, iterable)
+
+
+def free_threaded() -> bool:
+    """
+    Returns True if this Python runs without the GIL, so that threads run
+    Python code in parallel.
+    """
+    gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    return gil_enabled is not None and not gil_enabled()
+
+
+def make_executor(kind: str, jobs: int):
+    """
+    Returns an executor running jobs jobs at once, kind being one of
+    EXECUTORS. auto picks threads on free-threaded builds and processes
+    otherwise.
+    """
+    if jobs == 1:
+        return _Inline()
+    if kind == "auto":
+        kind = "thread" if free_threaded() else "process"
+    if kind == "thread":
+        return concurrent.futures.ThreadPoolExecutor(jobs)
+    return concurrent.futures.ProcessPoolExecutor(jobs)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Returns the parser for the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m chip64", description="Runs Chip64 programs in bulk."
+    )
+    parser.add_argument("programs", nargs="+", help="program files to run")
+    parser.add_argument(
+        "--program-format",
+        choices=["auto", "binary", "hex"],
+        default="auto",
+        help="how program files are read, auto reads .hex files as hex",
+    )
+    parser.add_argument(
+        "-i",
+        "--inputs",
+        help="file with one line of inputs per job, - for stdin, "
+        "every program runs once per line",
+    )
+    parser.add_argument("-e", "--engine", choices=sorted(ENGINES), default="fast")
+    parser.add_argument("-c", "--cycles", type=int, help="cycle budget of each job")
+    parser.add_argument(
+        "-t", "--timeout", type=float, help="seconds each job may run for"
+    )
+    parser.add_argument(
+        "--detect-loops",
+        action="store_true",
+        help="stop jobs whose loops return to an earlier state",
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="jobs run at once")
+    parser.add_argument(
+        "--executor",
+        choices=EXECUTORS,
+        default="auto",
+        help="what runs jobs in parallel, auto uses threads on free-threaded "
+        "builds and processes otherwise",
+    )
+    parser.add_argument("-o", "--output", help="where results go, stdout by default")
+    parser.add_argument("-f", "--format", choices=sorted(FORMATS), default="jsonl")
+    parser.add_argument("--cache", help="compiled code cache directory, fast engine only")
+    parser.add_argument(
+        "--result-cache",
+        help="directory to keep the results of deterministic jobs in, "
+        "repeated jobs are answered from it without running",
+    )
+    parser.add_argument(
+        "--seed", type=int, help="seed for every job's CXNN random numbers"
+    )
+    parser.add_argument(
+        "--metrics",
+        help="file to write Prometheus metrics to while jobs run and when they finish",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=chip64_metrics.DEFAULT_INTERVAL,
+        help="seconds between writes of the metrics file",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="localhost port to serve Prometheus metrics on while jobs run",
+    )
+    parser.add_argument("--profile", help="directory to write a cProfile file per job to")
+    parser.add_argument(
+        "--snapshot",
+        help="directory to write each job's final state to, "
+        "for chip64_replay.restore()",
+    )
+    return parser
+
+
+def main(argv=None) -> int:
+    """
+    Runs the command line tool, returning the exit status.
+    """
+    parser = build_parser()
+    options = parser.parse_args(argv)
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if options.output is None and options.format != "jsonl":
+        parser.error("--format %s needs --output" % options.format)
+    if options.profile and options.executor == "thread" and options.jobs > 1:
+        # cProfile allows one profiler at a time per process on newer Pythons.
+        parser.error("--profile cannot be used with --executor thread")
+    try:
+        programs = [load_program(path, options.program_format) for path in options.programs]
+    except (OSError, ValueError) as error:
+        parser.error(str(error))
+    if options.inputs is None:
+        inputs = [[]]
+    elif options.inputs == "-":
+        inputs = parse_inputs(sys.stdin)
+    else:
+        with open(options.inputs) as f:
+            inputs = parse_inputs(f)
+    for directory in (options.profile, options.snapshot):
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    jobs = [
+        (number, code, values, options)
+        for number, (code, values) in enumerate(itertools.product(programs, inputs))
+    ]
+    kind = options.executor
+    if kind == "auto" and options.profile:
+        kind = "process"
+    executor = make_executor(kind, options.jobs)
+    if isinstance(executor, (_Inline, concurrent.futures.ThreadPoolExecutor)):
+        if options.engine == "fast" and not options.cache:
+            options.cache = chip64_cache.MemoryCache()
+        if options.result_cache:
+            options.result_cache = chip64_memo.ResultCache(options.result_cache)
+    metrics = chip64_metrics.Metrics()
+    metrics.active_jobs = min(options.jobs, len(jobs))
+    exporter = None
+    if options.metrics:
+        exporter = chip64_metrics.FileExporter(
+            metrics, options.metrics, options.metrics_interval
+        )
+        exporter.start()
+    server = None
+    if options.metrics_port is not None:
+        server = chip64_metrics.serve(metrics, options.metrics_port)
+    sink = FORMATS[options.format](options.output or sys.stdout)
+    failed = 0
+    try:
+        with sink, executor:
+            results = executor.map(run_job, jobs, chunksize=16)
+            for done, (number, result, error, usage) in enumerate(results, 1):
+                metrics.record(
+                    options.engine, result, usage.seconds, usage.executed, usage.inputs
+                )
+                metrics.update_caches(usage.source, usage.caches)
+                metrics.active_jobs = min(options.jobs, len(jobs) - done)
+                if error is None:
+                    sink.write(result)
+                else:
+                    failed += 1
+                    print("job %d: %s" % (number, error), file=sys.stderr)
+    finally:
+        if exporter is not None:
+            exporter.stop()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    return 1 if failed else 0
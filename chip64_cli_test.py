@@ -0,0 +1,174 @@
+import chip64
+import chip64_cli
+import chip64_fast_test
+import chip64_replay
+import chip64_sink
+import concurrent.futures
+import io
+import pickle
+import pytest
+
+
+def write_programs(tmp_path):
+    """
+    Writes the multiply program as a binary and a hex file, returning their
+    paths.
+    """
+    binary = tmp_path / "multiply.c64"
+    binary.write_bytes(bytes(chip64_fast_test.MULTIPLY))
+    text = " ".join("0x%02X" % byte for byte in chip64_fast_test.MULTIPLY)
+    hex_file = tmp_path / "multiply.hex"
+    hex_file.write_text("# multiply\n" + text + "\n")
+    return str(binary), str(hex_file)
+
+
+def test_parse_hex():
+    """
+    Test that hex text is read with or without prefixes, separators and
+    comments.
+    """
+    assert chip64_cli.parse_hex("0x60, 0x2A # comment\n602A\n 60 2a") == [
+        0x60, 0x2A, 0x60, 0x2A, 0x60, 0x2A
+    ]
+    with pytest.raises(ValueError):
+        chip64_cli.parse_hex("6")
+
+
+def test_load_program(tmp_path):
+    """
+    Test that binary and hex files load the same program and oversized
+    programs are refused.
+    """
+    binary, hex_file = write_programs(tmp_path)
+    assert chip64_cli.load_program(binary) == chip64_fast_test.MULTIPLY
+    assert chip64_cli.load_program(hex_file) == chip64_fast_test.MULTIPLY
+    big = tmp_path / "big.c64"
+    big.write_bytes(bytes(4097))
+    with pytest.raises(ValueError):
+        chip64_cli.load_program(str(big))
+
+
+@pytest.mark.parametrize("engine", sorted(chip64_cli.ENGINES))
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_main(tmp_path, monkeypatch, engine, jobs):
+    """
+    Test that every program runs once per input line and the results are
+    written in job order.
+    """
+    binary, hex_file = write_programs(tmp_path)
+    monkeypatch.setattr("sys.stdin", io.StringIO("6 7\n\n# skipped\n3 5\n"))
+    output = str(tmp_path / "results.jsonl")
+    status = chip64_cli.main(
+        [binary, hex_file, "-i", "-", "-e", engine, "-j", str(jobs), "-o", output]
+    )
+    assert status == 0
+    results = chip64_sink.read_json_lines(output)
+    assert [result["outputs"] for result in results] == [["42"], ["15"]] * 2
+    assert {result["halt_reason"] for result in results} == {chip64.HALTED}
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_main_executors(tmp_path, executor):
+    """
+    Test that jobs give the same results run in threads or processes.
+    """
+    binary, _ = write_programs(tmp_path)
+    inputs = tmp_path / "inputs.txt"
+    inputs.write_text("".join("%d 7\n" % n for n in range(8)))
+    output = str(tmp_path / "results.jsonl")
+    argv = [binary, "-i", str(inputs), "-j", "4", "--executor", executor, "-o", output]
+    assert chip64_cli.main(argv) == 0
+    results = chip64_sink.read_json_lines(output)
+    assert [result["outputs"] for result in results] == [[str(7 * n)] for n in range(8)]
+
+
+def test_make_executor():
+    """
+    Test that one job runs inline and that threads and processes run the
+    rest.
+    """
+    assert isinstance(chip64_cli.make_executor("process", 1), chip64_cli._Inline)
+    with chip64_cli.make_executor("thread", 2) as executor:
+        assert isinstance(executor, concurrent.futures.ThreadPoolExecutor)
+    with chip64_cli.make_executor("process", 2) as executor:
+        assert isinstance(executor, concurrent.futures.ProcessPoolExecutor)
+
+
+def test_main_errors_and_snapshots(tmp_path, capsys):
+    """
+    Test that failing jobs are reported without stopping the others and
+    that snapshots and profiles are written.
+    """
+    binary, _ = write_programs(tmp_path)
+    inputs = tmp_path / "inputs.txt"
+    inputs.write_text("6 7\n6\n")
+    snapshots, profiles = tmp_path / "snapshots", tmp_path / "profiles"
+    status = chip64_cli.main(
+        [
+            binary, "-i", str(inputs), "-c", "5", "-f", "binary",
+            "-o", str(tmp_path / "results.bin"),
+            "--snapshot", str(snapshots), "--profile", str(profiles),
+        ]
+    )
+    assert status == 1
+    assert "job 1: EOFError" in capsys.readouterr().err
+    records, _ = chip64_sink.read_binary(str(tmp_path / "results.bin"))
+    assert len(records) == 1
+    assert chip64_sink.HALT_REASONS[records[0]["halt_reason"]] == chip64.CYCLE_LIMIT
+    with open(snapshots / "job-0.snapshot", "rb") as f:
+        point = pickle.load(f)
+    c64 = chip64.Chip64()
+    chip64_replay.restore(c64, point)
+    assert c64.registers[0] == 6 and c64.registers[1] == 7
+    assert (profiles / "job-0.prof").exists()
+
+
+def test_main_usage_errors(tmp_path):
+    """
+    Test that bad arguments exit with a usage error.
+    """
+    binary, _ = write_programs(tmp_path)
+    profile = [binary, "-j", "2", "--executor", "thread", "--profile", str(tmp_path)]
+    for argv in ([binary, "-j", "0"], [binary, "-f", "columns"], [str(tmp_path)], profile):
+        with pytest.raises(SystemExit) as exit_info:
+            chip64_cli.main(argv)
+        assert exit_info.value.code == 2
+
+
+def test_main_result_cache(tmp_path):
+    """
+    Test that repeated jobs are answered from the result cache with the same
+    results.
+    """
+    binary, _ = write_programs(tmp_path)
+    inputs = tmp_path / "inputs.txt"
+    inputs.write_text("6 7\n6 7\n3 5\n")
+    cache = tmp_path / "results"
+    outputs = []
+    for name in ["first.jsonl", "second.jsonl"]:
+        output = str(tmp_path / name)
+        argv = [binary, "-i", str(inputs), "--result-cache", str(cache), "--seed", "1", "-o", output]
+        assert chip64_cli.main(argv) == 0
+        outputs.append(chip64_sink.read_json_lines(output))
+    assert outputs[0] == outputs[1]
+    assert [result["outputs"] for result in outputs[0]] == [["42"], ["42"], ["15"]]
+    assert len(list(cache.iterdir())) >= 2
+
+
+def test_main_metrics(tmp_path):
+    """
+    Test that the metrics file totals the jobs once they have all run.
+    """
+    binary, _ = write_programs(tmp_path)
+    inputs = tmp_path / "inputs.txt"
+    inputs.write_text("6 7\n3 5\n")
+    metrics = tmp_path / "chip64.prom"
+    output = str(tmp_path / "results.jsonl")
+    argv = [binary, "-i", str(inputs), "--metrics", str(metrics), "-o", output]
+    assert chip64_cli.main(argv) == 0
+    text = metrics.read_text()
+    assert 'chip64_cycles_total{engine="fast"} 786' in text
+    assert 'chip64_runs_total{engine="fast",halt_reason="halted"} 2' in text
+    assert 'chip64_io_operations_total{direction="output"} 2' in text
+    assert 'chip64_cache_misses_total{cache="compile"} 1' in text
+    assert 'chip64_machines{state="active"} 0' in text
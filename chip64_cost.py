@@ -0,0 +1,286 @@
+"""
+Static cycle cost estimates and a performance lint for Chip64 programs.
+estimate() splits an analysed program into basic blocks and subroutines and
+works out the worst case number of cycles each subroutine, and the program
+as a whole, can take. Counted loops found by chip64_loops whose trip count is
+known cost that many iterations, any other loop makes the worst case
+unbounded. lint() reports code shapes that are known to run slowly.
+"""
+
+import collections
+import chip64_cfg
+import chip64_decode as c64d
+import chip64_loops
+
+# trips and total are None when the loop's trip count cannot be worked out.
+LoopCost = collections.namedtuple(
+    "LoopCost", ["header", "iteration_cycles", "trips", "total"]
+)
+# blocks maps the start of every basic block to its length in cycles, loops
+# maps loop headers to LoopCosts and subroutines maps the address of every
+# called subroutine to its worst case cycles, including the RET. total is
+# the worst case for the whole program. Worst cases are None if unbounded.
+Estimate = collections.namedtuple(
+    "Estimate", ["total", "blocks", "loops", "subroutines"]
+)
+
+
+def _cycles(instruction: c64d.Instruction) -> int:
+    return 0 if instruction.mnemonic == "HALT" else 1
+
+
+def _local_successors(analysis: chip64_cfg.Analysis, address: int) -> set:
+    """
+    Returns the addresses that can follow address within its subroutine, a
+    CALL being followed by the instruction after it.
+    """
+    instruction = analysis.instructions[address]
+    m = instruction.mnemonic
+    if m in ("HALT", "RET"):
+        return set()
+    if m == "CALL":
+        targets = {address + 2}
+    else:
+        targets = analysis.successors.get(address, set())
+    return {target for target in targets if target in analysis.instructions}
+
+
+def basic_blocks(analysis: chip64_cfg.Analysis) -> dict:
+    """
+    Returns the basic blocks of an analysed program, a dictionary mapping the
+    address each starts at to its instructions.
+    """
+    leaders = {analysis.entry}
+    for address, instruction in analysis.instructions.items():
+        m = instruction.mnemonic
+        if m in c64d.JUMPS or m in c64d.SKIPS:
+            leaders |= analysis.successors.get(address, set())
+            leaders.add(address + 2)
+            if m == "CALL":
+                leaders.add(instruction.nnn)
+    blocks = {}
+    for leader in sorted(leaders & analysis.instructions.keys()):
+        block, address = [], leader
+        while address in analysis.instructions:
+            instruction = analysis.instructions[address]
+            block.append(instruction)
+            m = instruction.mnemonic
+            if m in c64d.JUMPS or m in c64d.SKIPS or address + 2 in leaders:
+                break
+            address += 2
+        blocks[leader] = block
+    return blocks
+
+
+def _components(nodes: list, successors) -> list:
+    """
+    Returns the strongly connected components of the graph over nodes,
+    successors of each component first (Tarjan's algorithm, iteratively).
+    """
+    index, low, on_stack, stack, components = {}, {}, set(), [], []
+    for root in nodes:
+        if root in index:
+            continue
+        work = [(root, iter(successors(root)))]
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, children = work[-1]
+            child = next(children, None)
+            if child is not None:
+                if child not in index:
+                    index[child] = low[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(successors(child))))
+                elif child in on_stack:
+                    low[node] = min(low[node], index[child])
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+            if low[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+    return components
+
+
+class _Estimator:
+    """
+    Works out the worst case cycles of subroutines, one at a time.
+    """
+
+    def __init__(self, analysis: chip64_cfg.Analysis):
+        self.analysis = analysis
+        self.counted = chip64_loops.find_loops(analysis)
+        self.loops = {}
+        self.subroutines = {}
+        for header, loop in self.counted.items():
+            trips = loop.trip_count
+            total = None if trips is None else trips * loop.max_cycles + 1
+            self.loops[header] = LoopCost(header, loop.max_cycles, trips, total)
+
+    def _successors(self, address: int) -> set:
+        loop = self.counted.get(address)
+        if loop is not None and self.loops[address].total is not None:
+            return {loop.exit} & self.analysis.instructions.keys()
+        return _local_successors(self.analysis, address)
+
+    def _weight(self, address: int):
+        loop = self.loops.get(address)
+        if loop is not None and loop.total is not None:
+            return loop.total
+        instruction = self.analysis.instructions[address]
+        if instruction.mnemonic == "CALL":
+            callee = self.subroutine(instruction.nnn)
+            return None if callee is None else 1 + callee
+        return _cycles(instruction)
+
+    def subroutine(self, entry: int):
+        """
+        Returns the worst case cycles from entry to the HALT or RET that ends
+        it, or None if there is no bound.
+        """
+        if entry in self.subroutines:
+            return self.subroutines[entry]
+        self.subroutines[entry] = None  # recursion has no bound
+        order, worklist, seen = [], [entry], {entry}
+        while worklist:
+            address = worklist.pop()
+            order.append(address)
+            for target in self._successors(address):
+                if target not in seen:
+                    seen.add(target)
+                    worklist.append(target)
+        cost = {}
+        for component in _components(order, self._successors):
+            looping = len(component) > 1 or component[0] in self._successors(
+                component[0]
+            )
+            if looping and min(component) not in self.loops:
+                self.loops[min(component)] = LoopCost(
+                    min(component), len(component), None, None
+                )
+            for address in component:
+                weight = None if looping else self._weight(address)
+                following = [
+                    cost[t] for t in self._successors(address) if t in cost
+                ]
+                if weight is None or None in following:
+                    cost[address] = None
+                else:
+                    cost[address] = weight + max(following, default=0)
+        self.subroutines[entry] = cost[entry]
+        return cost[entry]
+
+
+def estimate(analysis: chip64_cfg.Analysis) -> Estimate:
+    """
+    Returns the static cycle cost estimate of an analysed program.
+    """
+    estimator = _Estimator(analysis)
+    total = estimator.subroutine(analysis.entry)
+    blocks = {
+        start: sum(_cycles(i) for i in block)
+        for start, block in basic_blocks(analysis).items()
+    }
+    subroutines = {
+        address: cost
+        for address, cost in estimator.subroutines.items()
+        if address != analysis.entry
+    }
+    return Estimate(total, blocks, estimator.loops, subroutines)
+
+
+def _cycles_text(cycles) -> str:
+    return "unbounded" if cycles is None else "%d cycles" % cycles
+
+
+def lint(analysis: chip64_cfg.Analysis) -> list:
+    """
+    Returns the sorted (address, message) pairs for slow code found in an
+    analysis: multiplication and division written as loops, memory copied
+    one register at a time, skips whose outcome is always the same and jumps
+    to jumps.
+    """
+    found = []
+    instructions = analysis.instructions
+    for header, loop in chip64_loops.find_loops(analysis).items():
+        if loop.kind == "multiply":
+            found.append(
+                (header, "multiply written as a loop of %d cycles per bit"
+                 % loop.max_cycles)
+            )
+    loops = [
+        component
+        for component in _components(
+            sorted(instructions), lambda a: _local_successors(analysis, a)
+        )
+        if len(component) > 1
+    ]
+    for component in loops:
+        body = [instructions[address] for address in component]
+        mnemonics = {i.mnemonic for i in body}
+        header = min(component)
+        if (
+            mnemonics & {"SUB", "RSUB"}
+            and any(i.mnemonic == "ADCR" and i.nn == 1 for i in body)
+            and any(i.mnemonic in c64d.SKIPS and i.x == 15 for i in body)
+        ):
+            found.append(
+                (header, "divide written as repeated subtraction, its cycles "
+                 "grow with the quotient, shift and subtract instead")
+            )
+        if any(i.mnemonic == "LOAD" and i.x == 0 for i in body) and any(
+            i.mnemonic == "SPILL" and i.x == 0 for i in body
+        ):
+            found.append(
+                (header, "memory copied one register at a time, "
+                 "move several registers per LOAD and SPILL")
+            )
+    for address, instruction in instructions.items():
+        m = instruction.mnemonic
+        if m in c64d.SKIPS and address in analysis.states:
+            taken = chip64_cfg.skip_taken(instruction, analysis.states[address])
+            if taken is not None:
+                found.append(
+                    (address, "%s is always %s"
+                     % (m, "taken" if taken else "not taken"))
+                )
+        elif m in ("GOTO", "CALL"):
+            target = instructions.get(instruction.nnn)
+            if target is not None and target.mnemonic == "GOTO":
+                found.append(
+                    (address, "%s to a GOTO, jump straight to $%03X"
+                     % (m, target.nnn))
+                )
+    return sorted(set(found))
+
+
+def report(memory, entry: int = 0, state: tuple = None) -> str:
+    """
+    Returns a text report of the cost estimate and lint of the program in
+    memory. state is the abstract state at entry, see chip64_cfg.analyse().
+    """
+    analysis = chip64_cfg.analyse(memory, entry, state)
+    cost = estimate(analysis)
+    lines = ["worst case: %s" % _cycles_text(cost.total)]
+    for header, loop in sorted(cost.loops.items()):
+        trips = "unknown trips" if loop.trips is None else "%d trips" % loop.trips
+        lines.append(
+            "loop $%03X: %d cycles per iteration, %s, %s"
+            % (header, loop.iteration_cycles, trips, _cycles_text(loop.total))
+        )
+    for address, cycles in sorted(cost.subroutines.items()):
+        lines.append("subroutine $%03X: %s" % (address, _cycles_text(cycles)))
+    for address, message in lint(analysis):
+        lines.append("$%03X: %s" % (address, message))
+    return "\n".join(lines)
@@ -0,0 +1,101 @@
+import chip64
+import chip64_cfg
+import chip64_cost
+import chip64_fast_test
+import chip64_test
+import chip64_util as c64u
+import unittest.mock
+
+# Calls a subroutine that adds 2 to r0 twice, then halts.
+CALLS = [
+    0x20, 0x06, 0x20, 0x06, 0x00, 0x00, 0x70, 0x02,
+    0x01, 0xEE,
+]
+# Divides the first input by the second by repeated subtraction.
+DIVIDE = [
+    0xF0, 0x01, 0xF1, 0x01, 0x62, 0x00, 0x80, 0x15,
+    0x3F, 0x00, 0x10, 0x10, 0x72, 0x01, 0x10, 0x06,
+    0xD2, 0x01, 0x00, 0x00,
+]
+# Copies eight bytes from $100 to $200 one register at a time.
+COPY = [
+    0xA1, 0x00, 0x63, 0xFF, 0x64, 0x00, 0xE0, 0x65,
+    0xE3, 0x1E, 0xE0, 0x55, 0xE4, 0x1E, 0x72, 0x01,
+    0x32, 0x08, 0x10, 0x06, 0x00, 0x00,
+]
+# Tests a register whose value is known and jumps by way of a GOTO.
+SLOW_JUMPS = [
+    0x60, 0x05, 0x30, 0x05, 0x00, 0x00, 0x10, 0x0A,
+    0x00, 0x00, 0x10, 0x08,
+]
+
+
+def analyse(code):
+    """
+    Returns the analysis of code loaded into otherwise empty memory.
+    """
+    memory = bytes(code) + bytes(chip64_cfg.MEMORY_SIZE - len(code))
+    return chip64_cfg.analyse(memory)
+
+
+def test_estimate_counted_loop():
+    """
+    Test that a counted loop with a known trip count gives a worst case
+    that a run with every multiplier bit set reaches.
+    """
+    cost = chip64_cost.estimate(analyse(chip64_fast_test.MULTIPLY))
+    assert cost.loops == {0x08: chip64_cost.LoopCost(0x08, 7, 64, 449)}
+    assert cost.blocks == {0x00: 4, 0x08: 1, 0x0A: 1, 0x0C: 2, 0x10: 1, 0x12: 3, 0x18: 1}
+    assert cost.total == 455
+    c64u.console_input = unittest.mock.MagicMock(side_effect=["18446744073709551615"] * 2)
+    c64u.console_output = unittest.mock.MagicMock()
+    c64 = chip64.Chip64(chip64_fast_test.MULTIPLY)
+    c64.execute()
+    assert c64.cycles == cost.total
+
+
+def test_estimate_subroutines_and_unbounded_loops():
+    """
+    Test that subroutine costs are added at each call and that loops with no
+    known trip count make the worst case unbounded.
+    """
+    cost = chip64_cost.estimate(analyse(CALLS))
+    assert cost.subroutines == {0x06: 2}
+    assert cost.total == 6
+    c64 = chip64.Chip64(CALLS)
+    c64.execute()
+    assert c64.cycles == cost.total
+    cost = chip64_cost.estimate(analyse(chip64_test.REPEATING))
+    assert cost.total is None
+    assert cost.loops[0x02].trips is None
+
+
+def test_lint():
+    """
+    Test that slow code shapes are reported at the address they start.
+    """
+    assert chip64_cost.lint(analyse(chip64_fast_test.MULTIPLY)) == [
+        (0x08, "multiply written as a loop of 7 cycles per bit")
+    ]
+    ((address, message),) = chip64_cost.lint(analyse(DIVIDE))
+    assert address == 0x06 and message.startswith("divide")
+    ((address, message),) = chip64_cost.lint(analyse(COPY))
+    assert address == 0x06 and message.startswith("memory copied")
+    assert chip64_cost.lint(analyse(SLOW_JUMPS)) == [
+        (0x02, "SNEC is always taken"),
+        (0x06, "GOTO to a GOTO, jump straight to $008"),
+    ]
+
+
+def test_report():
+    """
+    Test that the report lists the worst case, loops and lint.
+    """
+    memory = bytes(CALLS) + bytes(chip64_cfg.MEMORY_SIZE - len(CALLS))
+    assert chip64_cost.report(memory).splitlines() == [
+        "worst case: 6 cycles", "subroutine $006: 2 cycles"
+    ]
+    assert chip64_cost.report(analyse(DIVIDE).memory).splitlines()[:2] == [
+        "worst case: unbounded",
+        "loop $006: 4 cycles per iteration, unknown trips, unbounded",
+    ]
@@ -0,0 +1,157 @@
+"""
+Decoding and disassembly of Chip64 opcodes.
+The decoder mirrors the dispatch in Chip64.execute() exactly, so opcodes that
+the emulator silently ignores decode with a mnemonic of None.
+"""
+
+import collections
+import functools
+
+# A decoded instruction, address is where it was fetched from and the operand
+# fields are always filled in whether the opcode uses them or not.
+Instruction = collections.namedtuple(
+    "Instruction", ["address", "opcode", "mnemonic", "x", "y", "nn", "nnn"]
+)
+
+_ALU = {
+    0x0: "AR",
+    0x1: "OR",
+    0x2: "AND",
+    0x3: "XOR",
+    0x4: "ADD",
+    0x5: "SUB",
+    0x6: "SHR",
+    0x7: "RSUB",
+    0x8: "ADC",
+    0x9: "SBB",
+    0xE: "SHL",
+}
+_DISPLAY = {0x0: "DRH", 0x1: "DRD", 0x2: "DRB", 0x3: "DRO"}
+_INPUT = {0x0: "IRH", 0x1: "IRD", 0x2: "IRB", 0x3: "IRO"}
+_MEMORY = {0x1E: "MPAR", 0x55: "SPILL", 0x65: "LOAD", 0xA4: "ADDM", 0xA5: "SUBM"}
+_SIMPLE = {
+    0x1: "GOTO",
+    0x2: "CALL",
+    0x3: "SNEC",
+    0x4: "SNUEC",
+    0x5: "SNE",
+    0x6: "ACR",
+    0x7: "ADCR",
+    0x9: "SNUE",
+    0xA: "SMP",
+    0xB: "CPAC",
+    0xC: "BAR",
+}
+
+# Mnemonics grouped by how they affect control flow.
+SKIPS = frozenset(["SNEC", "SNUEC", "SNE", "SNUE"])
+JUMPS = frozenset(["GOTO", "CALL", "RET", "CPAC", "HALT"])
+INPUTS = frozenset(_INPUT.values())
+OUTPUTS = frozenset(_DISPLAY.values())
+# Mnemonics whose effect does not follow from the machine state alone.
+NONDETERMINISTIC = INPUTS | {"BAR", "HOST"}
+
+# The numeric base used by each I/O mnemonic.
+BASES = {
+    "IRH": 16, "IRD": 10, "IRB": 2, "IRO": 8,
+    "DRH": 16, "DRD": 10, "DRB": 2, "DRO": 8,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def mnemonic(opcode: int):
+    """
+    Returns the mnemonic for a 16 bit opcode or None if the emulator ignores
+    the opcode.
+    """
+    p = opcode >> 12
+    if opcode == 0x0000:
+        return "HALT"
+    if opcode == 0x01EE:
+        return "RET"
+    if p == 0x0:
+        return "HOST"
+    if p == 0x8:
+        return _ALU.get(opcode & 0xF)
+    if p == 0xD:
+        return _DISPLAY.get(opcode & 0xF)
+    if p == 0xE:
+        return _MEMORY.get(opcode & 0xFF)
+    if p == 0xF:
+        return _INPUT.get(opcode & 0xF)
+    return _SIMPLE.get(p)
+
+
+def decode(opcode: int, address: int = 0) -> Instruction:
+    """
+    Decodes a 16 bit opcode fetched from address into an Instruction.
+    """
+    opcode = int(opcode)
+    return Instruction(
+        address,
+        opcode,
+        mnemonic(opcode),
+        (opcode >> 8) & 0xF,
+        (opcode >> 4) & 0xF,
+        opcode & 0xFF,
+        opcode & 0xFFF,
+    )
+
+
+def fetch(memory, address: int) -> int:
+    """
+    Reads the big endian opcode stored at address.
+    memory may be a Chip64 memory list or any bytes like object.
+    """
+    return (int(memory[address]) << 8) | int(memory[address + 1])
+
+
+def decode_at(memory, address: int) -> Instruction:
+    """
+    Fetches and decodes the instruction at address.
+    """
+    return decode(fetch(memory, address), address)
+
+
+def decode_program(memory, start: int = 0, end: int = None) -> list:
+    """
+    Decodes every even address in [start, end) into a list of Instructions.
+    end defaults to the end of memory.
+    """
+    if end is None:
+        end = len(memory) - 1
+    return [decode_at(memory, address) for address in range(start, end, 2)]
+
+
+def disassemble(instruction: Instruction) -> str:
+    """
+    Returns the assembly text for a single instruction, undefined opcodes are
+    shown as a data word.
+    """
+    m, x, y = instruction.mnemonic, instruction.x, instruction.y
+    if m is None:
+        return "DW 0x%04X" % instruction.opcode
+    if m in ("HALT", "RET"):
+        return m
+    if m == "HOST":
+        return "HOST 0x%03X" % instruction.nnn
+    if m in ("GOTO", "CALL", "SMP", "CPAC"):
+        return "%s $%03X" % (m, instruction.nnn)
+    if m in ("SNEC", "SNUEC", "ACR", "ADCR", "BAR"):
+        return "%s r%X, 0x%02X" % (m, x, instruction.nn)
+    if m in ("SHR", "SHL"):
+        return "%s r%X, %d" % (m, x, y)
+    if m in _ALU.values() or m in ("SNE", "SNUE"):
+        return "%s r%X, r%X" % (m, x, y)
+    return "%s r%X" % (m, x)
+
+
+def listing(memory, start: int = 0, end: int = None) -> str:
+    """
+    Returns a disassembly listing of the even addresses in [start, end), one
+    instruction per line.
+    """
+    return "\n".join(
+        "$%03X  %04X  %s" % (i.address, i.opcode, disassemble(i))
+        for i in decode_program(memory, start, end)
+    )
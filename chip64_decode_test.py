@@ -0,0 +1,62 @@
+import chip64_decode as c64d
+
+
+def test_decode():
+    """
+    Test the decode() function, ensure that the operand fields are split out.
+    """
+    instruction = c64d.decode(0x8AB4, 0x10)
+    assert instruction.address == 0x10
+    assert instruction.mnemonic == "ADD"
+    assert instruction.x == 0xA
+    assert instruction.y == 0xB
+    assert instruction.nn == 0xB4
+    assert instruction.nnn == 0xAB4
+
+
+def test_mnemonic():
+    """
+    Test the mnemonic() function, ensure that it follows the dispatch in
+    Chip64.execute() including the opcodes it ignores.
+    """
+    assert c64d.mnemonic(0x0000) == "HALT"
+    assert c64d.mnemonic(0x01EE) == "RET"
+    assert c64d.mnemonic(0x0123) == "HOST"
+    assert c64d.mnemonic(0x5121) == "SNE"
+    assert c64d.mnemonic(0x8127) == "RSUB"
+    assert c64d.mnemonic(0x812A) is None
+    assert c64d.mnemonic(0x8128) == "ADC"
+    assert c64d.mnemonic(0xE5A5) == "SUBM"
+    assert c64d.mnemonic(0xD013) == "DRO"
+    assert c64d.mnemonic(0xD014) is None
+    assert c64d.mnemonic(0xE355) == "SPILL"
+    assert c64d.mnemonic(0xE356) is None
+    assert c64d.mnemonic(0xF202) == "IRB"
+
+
+def test_fetch():
+    """
+    Test the fetch() function, ensure that opcodes are read big endian.
+    """
+    assert c64d.fetch([0x12, 0x34, 0x56, 0x78], 2) == 0x5678
+
+
+def test_disassemble():
+    """
+    Test the disassemble() function.
+    """
+    assert c64d.disassemble(c64d.decode(0x1018)) == "GOTO $018"
+    assert c64d.disassemble(c64d.decode(0x4340)) == "SNUEC r3, 0x40"
+    assert c64d.disassemble(c64d.decode(0x811E)) == "SHL r1, 1"
+    assert c64d.disassemble(c64d.decode(0x8214)) == "ADD r2, r1"
+    assert c64d.disassemble(c64d.decode(0xD201)) == "DRD r2"
+    assert c64d.disassemble(c64d.decode(0x01EE)) == "RET"
+    assert c64d.disassemble(c64d.decode(0x0123)) == "HOST 0x123"
+    assert c64d.disassemble(c64d.decode(0x812A)) == "DW 0x812A"
+
+
+def test_listing():
+    """
+    Test the listing() function.
+    """
+    assert c64d.listing([0x60, 0x2A, 0x00, 0x00]) == "$000  602A  ACR r0, 0x2A\n$002  0000  HALT"
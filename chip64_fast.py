@@ -0,0 +1,564 @@
+"""
+A faster Chip64 engine for verified programs.
+Straight line runs of instructions are compiled into Python functions that
+work on plain integers, and the machine state is only converted to and from
+numpy types at the edges of execute().
+"""
+
+import struct
+import time
+import numpy as np
+import chip64
+import chip64_decode as c64d
+import chip64_verify
+import chip64_loops
+
+MASK = 0xFFFFFFFFFFFFFFFF
+# Longest block compiled, so cycle limited runs rarely have to single step.
+MAX_BLOCK_LENGTH = 32
+# The cycle limit used when execute() is asked to run until it halts.
+UNLIMITED = chip64.UNLIMITED
+
+# Big endian packers for registers 0 to X, indexed by X.
+_REGISTER_STRUCTS = [struct.Struct(">%dQ" % (i + 1)) for i in range(16)]
+# One numpy byte per value, used to write memory back without allocation.
+_BYTES = [np.uint8(i) for i in range(256)]
+
+_INPUT = 'int(np.uint64(int(c.read_input(">")%s)))'
+
+# Python statements for each mnemonic that does not end a block. c is the
+# machine, r holds the registers, m the memory, s the call stack, v[0] the memory pointer, v[1] the
+# cycles run so far and v[2] the cycle limit, or the end of the current
+# deadline slice.
+_STATEMENTS = {
+    "ACR": ["r[{x}] = {nn}"],
+    "ADCR": ["r[{x}] = (r[{x}] + {nn}) & MASK"],
+    "AR": ["r[{x}] = r[{y}]"],
+    "OR": ["r[{x}] |= r[{y}]"],
+    "AND": ["r[{x}] &= r[{y}]"],
+    "XOR": ["r[{x}] ^= r[{y}]"],
+    "ADD": ["t = r[{x}] + r[{y}]", "r[15] = t >> 64", "r[{x}] = t & MASK"],
+    "SUB": ["r[15] = 1 if r[{x}] >= r[{y}] else 0", "r[{x}] = (r[{x}] - r[{y}]) & MASK"],
+    "RSUB": ["r[15] = 1 if r[{y}] >= r[{x}] else 0", "r[{y}] = (r[{y}] - r[{x}]) & MASK"],
+    "SMP": ["v[0] = {nnn}"],
+    "MPAR": ["v[0] = (v[0] + r[{x}]) & MASK"],
+    "BAR": ["r[{x}] = c.random_byte() & {nn}"],
+    "DRH": ["c.write_output(r[{x}], 16)"],
+    "DRD": ["c.write_output(r[{x}], 10)"],
+    "DRB": ["c.write_output(r[{x}], 2)"],
+    "DRO": ["c.write_output(r[{x}], 8)"],
+    "SPILL": ["Q[{x}].pack_into(m, v[0], *r[:{x} + 1])"],
+    "LOAD": ["r[:{x} + 1] = Q[{x}].unpack_from(m, v[0])"],
+    "ADC": [
+        "t = r[{x}] + r[{y}] + (r[15] & 1)",
+        "r[15] = t >> 64",
+        "r[{x}] = t & MASK",
+    ],
+    "SBB": [
+        "t = r[{x}] - r[{y}] - (1 - (r[15] & 1))",
+        "r[15] = 1 if t >= 0 else 0",
+        "r[{x}] = t & MASK",
+    ],
+    "ADDM": ["r[15] = B(m, v[0], r[{x}], False)"],
+    "SUBM": ["r[15] = B(m, v[0], r[{x}], True)"],
+    "IRH": ["r[{x}] = " + _INPUT % ", 16"],
+    "IRD": ["r[{x}] = " + _INPUT % ""],
+    "IRB": ["r[{x}] = " + _INPUT % ", 2"],
+    "IRO": ["r[{x}] = " + _INPUT % ", 8"],
+    "HOST": ["H(c, {nnn}, r, m)"],
+    None: [],
+}
+
+# Mnemonics that start a new block, and those left out of checked blocks.
+_STOPS = c64d.INPUTS
+_CHECKED_STOPS = c64d.INPUTS | {"SPILL", "LOAD", "ADDM", "SUBM", "HOST"}
+
+_CONDITIONS = {
+    "SNEC": "r[{x}] == {nn}",
+    "SNUEC": "r[{x}] != {nn}",
+    "SNE": "r[{x}] == r[{y}]",
+    "SNUE": "r[{x}] != r[{y}]",
+}
+
+def _host_call(c, number, r, m):
+    """
+    Calls host function number on the registers r and the memory m.
+    """
+    function = c.host_functions.get(number)
+    if function is not None:
+        function(r, np.frombuffer(m, np.uint8))
+        r[:] = [int(value) & MASK for value in r]
+
+
+def _bulk(m, ptr, limbs, subtract):
+    """
+    Adds or subtracts the two numbers of limbs 64 bit limbs at ptr in m,
+    returning the new flag register.
+    """
+    size = 8 * limbs
+    a = int.from_bytes(m[ptr : ptr + size], "big")
+    b = int.from_bytes(m[ptr + size : ptr + 2 * size], "big")
+    if subtract:
+        m[ptr : ptr + size] = ((a - b) % (1 << 8 * size)).to_bytes(size, "big")
+        return 1 if a >= b else 0
+    total = (a + b).to_bytes(size + 1, "big")
+    m[ptr : ptr + size] = total[1:]
+    return total[0]
+
+
+class _Halt(Exception):
+    """
+    Raised by the unit standing in for a HALT opcode.
+    """
+
+
+def _halt(c, r, m, s, v):
+    raise _Halt
+
+
+class _Spin(Exception):
+    """
+    Raised by the unit standing in for a GOTO to itself, and with its
+    address by a BNNN that jumps to itself.
+    """
+
+
+def _spin(c, r, m, s, v):
+    v[1] += 1
+    raise _Spin
+
+
+_GLOBALS = {
+    "B": _bulk,
+    "H": _host_call,
+    "MASK": MASK,
+    "Q": _REGISTER_STRUCTS,
+    "Spin": _Spin,
+    "np": np,
+}
+
+
+def self_jump(memory, address: int) -> bool:
+    """
+    Returns True if the instruction at address is a GOTO to itself.
+    """
+    instruction = c64d.decode_at(memory, address)
+    return instruction.mnemonic == "GOTO" and instruction.nnn == address
+
+
+def block_nondeterministic(memory, address: int, length: int) -> bool:
+    """
+    Returns True if any of the length instructions from address takes input,
+    a random byte or calls a host function.
+    """
+    return any(
+        c64d.decode_at(memory, a).mnemonic in c64d.NONDETERMINISTIC
+        for a in range(address, address + 2 * length, 2)
+    )
+
+
+def statements(instruction: c64d.Instruction) -> list:
+    """
+    Returns the Python statements that carry out a non control flow
+    instruction.
+    """
+    m, i = instruction.mnemonic, instruction
+    if m in ("SHR", "SHL"):
+        if i.y == 0:
+            return ["r[15] = 0"]
+        if m == "SHR":
+            return ["r[15] = (r[%d] >> %d) & 1" % (i.x, i.y - 1), "r[%d] >>= %d" % (i.x, i.y)]
+        return [
+            "r[15] = (r[%d] >> %d) & 1" % (i.x, 64 - i.y),
+            "r[%d] = (r[%d] << %d) & MASK" % (i.x, i.x, i.y),
+        ]
+    return [line.format(**i._asdict()) for line in _STATEMENTS[m]]
+
+
+def condition(instruction: c64d.Instruction) -> str:
+    """
+    Returns the Python expression that is true when a skip is taken.
+    """
+    return _CONDITIONS[instruction.mnemonic].format(**instruction._asdict())
+
+
+def table_dispatch(instruction: c64d.Instruction, length: int, table: tuple,
+                   fallback: str, resolve: bool = True) -> list:
+    """
+    Returns the statements that end a block of length instructions with a
+    BNNN into a jump table, see chip64_cfg.jump_table(). r0 is checked
+    against the table once and, if resolve is True, the entry's GOTO is run
+    in the same block, jumping straight to its target. Other values of r0
+    return the value of fallback, an expression of the target t.
+    """
+    lines = [
+        "t = r[0]",
+        "if t >= %d or t & 1:" % (2 * len(table)),
+        "    v[1] += %d" % length,
+        "    t = (t + %d) & MASK" % instruction.nnn,
+    ]
+    lines += ["    " + line for line in _spin_check(instruction)]
+    lines += ["    return %s" % fallback]
+    if not resolve:
+        return lines + ["v[1] += %d" % length, "return t + %d" % instruction.nnn]
+    return lines + ["v[1] += %d" % (length + 1), "return %r[t >> 1]" % (table,)]
+
+
+def _spin_check(instruction: c64d.Instruction) -> list:
+    """
+    Returns the statements that stop a BNNN whose target t is itself, as
+    Chip64.execute() stops at a jump to itself.
+    """
+    return ["if t == %d:" % instruction.address, "    raise Spin(%d)" % instruction.address]
+
+
+def exit_statements(instruction: c64d.Instruction, length: int) -> list:
+    """
+    Returns the statements that end a block of length instructions whose last
+    instruction is instruction.
+    """
+    m, i = instruction.mnemonic, instruction
+    lines = ["v[1] += %d" % length]
+    if m == "GOTO":
+        lines.append("return %d" % i.nnn)
+    elif m == "CALL":
+        lines += ["s.append(%d)" % i.address, "return %d" % i.nnn]
+    elif m == "RET":
+        lines.append("return s.pop() + 2")
+    elif m == "CPAC":
+        lines.append("t = (r[0] + %d) & MASK" % i.nnn)
+        lines += _spin_check(i) + ["return t"]
+    elif m in c64d.SKIPS:
+        lines.append(
+            "return %d if %s else %d"
+            % (i.address + 4, condition(i), i.address + 2)
+        )
+    else:
+        lines.append("return %d" % (i.address + 2))
+    return lines
+
+
+def block_source(
+    memory,
+    address: int,
+    max_length: int = MAX_BLOCK_LENGTH,
+    leaders=frozenset(),
+    checked: bool = False,
+    tables=None,
+):
+    """
+    Returns (source, length) for the block starting at address, or None if
+    the instruction at address is HALT. length counts the cycles the block
+    runs for.
+    A block runs until a control flow instruction, a HALT, max_length
+    instructions or an address in leaders. Input instructions get a block of
+    their own so that a bad input leaves code_ptr on the instruction that
+    read it.
+    If checked is True the program need not be verified. Blocks then stop
+    before any instruction that can fault or write memory and before the end
+    of memory, returning None if that is the first instruction, and a RET
+    with an empty call stack leaves the block, or faults if it comes first.
+    tables maps the addresses of BNNNs to the jump tables they dispatch
+    into, as chip64_cfg.Analysis.jump_tables does. Targets outside a table
+    are checked by the machine's computed_jump() in verified programs and
+    left to the caller in checked ones.
+    """
+    body, address0, length = [], address, 0
+    stop = _CHECKED_STOPS if checked else _STOPS
+    while True:
+        if checked and address + 1 >= len(memory):
+            if not length:
+                return None
+            exit_lines = ["v[1] += %d" % length, "return %d" % address]
+            break
+        instruction = c64d.decode_at(memory, address)
+        m = instruction.mnemonic
+        # A jump to itself gets a unit of its own, see self_jump().
+        if m == "HALT" or (checked and m in stop) or (
+            length and (m in stop or address in leaders or (
+                m == "GOTO" and instruction.nnn == address
+            ))
+        ):
+            if not length:
+                return None
+            exit_lines = ["v[1] += %d" % length, "return %d" % address]
+            break
+        length += 1
+        table = None if tables is None or m != "CPAC" else tables.get(address)
+        if table:
+            fallback = "t" if checked else "c.computed_jump(%d, t)" % address
+            resolve = length < max_length
+            exit_lines = table_dispatch(instruction, length, table, fallback, resolve)
+            length += resolve
+            break
+        if m in c64d.JUMPS or m in c64d.SKIPS:
+            exit_lines = exit_statements(instruction, length)
+            if checked and m == "RET":
+                exit_lines = ["t = s.pop() + 2", "v[1] += %d" % length, "return t"]
+                if length > 1:
+                    exit_lines[:0] = [
+                        "if not s:",
+                        "    v[1] += %d" % (length - 1),
+                        "    return %d" % address,
+                    ]
+            break
+        body += statements(instruction)
+        if m in c64d.INPUTS or length == max_length:
+            exit_lines = exit_statements(instruction, length)
+            break
+        address += 2
+    lines = ["def block_%03X(c, r, m, s, v):" % address0]
+    lines += ["    " + line for line in body + exit_lines]
+    return "\n".join(lines) + "\n", length
+
+
+def compile_unit(source: str, address: int, kind: str = "block", codes=None):
+    """
+    Compiles the source of a block, or another kind of generated function,
+    into a function.
+    codes is an optional dictionary of code objects keyed by source, which is
+    used instead of compiling when it holds source and updated otherwise.
+    """
+    namespace = {}
+    name = "%s_%03X" % (kind, address)
+    code = None if codes is None else codes.get(source)
+    if code is None:
+        code = compile(source, "<chip64 %s>" % name, "exec")
+        if codes is not None:
+            codes[source] = code
+    exec(code, _GLOBALS, namespace)
+    return namespace[name]
+
+
+def compile_block(
+    memory,
+    address: int,
+    max_length: int = MAX_BLOCK_LENGTH,
+    leaders=frozenset(),
+    codes=None,
+    tables=None,
+):
+    """
+    Returns the (function, length) unit for the block at address.
+    """
+    built = block_source(memory, address, max_length, leaders, tables=tables)
+    if built is None:
+        return _halt, 0
+    return compile_unit(built[0], address, codes=codes), built[1]
+
+
+class FastChip64(chip64.Chip64):
+    """
+    A Chip64 that runs verified programs from compiled blocks.
+    The program in memory is verified with chip64_verify the first time it is
+    executed, raising VerificationError if it fails. Because a verified
+    program cannot fault, the compiled code has no bounds or validity checks.
+    Memory holding code must not be modified from outside the machine once it
+    has been executed.
+    Counted loops found by chip64_loops are run a whole batch of iterations
+    at a time unless summarise_loops is False.
+    cache is an optional chip64_cache.DiskCache, used to share the analysis
+    and compiled code of programs between processes.
+    """
+
+    def __init__(self, code=[], summarise_loops=True, cache=None, detect_loops=False):
+        """
+        The default constructor for the class.
+        """
+        super().__init__(code, detect_loops)
+        self.summarise_loops = summarise_loops
+        self.cache = cache
+        self.analysis = None
+        self.loops = {}
+        self._codes = {}
+        self._codes_stored = 0
+        self._key = None
+        self._image = None
+        self._units = {}
+        self._singles = {}
+        self._nondeterministic = set()
+        self._image_is_program = False
+
+    def reset(self, reload_program=False) -> None:
+        """
+        Resets the machine, compiled code is kept if the program is reloaded.
+        """
+        super().reset(reload_program)
+        if not (reload_program and self._image_is_program):
+            self._image = None
+
+    def prepare(self) -> None:
+        """
+        Verifies the program in memory and discards any compiled code.
+        """
+        image = bytes(bytearray(self.memory))
+        analysis, entry = None, None
+        if self.cache is not None:
+            # Images are mapped to the key of their code, so only the first
+            # run of an image needs analysing to find its entry.
+            self._key = self.cache.load_object(self.cache.key(image))
+            if self._key is None:
+                analysis = chip64_verify.check(image, host_functions=self.host_functions)
+                self._key = self.cache.key(image, analysis)
+                try:
+                    self.cache.store_object(self.cache.key(image), self._key)
+                except OSError:
+                    pass
+            entry = self.cache.load(self._key)
+        if entry is None:
+            if analysis is None:
+                analysis = chip64_verify.check(image, host_functions=self.host_functions)
+            self.analysis = analysis
+            self._codes, self._codes_stored = {}, -1
+        else:
+            self.analysis, self._codes = entry
+            self._codes_stored = len(self._codes)
+            found = chip64_verify.problems(self.analysis, self.host_functions)
+            if found:
+                raise chip64_verify.VerificationError(found)
+        self.loops = (
+            chip64_loops.find_loops(self.analysis) if self.summarise_loops else {}
+        )
+        self._image = image
+        self._units = {}
+        self._singles = {}
+        self._nondeterministic = set()
+        program = bytes(bytearray(self.program))
+        self._image_is_program = image == program + bytes(len(image) - len(program))
+
+    def _unit(self, address: int):
+        """
+        Returns the compiled unit starting at address.
+        """
+        unit = self._units.get(address)
+        if unit is None:
+            if self_jump(self._image, address):
+                unit = (_spin, 1)
+            else:
+                unit = compile_block(
+                    self._image, address, leaders=self.loops, codes=self._codes,
+                    tables=self.analysis.jump_tables,
+                )
+            if block_nondeterministic(self._image, address, unit[1]):
+                self._nondeterministic.add(address)
+            if address in self.loops:
+                unit = chip64_loops.loop_unit(self.loops[address], unit, self._codes)
+            self._units[address] = unit
+        return unit
+
+    def _single(self, address: int):
+        """
+        Returns a unit running just the instruction at address.
+        """
+        unit = self._singles.get(address)
+        if unit is None:
+            unit = compile_block(
+                self._image, address, 1, codes=self._codes,
+                tables=self.analysis.jump_tables,
+            )
+            self._singles[address] = unit
+        return unit
+
+    def computed_jump(self, address: int, target: int) -> int:
+        """
+        Returns target, where the BNNN at address jumps to with r0 outside
+        its jump table, if verification followed the jump there. Raises
+        IndexError otherwise, as the rest of the program was only verified
+        for jumps into the table.
+        """
+        if target not in self.analysis.successors[address]:
+            raise IndexError(
+                "BNNN at $%03X jumps to $%X, outside its jump table" % (address, target)
+            )
+        return target
+
+    def _store(self) -> None:
+        """
+        Writes the analysis and compiled code to the cache if either is new.
+        The cache is an optimisation, so failing to write it is not an error.
+        """
+        if self.cache is None or self._codes_stored == len(self._codes):
+            return
+        try:
+            self.cache.store(self._key, self.analysis, self._codes)
+        except OSError:
+            return
+        self._codes_stored = len(self._codes)
+
+    @chip64.measured
+    def execute(self, num_of_cycles=None, deadline=None) -> chip64.ExecutionResult:
+        """
+        The main execution loop of the emulator.
+        num_of_cycles gives the number of cycles you'd like the emulator to run for.
+        If no parameter is passed then the emulator will cycle indefinitely.
+        deadline is a time.monotonic() value to stop at, checked between
+        compiled blocks once every chip64.DEADLINE_INTERVAL cycles.
+        Stops at loops that cannot halt as Chip64.execute() does. While
+        hooks are installed the program is run by the interpreter.
+        """
+        self.halt_reason = self.loop_address = self.stop_address = None
+        if self._image is None:
+            self.prepare()
+        if self._observed:
+            self._execute_observed(num_of_cycles, deadline)
+            return
+        limit = UNLIMITED if num_of_cycles is None else num_of_cycles
+        units = self._units
+        r = [int(value) for value in self.registers]
+        m = bytearray(self.memory)
+        before = bytes(m)
+        s = [int(address) for address in self.stack]
+        v = [int(self.memory_ptr), 0, limit]
+        pc = int(self.code_ptr)
+        repeats = chip64.RepeatDetector() if self.detect_loops else None
+        stop = limit
+        try:
+            while v[1] < limit:
+                if deadline is not None:
+                    if time.monotonic() >= deadline:
+                        self.halt_reason = chip64.DEADLINE
+                        break
+                    stop = min(limit, v[1] + chip64.DEADLINE_INTERVAL)
+                    # Summarised loops run no further than the slice either.
+                    v[2] = stop
+                if repeats is None:
+                    while v[1] < stop:
+                        unit = units.get(pc) or self._unit(pc)
+                        if v[1] + unit[1] > limit:
+                            unit = self._single(pc)
+                        pc = unit[0](self, r, m, s, v)
+                else:
+                    while v[1] < stop:
+                        address = pc
+                        unit = units.get(pc) or self._unit(pc)
+                        if v[1] + unit[1] > limit:
+                            unit = self._single(pc)
+                        pc = unit[0](self, r, m, s, v)
+                        if address in self._nondeterministic:
+                            repeats.clear()
+                        elif pc <= address and repeats.seen(
+                            (pc, v[0], tuple(r), tuple(s)), lambda: bytes(m)
+                        ):
+                            raise _Spin
+            else:
+                self.halt_reason = chip64.CYCLE_LIMIT
+        except _Halt:
+            self.halt_reason = chip64.HALTED
+        except _Spin as spin:
+            if spin.args:
+                pc = spin.args[0]
+            self.halt_reason = chip64.NON_TERMINATING
+            self.loop_address = pc
+        finally:
+            self.code_ptr = pc
+            self.memory_ptr = v[0]
+            self.registers[:] = [np.uint64(value) for value in r]
+            self.stack[:] = s
+            self.cycles += v[1]
+            if m != before:
+                changed = np.flatnonzero(
+                    np.frombuffer(m, np.uint8) != np.frombuffer(before, np.uint8)
+                )
+                for i in changed:
+                    self.memory[i] = _BYTES[m[i]]
+            self._store()
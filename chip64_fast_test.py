@@ -0,0 +1,289 @@
+import chip64
+import chip64_fast
+import chip64_test
+import chip64_tiered
+import chip64_util as c64u
+import chip64_verify
+import numpy as np
+import pytest
+import time
+import unittest.mock
+
+# The shift and add multiply from c_mul.py followed by a HALT.
+MULTIPLY = [
+    0xF0, 0x01, 0xF1, 0x01, 0x62, 0x00, 0x63, 0x00,
+    0x43, 0x40, 0x10, 0x18, 0x80, 0x16, 0x3F, 0x00,
+    0x82, 0x14, 0x81, 0x1E, 0x73, 0x01, 0x10, 0x08,
+    0xD2, 0x01, 0x00, 0x00,
+]
+
+
+def run_both(code, inputs=(), num_of_cycles=None):
+    """
+    Runs code on the reference and the fast engine and returns both machines
+    along with the outputs of each.
+    """
+    machines, outputs = [], []
+    for cls in (chip64.Chip64, chip64_fast.FastChip64):
+        c64u.console_input = unittest.mock.MagicMock(side_effect=list(inputs))
+        c64u.console_output = unittest.mock.MagicMock()
+        c64 = cls(code)
+        c64.execute(num_of_cycles)
+        machines.append(c64)
+        outputs.append(c64u.console_output.call_args_list)
+    return machines, outputs
+
+
+def assert_same_state(a, b):
+    """
+    Asserts two machines hold the same state.
+    """
+    assert a.registers == b.registers
+    assert a.memory == b.memory
+    assert a.stack == b.stack
+    assert a.code_ptr == b.code_ptr
+    assert a.memory_ptr == b.memory_ptr
+
+
+def test_fast_multiply():
+    """
+    Test that the multiply loop gives the same state and output as Chip64.
+    """
+    (a, b), (out_a, out_b) = run_both(MULTIPLY, ["123456789", "987654321"])
+    assert_same_state(a, b)
+    assert out_a == out_b
+    assert out_b[0] == unittest.mock.call(str(123456789 * 987654321))
+
+
+def test_fast_cycle_limit():
+    """
+    Test that execute() stops after exactly num_of_cycles cycles, even when
+    that is part way through a block.
+    """
+    for cycles in (1, 5, 9, 50, 200):
+        (a, b), _ = run_both(MULTIPLY, ["3", "5"], cycles)
+        assert_same_state(a, b)
+
+
+def test_fast_jump_table():
+    """
+    Test that computed jumps into a jump table give the same state as
+    Chip64 at any cycle limit, and that jumps outside the table fault.
+    """
+    for cycles in (None, 11, 12, 13, 14, 100):
+        (a, b), (out_a, out_b) = run_both(chip64_test.DISPATCH, ["40"], cycles)
+        assert_same_state(a, b)
+        assert out_a == out_b
+        assert a.cycles == b.cycles
+    code = [
+        0xF0, 0x01, 0xB0, 0x06, 0x00, 0x00, 0x10, 0x0A,
+        0x10, 0x0E, 0xD0, 0x01, 0x00, 0x00, 0x00, 0x00,
+    ]
+    (a, b), _ = run_both(code, ["2"])
+    assert_same_state(a, b)
+    assert b.cycles == 3
+    for value in ("1", "4"):
+        c64u.console_input = unittest.mock.MagicMock(return_value=value)
+        c64 = chip64_fast.FastChip64(code)
+        with pytest.raises(IndexError):
+            c64.execute()
+        assert c64.halt_reason == chip64.ERROR
+
+
+def test_fast_memory_and_calls():
+    """
+    Test SPILL, LOAD, CALL and RET against Chip64.
+    """
+    code = [
+        0x60, 0xFF, 0x61, 0x12, 0x8F, 0x14, 0x20, 0x10,
+        0xA0, 0x40, 0xE1, 0x65, 0xD1, 0x00, 0x00, 0x00,
+        0xA0, 0x40, 0x81, 0x1E, 0xE2, 0x55, 0x01, 0xEE,
+    ]
+    (a, b), (out_a, out_b) = run_both(code)
+    assert_same_state(a, b)
+    assert out_a == out_b
+    assert b.memory[0x4F] == np.uint8(0x24)
+    assert out_b[0] == unittest.mock.call(hex(0x24))
+
+
+def test_fast_resumes():
+    """
+    Test that execute() can be called repeatedly to run a program in slices.
+    """
+    c64u.console_input = unittest.mock.MagicMock(side_effect=["6", "7"])
+    c64u.console_output = unittest.mock.MagicMock()
+    c64 = chip64_fast.FastChip64(MULTIPLY)
+    for _ in range(100):
+        c64.execute(7)
+    assert c64.registers[2] == 42
+    assert c64.code_ptr == 0x1A
+
+
+def test_fast_reset_reload_keeps_compiled_code():
+    """
+    Test that reloading the program keeps the verified image.
+    """
+    c64 = chip64_fast.FastChip64([0x60, 0x2A, 0x00, 0x00])
+    c64.execute()
+    image = c64._image
+    c64.reset(reload_program=True)
+    assert c64._image is image
+    c64.execute()
+    assert c64.registers[0] == 0x2A
+    c64.reset()
+    assert c64._image is None
+
+
+def test_fast_rejects_unverified_program():
+    """
+    Test that a program failing verification is not run.
+    """
+    c64 = chip64_fast.FastChip64([0x01, 0xEE])
+    with pytest.raises(chip64_verify.VerificationError):
+        c64.execute()
+
+
+# Adds an input to a two limb total 200 times with ADDM, takes it away again
+# with SUBM, then runs an ADC and SBB chain over the limbs in registers.
+MULTI_PRECISION = [
+    0xF3, 0x01, 0x60, 0x00, 0x61, 0x00, 0x62, 0x00,
+    0xA1, 0x00, 0xE3, 0x55, 0x64, 0x02, 0x65, 0x00,
+    0xE4, 0xA4, 0x75, 0x01, 0x45, 0xC8, 0x10, 0x1A,
+    0x10, 0x10, 0xE1, 0x65, 0xD0, 0x01, 0xD1, 0x01,
+    0xE4, 0xA5, 0xE1, 0x65, 0xD0, 0x01, 0xD1, 0x01,
+    0xDF, 0x01, 0x6F, 0x01, 0x80, 0x28, 0x81, 0x39,
+    0xD0, 0x01, 0xD1, 0x01, 0xDF, 0x01, 0x00, 0x00,
+]
+
+
+def test_fast_multi_precision():
+    """
+    Test ADC, SBB, ADDM and SUBM against Chip64.
+    """
+    value = 2**63 + 12345
+    (a, b), (out_a, out_b) = run_both(MULTI_PRECISION, [str(value)])
+    assert_same_state(a, b)
+    assert out_a == out_b
+    total = 200 * value
+    assert out_b[0] == unittest.mock.call(str(total >> 64))
+    assert out_b[1] == unittest.mock.call(str(total & 0xFFFFFFFFFFFFFFFF))
+
+
+@pytest.mark.parametrize(
+    "code, cycles, reason",
+    [
+        ([0x60, 0x01, 0x10, 0x02], None, chip64.NON_TERMINATING),
+        (chip64_test.REPEATING, None, chip64.NON_TERMINATING),
+        (chip64_test.COUNTING, 500, chip64.CYCLE_LIMIT),
+        (MULTIPLY, None, chip64.HALTED),
+    ],
+)
+def test_fast_detect_loops(code, cycles, reason):
+    """
+    Test that loops that cannot halt are stopped as they are by Chip64.
+    """
+    machines = []
+    for cls in (chip64.Chip64, chip64_fast.FastChip64):
+        c64u.console_input = unittest.mock.MagicMock(side_effect=["3", "5"])
+        c64u.console_output = unittest.mock.MagicMock()
+        c64 = cls(code, detect_loops=True)
+        c64.execute(cycles)
+        assert c64.halt_reason == reason
+        machines.append(c64)
+    assert machines[0].loop_address == machines[1].loop_address
+    assert_same_state(*machines)
+
+
+@pytest.mark.parametrize(
+    "code, cycles",
+    [
+        ([0x60, 0x00, 0xB0, 0x02], 2),
+        ([0x60, 0x00, 0x70, 0x00, 0x70, 0x00, 0xB0, 0x06], 4),
+    ],
+)
+def test_computed_jump_to_itself(code, cycles):
+    """
+    Test that a BNNN that jumps to itself stops every engine after the same
+    cycles, as a GOTO to itself does.
+    """
+    machines = []
+    for cls in (chip64.Chip64, chip64_fast.FastChip64, chip64_tiered.TieredChip64):
+        c64 = cls(code)
+        c64.execute(100000)
+        assert c64.halt_reason == chip64.NON_TERMINATING
+        assert c64.cycles == cycles
+        assert c64.loop_address == c64.code_ptr == len(code) - 2
+        machines.append(c64)
+    assert_same_state(*machines[:2])
+
+
+@pytest.mark.parametrize("cls", [chip64.Chip64, chip64_fast.FastChip64, chip64_tiered.TieredChip64])
+def test_observed_execution(cls):
+    """
+    Test that an instruction hook sees every cycle, leaves the results
+    unchanged, and that compiled code is used again once it is removed.
+    """
+    (a, _), _ = run_both(MULTIPLY, ["6", "7"])
+    c64u.console_input = unittest.mock.MagicMock(side_effect=["6", "7"])
+    c64u.console_output = unittest.mock.MagicMock()
+    c64 = cls(MULTIPLY)
+    seen = []
+    hook = lambda c, address, opcode: seen.append(address)
+    c64.add_hook("instruction", hook)
+    c64.execute(100)
+    c64.remove_hook("instruction", hook)
+    c64.execute()
+    assert_same_state(a, c64)
+    assert len(seen) == 100
+    assert seen[:3] == [0x00, 0x02, 0x04]
+    assert c64.cycles == 393
+    if cls is chip64_tiered.TieredChip64:
+        assert c64.compiled
+
+
+@pytest.mark.parametrize("observed", [False, True])
+@pytest.mark.parametrize("cls", [chip64.Chip64, chip64_fast.FastChip64, chip64_tiered.TieredChip64])
+def test_execution_result(cls, observed):
+    """
+    Test that execute() reports the cycles it ran and why it stopped, that
+    runs stop at their deadline and that failed runs are marked as errors.
+    """
+    c64u.console_input = unittest.mock.MagicMock(side_effect=["6", "7"])
+    c64u.console_output = unittest.mock.MagicMock()
+    machines = [cls(MULTIPLY), cls(chip64_test.COUNTING), cls([0xF0, 0x01, 0xB0, 0x00])]
+    if observed:
+        for c64 in machines:
+            c64.add_hook("instruction", lambda c, address, opcode: None)
+    multiply, counting, failing = machines
+    result = multiply.execute(100)
+    assert result[:2] == (100, chip64.CYCLE_LIMIT) and result.elapsed >= 0
+    assert multiply.execute()[:2] == (293, chip64.HALTED)
+    assert counting.execute(deadline=time.monotonic() - 1)[:2] == (0, chip64.DEADLINE)
+    result = counting.execute(deadline=time.monotonic() + 0.05)
+    assert result.halt_reason == counting.halt_reason == chip64.DEADLINE
+    assert result.cycles == counting.cycles > 0 and result.elapsed >= 0.05
+    assert counting.execute(10, time.monotonic() + 60) == (10, chip64.CYCLE_LIMIT, unittest.mock.ANY)
+    c64u.console_input = unittest.mock.MagicMock(return_value="4095")
+    with pytest.raises(Exception):
+        failing.execute()
+    assert failing.halt_reason == chip64.ERROR
+
+
+def test_deadline_in_counted_loop():
+    """
+    Test that a compiled counted loop runs no further than the deadline
+    rather than through all its iterations at once.
+    """
+    # The mixer loop of chip64_loops_test run 2 ** 64 - 1 times.
+    code = [
+        0x62, 0x01, 0x42, 0x00, 0x10, 0x12, 0x81, 0x23,
+        0x81, 0x1E, 0x3F, 0x01, 0x71, 0x09, 0x72, 0x01,
+        0x10, 0x02, 0x00, 0x00,
+    ]
+    c64 = chip64_fast.FastChip64(code)
+    c64.prepare()
+    assert c64.loops[2].kind == "compiled"
+    start = time.monotonic()
+    result = c64.execute(deadline=start + 0.05)
+    assert result.halt_reason == chip64.DEADLINE
+    assert time.monotonic() - start < 5
@@ -0,0 +1,417 @@
+"""
+A differential fuzzer for the Chip64 engines.
+Each case is a random program that passes chip64_verify, run with a stream
+of random inputs and CXNN bytes drawn from its seed on the reference
+Chip64 and on every other engine. The machines' registers, flags, memory,
+stack, pointers and outputs are compared every interval cycles and cases
+that differ are shrunk to a minimal program before being reported.
+Run python -m chip64_fuzz to fuzz from the command line.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import functools
+import random
+import sys
+import numpy as np
+import chip64
+import chip64_fast
+import chip64_tiered
+import chip64_verify
+
+ENGINES = {
+    "fast": chip64_fast.FastChip64,
+    "fast-unsummarised": functools.partial(
+        chip64_fast.FastChip64, summarise_loops=False
+    ),
+    "tiered": chip64_tiered.TieredChip64,
+    "tiered-eager": functools.partial(chip64_tiered.TieredChip64, threshold=1),
+}
+
+DEFAULT_LENGTH = 24
+DEFAULT_CYCLES = 1000
+DEFAULT_INTERVAL = 127
+
+# Placeholders for instructions that never change what a program does, used
+# when shrinking. 7000 adds 0 to r0 and sets no flags.
+NOP = 0x7000
+HALT = 0x0000
+RET = 0x01EE
+# A jump table entry whose target generate() fills in, never the entry
+# itself, which would end the table.
+ENTRY = 0x1001
+
+# Where generated programs read and write memory, well clear of their code.
+DATA_START = 0x800
+DATA_END = 0xF00
+
+
+def _host_mix(registers, memory) -> None:
+    registers[0] = registers[1] * 3 + registers[2]
+
+
+def _host_store(registers, memory) -> None:
+    memory[DATA_START + registers[3] % 256] = registers[4] & 0xFF
+
+
+def _host_fetch(registers, memory) -> None:
+    registers[5] += int(memory[DATA_START + registers[6] % 256])
+    registers[15] = registers[5] >> 64
+
+
+# Host functions registered on every machine, called by the 0NNN opcodes of
+# generated programs.
+HOST_FUNCTIONS = {0x001: _host_mix, 0x002: _host_store, 0x003: _host_fetch}
+
+# The state of a machine at a checkpoint, outputs being those written so far.
+State = collections.namedtuple(
+    "State",
+    ["cycles", "halt_reason", "code_ptr", "memory_ptr", "registers", "stack",
+     "memory", "outputs"],
+)
+# A case whose engines disagree. program is the list of opcodes, engine the
+# first engine to differ from the reference and expected and actual the
+# States they were in at the first checkpoint where they differed.
+Failure = collections.namedtuple(
+    "Failure", ["seed", "program", "engine", "expected", "actual"]
+)
+
+
+def to_code(program: list) -> list:
+    """
+    Returns the bytes of a list of opcodes.
+    """
+    return [byte for opcode in program for byte in (opcode >> 8, opcode & 0xFF)]
+
+
+def _alu(rng: random.Random, x: int) -> int:
+    return 0x8000 | x << 8 | rng.randrange(16) << 4 | rng.choice(
+        [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 0xE]
+    )
+
+
+def _counted_loop(rng: random.Random, address: int) -> list:
+    """
+    Returns a counted loop of the shape chip64_loops recognises, starting at
+    address.
+    """
+    i = rng.randrange(1, 15)
+    step = rng.randrange(1, 4)
+    limit = step * rng.randrange(1, 256 // step)
+    body = []
+    for _ in range(rng.randrange(1, 4)):
+        x = rng.choice([r for r in range(15) if r != i])
+        if rng.random() < 0.3:
+            body.append(0x3F00 | rng.randrange(2))
+        body.append(_alu(rng, x))
+    loop = [0x6000 | i << 8, 0x4000 | i << 8 | limit]
+    exit = address + 2 * (len(loop) + len(body) + 3)
+    loop += [0x1000 | exit] + body + [0x7000 | i << 8 | step, 0x1000 | address + 2]
+    return loop
+
+
+def _jump_table(rng: random.Random, address: int) -> list:
+    """
+    Returns a BNNN dispatching through a jump table of GOTOs, starting at
+    address. r0 is either a random entry, or a constant that may pick an
+    entry or the instruction just past the table. A NOP comes first so that
+    a skip before it cannot skip setting r0. Entries jump past the table or
+    are left as ENTRY for generate() to fill in. Now and then the BNNN
+    jumps to itself instead.
+    """
+    if rng.random() < 0.05:
+        return [NOP, 0x6000, 0xB000 | address + 4]
+    entries = rng.choice([1, 2, 4])
+    if rng.random() < 0.5:
+        select = 0xC000 | 2 * (entries - 1)
+    else:
+        select = 0x6000 | 2 * rng.randrange(entries + 1)
+    table = address + 6
+    end = table + 2 * entries
+    gotos = [rng.choice([0x1000 | end, ENTRY]) for _ in range(entries)]
+    return [NOP, select, 0xB000 | table] + gotos
+
+
+def _instruction(rng: random.Random, subroutine: bool, host_calls: bool = False) -> list:
+    """
+    Returns one randomly chosen instruction, or a short sequence of them.
+    Jumps are left as 0x1000 with no target, to be filled in by generate().
+    If host_calls is True it may be a call to one of HOST_FUNCTIONS.
+    """
+    x = rng.randrange(16)
+    kind = rng.choices(
+        ["alu", "const", "skip", "jump", "call", "random", "io", "memory", "host"],
+        [30, 20, 12, 5, 0 if subroutine else 4, 4, 6, 8, 3 if host_calls else 0],
+    )[0]
+    if kind == "alu":
+        return [_alu(rng, x)]
+    if kind == "const":
+        return [rng.choice([0x6000, 0x7000]) | x << 8 | rng.randrange(256)]
+    if kind == "skip":
+        if rng.random() < 0.5:
+            return [rng.choice([0x3000, 0x4000]) | x << 8 | rng.randrange(256)]
+        return [rng.choice([0x5000, 0x9000]) | x << 8 | rng.randrange(16) << 4]
+    if kind == "jump":
+        return [0x1000]
+    if kind == "call":
+        return [0x2000]
+    if kind == "random":
+        return [0xC000 | x << 8 | rng.randrange(256)]
+    if kind == "io":
+        return [rng.choice([0xD000, 0xF000]) | x << 8 | rng.randrange(4)]
+    if kind == "host":
+        return [rng.choice(sorted(HOST_FUNCTIONS))]
+    x = rng.randrange(8)
+    pointer = 0xA000 | rng.randrange(DATA_START, DATA_END - 8 * 16, 8)
+    return [pointer, 0xE000 | x << 8 | rng.choice([0x55, 0x65, 0xA4, 0xA5])]
+
+
+def generate(rng: random.Random, length: int = DEFAULT_LENGTH, tables: bool = True,
+             host_calls: bool = True) -> list:
+    """
+    Returns a random program of about length instructions that passes
+    chip64_verify, as a list of opcodes. It may loop forever.
+    tables and host_calls allow BNNNs into jump tables and calls to
+    HOST_FUNCTIONS. With both False a seed gives the programs it gave
+    before either was generated.
+    """
+    while True:
+        main, subroutine = [], []
+        while len(main) < length:
+            shape = rng.random()
+            if shape < 0.08:
+                main += _counted_loop(rng, 2 * len(main))
+            elif tables and shape < 0.12:
+                main += _jump_table(rng, 2 * len(main))
+            else:
+                main += _instruction(rng, False, host_calls)
+        main.append(HALT)
+        for _ in range(rng.randrange(1, 5)):
+            subroutine += _instruction(rng, True, host_calls)
+        start = 2 * len(main)
+        program = main + subroutine + [RET, HALT]
+        end = start + 2 * len(subroutine)
+        for n, opcode in enumerate(program):
+            if opcode in (0x1000, ENTRY):
+                low, high = (0, start - 2) if n < len(main) else (start, end)
+                target = rng.randrange(low, high + 1, 2)
+                # Only the instructions setting r0 may lead into a BNNN.
+                while program[target // 2] >> 12 == 0xB or (
+                    opcode == ENTRY and target == 2 * n
+                ):
+                    target = rng.randrange(low, high + 1, 2)
+                program[n] = 0x1000 | target
+            elif opcode == 0x2000:
+                program[n] = 0x2000 | start
+        if not chip64_verify.verify(to_code(program)):
+            return program
+
+
+class _Streams:
+    """
+    The input lines and CXNN bytes a case feeds to a machine, drawn from
+    random streams seeded by the case seed so that every engine sees the
+    same sequence.
+    """
+
+    def __init__(self, seed: int):
+        self._inputs = random.Random(seed)
+        self._bytes = random.Random(~seed)
+        self.outputs = []
+
+    def read_input(self, prompt: str) -> str:
+        # Up to 16 binary digits parse in every base the FX0Q opcodes use
+        # without overflowing a register.
+        return bin(self._inputs.getrandbits(self._inputs.randrange(1, 17)))[2:]
+
+    def write_output(self, value, base: int) -> None:
+        self.outputs.append(chip64.OUTPUT_FORMATS[base](int(value)))
+
+    def random_byte(self) -> int:
+        return self._bytes.randrange(256)
+
+
+def _machine(factory, program: list, seed: int):
+    """
+    Returns a machine built by factory that runs program with the streams of
+    seed, along with the streams.
+    """
+    c64 = factory(to_code(program))
+    for number, function in HOST_FUNCTIONS.items():
+        c64.register_host_function(number, function)
+    streams = _Streams(seed)
+    c64.read_input = streams.read_input
+    c64.write_output = streams.write_output
+    c64.random_byte = streams.random_byte
+    return c64, streams
+
+
+def _state(c64, streams: _Streams) -> State:
+    return State(
+        c64.cycles,
+        c64.halt_reason,
+        int(c64.code_ptr),
+        int(c64.memory_ptr),
+        tuple(int(value) for value in c64.registers),
+        tuple(int(address) for address in c64.stack),
+        bytes(bytearray(c64.memory)),
+        tuple(streams.outputs),
+    )
+
+
+def states(factory, program: list, seed: int, cycles: int, interval: int) -> list:
+    """
+    Runs program on a machine built by factory for up to cycles cycles and
+    returns its States every interval cycles and when it stops.
+    """
+    c64, streams = _machine(factory, program, seed)
+    found = []
+    with np.errstate(over="ignore"):
+        while c64.cycles < cycles:
+            c64.execute(min(interval, cycles - c64.cycles))
+            found.append(_state(c64, streams))
+            if c64.halt_reason != chip64.CYCLE_LIMIT:
+                break
+    return found
+
+
+def compare(program: list, seed: int, engines=ENGINES, cycles=DEFAULT_CYCLES,
+            interval=DEFAULT_INTERVAL):
+    """
+    Runs program on the reference Chip64 and on each engine in engines, a
+    dictionary of names to factories, and returns a Failure for the first
+    engine to differ, None if all agree.
+    """
+    expected = states(chip64.Chip64, program, seed, cycles, interval)
+    for name, factory in engines.items():
+        actual = states(factory, program, seed, cycles, interval)
+        for want, got in zip(expected, actual + [None] * len(expected)):
+            if want != got:
+                return Failure(seed, program, name, want, got)
+    return None
+
+
+def shrink(failure: Failure, engines=ENGINES, cycles=DEFAULT_CYCLES,
+           interval=DEFAULT_INTERVAL) -> Failure:
+    """
+    Returns a Failure for the smallest program found by cutting the failing
+    program short and replacing its instructions with NOPs one at a time,
+    keeping every change that verifies and still fails.
+    """
+    engines = {failure.engine: engines[failure.engine]}
+
+    def attempt(program):
+        if chip64_verify.verify(to_code(program)):
+            return None
+        return compare(program, failure.seed, engines, cycles, interval)
+
+    changed = True
+    while changed:
+        changed = False
+        for n in range(len(failure.program) - 1, -1, -1):
+            for opcode in (HALT, NOP):
+                if failure.program[n] in (HALT, NOP):
+                    break
+                program = failure.program[:n] + [opcode] + failure.program[n + 1:]
+                if opcode == HALT:
+                    program = program[: n + 1]
+                smaller = attempt(program)
+                if smaller is not None:
+                    failure, changed = smaller, True
+                    break
+    return failure
+
+
+def check(job: tuple):
+    """
+    Generates and runs the case of one job, (seed, length, engines, cycles,
+    interval) with engines a tuple of ENGINES names, returning its shrunk
+    Failure or None. Called in worker processes.
+    """
+    seed, length, names, cycles, interval = job
+    engines = {name: ENGINES[name] for name in names}
+    program = generate(random.Random(seed), length)
+    failure = compare(program, seed, engines, cycles, interval)
+    if failure is not None:
+        failure = shrink(failure, engines, cycles, interval)
+    return failure
+
+
+def fuzz(cases: int, seed: int = 0, jobs: int = 1, length: int = DEFAULT_LENGTH,
+         engines=tuple(ENGINES), cycles: int = DEFAULT_CYCLES,
+         interval: int = DEFAULT_INTERVAL):
+    """
+    Yields the Failures of cases cases, seeded seed, seed + 1, ..., running
+    jobs cases at once in worker processes.
+    """
+    work = [
+        (seed + n, length, tuple(engines), cycles, interval) for n in range(cases)
+    ]
+    if jobs == 1:
+        results = map(check, work)
+        for failure in results:
+            if failure is not None:
+                yield failure
+        return
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        for failure in executor.map(check, work, chunksize=32):
+            if failure is not None:
+                yield failure
+
+
+def describe(failure: Failure) -> str:
+    """
+    Returns a readable account of a Failure.
+    """
+    lines = [
+        "seed %d, %s differs from the reference" % (failure.seed, failure.engine),
+        "program: " + " ".join("%04X" % opcode for opcode in failure.program),
+    ]
+    if failure.actual is None:
+        lines.append("%s stopped early" % failure.engine)
+        return "\n".join(lines)
+    for field in State._fields:
+        want = getattr(failure.expected, field)
+        got = getattr(failure.actual, field)
+        if want != got:
+            if field == "memory":
+                address = next(i for i, (a, b) in enumerate(zip(want, got)) if a != b)
+                want, got = "$%03X = %02X" % (address, want[address]), "%02X" % got[address]
+            lines.append("%s: expected %s, got %s" % (field, want, got))
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    """
+    Runs the fuzzer from the command line, returning 1 if any case failed.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m chip64_fuzz",
+        description="Checks every engine against the reference Chip64.",
+    )
+    parser.add_argument("-n", "--cases", type=int, default=1000)
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument("-l", "--length", type=int, default=DEFAULT_LENGTH,
+                        help="instructions per program")
+    parser.add_argument("-c", "--cycles", type=int, default=DEFAULT_CYCLES,
+                        help="cycle budget of each case")
+    parser.add_argument("-e", "--engine", action="append", choices=sorted(ENGINES),
+                        help="engine to check, all by default")
+    options = parser.parse_args(argv)
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    failed = 0
+    for failure in fuzz(
+        options.cases, options.seed, options.jobs, options.length,
+        options.engine or tuple(ENGINES), options.cycles,
+    ):
+        failed += 1
+        print(describe(failure) + "\n", file=sys.stderr)
+    print("%d of %d cases failed" % (failed, options.cases))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import chip64
+import chip64_fuzz
+import chip64_verify
+import random
+
+
+class BrokenChip64(chip64.Chip64):
+    """
+    A Chip64 whose 8XY4 opcode always sets the carry flag.
+    """
+
+    def add_registers(self, dest_index, src_index) -> None:
+        super().add_registers(dest_index, src_index)
+        self.registers[0xF] = 1
+
+
+def test_generate():
+    """
+    Test that generated programs depend only on the seed and verify, that
+    some make computed jumps and host calls, and that with neither allowed
+    they make none.
+    """
+    kinds = set()
+    for seed in range(20):
+        program = chip64_fuzz.generate(random.Random(seed))
+        assert program == chip64_fuzz.generate(random.Random(seed))
+        assert chip64_verify.verify(chip64_fuzz.to_code(program)) == []
+        kinds.update(opcode >> 12 for opcode in program if opcode not in (0x0000, 0x01EE))
+        plain = chip64_fuzz.generate(random.Random(seed), tables=False, host_calls=False)
+        assert not any(opcode >> 12 == 0xB or opcode in chip64_fuzz.HOST_FUNCTIONS for opcode in plain)
+    assert {0x0, 0xB} <= kinds
+    assert chip64_fuzz.to_code([0x6A2A, 0x01EE]) == [0x6A, 0x2A, 0x01, 0xEE]
+
+
+def test_compare_agrees():
+    """
+    Test that every engine agrees with the reference, in and out of worker
+    processes.
+    """
+    assert list(chip64_fuzz.fuzz(40, seed=1000)) == []
+    assert list(chip64_fuzz.fuzz(8, seed=2000, jobs=2)) == []
+
+
+def test_regressions():
+    """
+    Test cases the fuzzer has found: a shift of the flag register after a
+    shift had set it, and jumps to themselves entered from a jump or at the
+    end of a block.
+    """
+    for program in (
+        [0x8F16, 0x8F16, 0x0000],
+        [0x1006, 0x7000, 0x7000, 0x1006, 0x0000],
+        [0x7000, 0x9070, 0x1004, 0x0000],
+        [0x2006, 0x0000, 0x0000, 0x7000, 0x1008, 0x0000],
+    ):
+        assert chip64_fuzz.compare(program, 0) is None
+
+
+def test_shrink():
+    """
+    Test that a case a broken engine gets wrong is shrunk to the few
+    instructions needed to show it.
+    """
+    engines = {"broken": BrokenChip64}
+    program = [0x60FF, 0x6101, 0x8014, 0x7203, 0xD001, 0xDF01, 0x0000]
+    failure = chip64_fuzz.compare(program, 0, engines)
+    assert failure.engine == "broken"
+    assert failure.expected.outputs == ("256", "0")
+    assert failure.actual.outputs == ("256", "1")
+    shrunk = chip64_fuzz.shrink(failure, engines)
+    assert shrunk.program == [chip64_fuzz.NOP, chip64_fuzz.NOP, 0x8014, 0x0000]
+    assert "registers: expected" in chip64_fuzz.describe(shrunk)
+
+
+def test_main(capsys):
+    """
+    Test that the command line reports how many cases failed.
+    """
+    assert chip64_fuzz.main(["-n", "5", "-e", "fast", "-c", "300"]) == 0
+    assert capsys.readouterr().out == "0 of 5 cases failed\n"
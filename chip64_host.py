@@ -0,0 +1,108 @@
+"""
+Built in host functions for the 0NNN opcode.
+Each function takes its arguments from r0 upwards and leaves its result in
+r0, other registers are left alone. install() registers them all on a
+machine under the numbers in BUILTINS.
+"""
+
+import math
+import numpy as np
+
+MASK = 0xFFFFFFFFFFFFFFFF
+
+# Deterministic Miller-Rabin witnesses for every 64 bit number.
+_WITNESSES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)
+
+
+def modpow(r, m) -> None:
+    """
+    r0 = r0 ** r1 mod r2, or 0 if r2 is 0.
+    """
+    r[0] = pow(r[0], r[1], r[2]) if r[2] else 0
+
+
+def mulmod(r, m) -> None:
+    """
+    r0 = r0 * r1 mod r2, or 0 if r2 is 0.
+    """
+    r[0] = r[0] * r[1] % r[2] if r[2] else 0
+
+
+def mulhi(r, m) -> None:
+    """
+    r0 = the high 64 bits of r0 * r1.
+    """
+    r[0] = (r[0] * r[1]) >> 64
+
+
+def isqrt(r, m) -> None:
+    """
+    r0 = the integer square root of r0.
+    """
+    r[0] = math.isqrt(r[0])
+
+
+def gcd(r, m) -> None:
+    """
+    r0 = the greatest common divisor of r0 and r1.
+    """
+    r[0] = math.gcd(r[0], r[1])
+
+
+def is_prime(r, m) -> None:
+    """
+    r0 = 1 if r0 is prime, 0 otherwise.
+    """
+    n = r[0]
+    if n < 2:
+        r[0] = 0
+        return
+    for p in _WITNESSES:
+        if n % p == 0:
+            r[0] = int(n == p)
+            return
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d, s = d // 2, s + 1
+    for a in _WITNESSES:
+        x = pow(a, d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            r[0] = 0
+            return
+    r[0] = 1
+
+
+def table_sum(r, m) -> None:
+    """
+    r0 = the sum modulo 2**64 of the r1 big endian 64 bit words stored from
+    address r0.
+    """
+    start, end = r[0], r[0] + 8 * r[1]
+    if end > len(m):
+        raise IndexError("table at $%03X runs past the end of memory" % start)
+    r[0] = int(m[start:end].view(">u8").sum(dtype=np.uint64))
+
+
+BUILTINS = {
+    0x001: modpow,
+    0x002: mulmod,
+    0x003: mulhi,
+    0x004: isqrt,
+    0x005: gcd,
+    0x006: is_prime,
+    0x010: table_sum,
+}
+
+
+def install(c64) -> None:
+    """
+    Registers every function in BUILTINS on c64.
+    """
+    for number, function in BUILTINS.items():
+        c64.register_host_function(number, function)
@@ -0,0 +1,93 @@
+import chip64
+import chip64_fast
+import chip64_host
+import chip64_tiered
+import chip64_util as c64u
+import chip64_verify
+import numpy as np
+import pytest
+import unittest.mock
+
+# 3 ** 200 mod 251 by host call, then the sum of the table [5, 6, 7] spilled
+# to $080.
+PROGRAM = [
+    0x60, 0x03, 0x61, 0xC8, 0x62, 0xFB, 0x00, 0x01,
+    0xD0, 0x01, 0xA0, 0x80, 0x60, 0x05, 0x61, 0x06,
+    0x62, 0x07, 0xE2, 0x55, 0x60, 0x80, 0x61, 0x03,
+    0x00, 0x10, 0xD0, 0x01, 0x00, 0x00,
+]
+
+
+def call(function, *args):
+    """
+    Calls a host function with args in r0 upwards and returns r0.
+    """
+    r = list(args) + [0] * (16 - len(args))
+    function(r, np.zeros(4096, np.uint8))
+    return r[0]
+
+
+def test_builtins():
+    """
+    Test the built in host functions.
+    """
+    assert call(chip64_host.modpow, 3, 200, 251) == pow(3, 200, 251)
+    assert call(chip64_host.modpow, 3, 200, 0) == 0
+    assert call(chip64_host.mulmod, 2**63, 2**63, 2**64 - 59) == 2**126 % (2**64 - 59)
+    assert call(chip64_host.mulhi, 2**63, 6) == 3
+    assert call(chip64_host.isqrt, 2**64 - 1) == 2**32 - 1
+    assert call(chip64_host.gcd, 84, 36) == 12
+    primes = [n for n in range(60) if call(chip64_host.is_prime, n)]
+    assert primes == [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59]
+    assert call(chip64_host.is_prime, 2**64 - 59) == 1
+    assert call(chip64_host.is_prime, 3215031751) == 0
+
+
+def test_table_sum():
+    """
+    Test that table_sum() sums big endian words and wraps round.
+    """
+    m = np.zeros(4096, np.uint8)
+    m[0x100:0x110] = 0xFF
+    m[0x117] = 2
+    r = [0x100, 3] + [0] * 14
+    chip64_host.table_sum(r, m)
+    assert r[0] == (2 * (2**64 - 1) + 2) % 2**64
+    with pytest.raises(IndexError):
+        chip64_host.table_sum([4090, 1] + [0] * 14, m)
+
+
+@pytest.mark.parametrize(
+    "cls", [chip64.Chip64, chip64_fast.FastChip64, chip64_tiered.TieredChip64]
+)
+def test_host_program(cls):
+    """
+    Test host calls from a program on every engine.
+    """
+    c64u.console_output = unittest.mock.MagicMock()
+    c64 = cls(PROGRAM)
+    chip64_host.install(c64)
+    c64.execute()
+    assert c64u.console_output.call_args_list == [
+        unittest.mock.call(str(pow(3, 200, 251))),
+        unittest.mock.call("18"),
+    ]
+    assert c64.registers[1] == 3
+
+
+def test_host_unregistered():
+    """
+    Test that unregistered host calls do nothing on Chip64 and fail
+    verification on FastChip64.
+    """
+    c64u.console_output = unittest.mock.MagicMock()
+    c64 = chip64.Chip64(PROGRAM)
+    c64.execute()
+    assert c64u.console_output.call_args_list[0] == unittest.mock.call("3")
+    with pytest.raises(chip64_verify.VerificationError) as e:
+        chip64_fast.FastChip64(PROGRAM).execute()
+    assert e.value.problems == [
+        (0x06, "host function 0x001 is not registered"),
+        (0x18, "host function 0x010 is not registered"),
+    ]
+    assert chip64_verify.verify(PROGRAM + [0] * 64) == []
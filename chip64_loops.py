@@ -0,0 +1,307 @@
+"""
+Recognition and summarised execution of counted loops.
+A counted loop is headed by a test of an induction register against a
+constant, its body is straight line ALU code ending in a GOTO back to the
+header and the induction register is only changed by a single ADCR. The trip
+count then follows from the register's value on entry, so the loop can be run
+as one step, in closed form where the body is a known idiom (shift and add
+multiply, bit counting, accumulation) and as a tight compiled loop otherwise.
+Cycle counts stay exact.
+"""
+
+import re
+import chip64_cfg
+import chip64_decode as c64d
+import chip64_fast
+
+MASK = chip64_cfg.MASK
+
+# Mnemonics allowed in the body of a counted loop.
+ALU = frozenset(
+    ["ACR", "ADCR", "AR", "OR", "AND", "XOR", "ADD", "SUB", "RSUB", "SHR", "SHL",
+     "ADC", "SBB"]
+)
+# Skips on the flag that guard an instruction run when the flag is 1.
+_GUARD_ON_ONE = {("SNEC", 0), ("SNUEC", 1)}
+_GUARD_ON_ZERO = {("SNEC", 1), ("SNUEC", 0)}
+
+
+class CountedLoop:
+    """
+    A counted loop found by find_loops().
+    header is the address of the skip testing the induction register against
+    limit, exit is where the loop leaves to and body lists the instructions
+    run on each iteration, the back edge GOTO excluded. guarded holds the
+    indexes into body of instructions a skip may jump over. overhead is the
+    number of unconditional cycles each iteration spends on control flow.
+    kind names the closed form used to run the loop, or is "compiled".
+    trip_count is the number of iterations when the induction register's
+    entry value is known statically, None otherwise.
+    """
+
+    def __init__(self, header, exit, body, guarded, induction, step, limit, overhead):
+        self.header = header
+        self.exit = exit
+        self.body = body
+        self.guarded = guarded
+        self.induction = induction
+        self.step = step
+        self.limit = limit
+        self.overhead = overhead
+        self.kind = "compiled"
+        self.operands = ()
+        self.trip_count = None
+
+    @property
+    def base_cycles(self) -> int:
+        """
+        Cycles taken by an iteration that runs none of its guarded instructions.
+        """
+        return self.overhead + len(self.body) - len(self.guarded)
+
+    @property
+    def max_cycles(self) -> int:
+        """
+        Cycles taken by an iteration that runs all of its guarded instructions.
+        """
+        return self.overhead + len(self.body)
+
+    def trips(self, value: int):
+        """
+        Returns the number of iterations the loop runs for when the induction
+        register holds value on entry, or None if it never reaches the limit
+        without wrapping around.
+        """
+        distance = (self.limit - value) & MASK
+        if distance % self.step:
+            return None
+        return distance // self.step
+
+
+def _linear_body(analysis, start, header):
+    """
+    Returns (body, guarded) for the straight line code from start up to a
+    GOTO header, or None if the code is not of that shape.
+    """
+    body, guarded, address = [], set(), start
+    while address != header:
+        instruction = analysis.instructions.get(address)
+        if instruction is None:
+            return None
+        m = instruction.mnemonic
+        if m == "GOTO":
+            if instruction.nnn != header or len(body) in guarded:
+                return None
+            return body, guarded
+        if m in c64d.SKIPS:
+            if len(body) in guarded:
+                return None
+            guarded.add(len(body) + 1)
+        elif m not in ALU:
+            return None
+        body.append(instruction)
+        address += 2
+    return None
+
+
+def _classify(loop) -> None:
+    """
+    Picks the closed form for loop, if any.
+    """
+    i = loop.induction
+    rest = [b for b in loop.body if not (b.mnemonic == "ADCR" and b.x == i)]
+    if any(chip64_cfg.uses_and_defs(b)[0] & (1 << i) for b in rest):
+        return
+    shape = [b.mnemonic for b in rest]
+    if len(rest) >= 3 and shape[0] == "SHR" and rest[0].y == 1 and rest[1].x == 15:
+        a, guard = rest[0].x, (rest[1].mnemonic, rest[1].nn)
+        if guard in _GUARD_ON_ONE | _GUARD_ON_ZERO:
+            if shape[2:] == ["ADCR"] and len({a, rest[2].x, i, 15}) == 4:
+                loop.kind = "popcount"
+                loop.operands = (a, rest[2].x, rest[2].nn, guard in _GUARD_ON_ONE)
+                return
+            if (
+                shape[2:] == ["ADD", "SHL"]
+                and guard in _GUARD_ON_ONE
+                and rest[3].y == 1
+                and rest[2].y == rest[3].x
+                and len({a, rest[2].x, rest[2].y, i, 15}) == 5
+            ):
+                loop.kind = "multiply"
+                loop.operands = (a, rest[2].x, rest[2].y)
+                return
+    if loop.guarded or any(m not in ("ADCR", "ADD") for m in shape):
+        return
+    written = [b.x for b in rest]
+    sources = {b.y for b in rest if b.mnemonic == "ADD"}
+    if (
+        len(set(written)) == len(written)
+        and 15 not in written
+        and 15 not in sources
+        and sources.isdisjoint(written)
+        and i not in sources
+    ):
+        loop.kind = "accumulate"
+        loop.operands = tuple(rest)
+
+
+def _entry_value(analysis, loop, back_edge):
+    """
+    Returns the induction register's value on entry to loop if it is known.
+    """
+    values = set()
+    for address, successors in analysis.successors.items():
+        if loop.header not in successors or address == back_edge:
+            continue
+        instruction = analysis.instructions[address]
+        after = chip64_cfg.transfer(instruction, analysis.states[address])
+        values.add(after[loop.induction])
+    if len(values) == 1:
+        return values.pop()
+    return None
+
+
+def find_loops(analysis: chip64_cfg.Analysis) -> dict:
+    """
+    Returns the counted loops in an analysed program keyed by header address.
+    """
+    loops = {}
+    for header, instruction in analysis.instructions.items():
+        m = instruction.mnemonic
+        if m not in ("SNEC", "SNUEC") or instruction.x == 15:
+            continue
+        if m == "SNUEC":
+            start, exit = header + 4, header + 2
+        else:
+            start, exit = header + 2, header + 4
+        overhead = 2
+        first = analysis.instructions.get(start)
+        if first is not None and first.mnemonic == "GOTO" and first.nnn != header:
+            start, overhead = first.nnn, 3
+        shape = _linear_body(analysis, start, header)
+        if shape is None or not shape[0]:
+            continue
+        body, guarded = shape
+        back_edge = start + 2 * len(body)
+        if start <= exit <= back_edge:
+            continue
+        i = instruction.x
+        writers = [
+            (n, b)
+            for n, b in enumerate(body)
+            if chip64_cfg.uses_and_defs(b)[1] & (1 << i)
+        ]
+        if len(writers) != 1:
+            continue
+        n, writer = writers[0]
+        if writer.mnemonic != "ADCR" or writer.nn == 0 or n in guarded:
+            continue
+        loop = CountedLoop(
+            header, exit, body, guarded, i, writer.nn, instruction.nn, overhead
+        )
+        _classify(loop)
+        value = _entry_value(analysis, loop, back_edge)
+        if value is not None:
+            loop.trip_count = loop.trips(value)
+        loops[header] = loop
+    return loops
+
+
+def summarise(loop: CountedLoop, r: list, k: int) -> int:
+    """
+    Runs k iterations of a closed form loop on the registers r and returns the
+    number of cycles they take.
+    """
+    i = loop.induction
+    cycles = k * loop.base_cycles
+    # Shifting by 64 or more clears a register, so larger counts behave alike.
+    bits = min(k, 64)
+    if loop.kind == "multiply":
+        a, acc, b = loop.operands
+        low = r[a] & ((1 << bits) - 1)
+        r[acc] = (r[acc] + low * r[b]) & MASK
+        r[15] = ((r[b] << (bits - 1)) & MASK) >> 63 if k <= 64 else 0
+        r[b] = (r[b] << bits) & MASK
+        r[a] >>= bits
+        cycles += low.bit_count()
+    elif loop.kind == "popcount":
+        a, counter, amount, on_one = loop.operands
+        ones = (r[a] & ((1 << bits) - 1)).bit_count()
+        runs = ones if on_one else k - ones
+        r[counter] = (r[counter] + runs * amount) & MASK
+        r[15] = (r[a] >> (k - 1)) & 1 if k <= 64 else 0
+        r[a] >>= bits
+        cycles += runs
+    elif loop.kind == "accumulate":
+        for instruction in loop.operands:
+            x = instruction.x
+            if instruction.mnemonic == "ADCR":
+                r[x] = (r[x] + k * instruction.nn) & MASK
+            else:
+                last = (r[x] + (k - 1) * r[instruction.y]) & MASK
+                total = last + r[instruction.y]
+                r[15] = total >> 64
+                r[x] = total & MASK
+    r[i] = (r[i] + k * loop.step) & MASK
+    return cycles
+
+
+def loop_source(loop: CountedLoop) -> str:
+    """
+    Returns the source of a function running n iterations of a loop's body on
+    registers held in locals, returning how many guarded instructions ran.
+    """
+    lines, guard = [], None
+    for n, instruction in enumerate(loop.body):
+        if instruction.mnemonic in c64d.SKIPS:
+            guard = chip64_fast.condition(instruction)
+            continue
+        code = chip64_fast.statements(instruction)
+        if n in loop.guarded:
+            lines.append("if not (%s):" % guard)
+            lines += ["    " + line for line in code] + ["    e += 1"]
+        else:
+            lines += code
+    body = "\n".join(lines)
+    used = sorted({int(x) for x in re.findall(r"r\[(\d+)\]", body)})
+    body = re.sub(r"r\[(\d+)\]", r"r\1", body)
+    names = ", ".join("r%d" % x for x in used)
+    items = ", ".join("r[%d]" % x for x in used)
+    source = ["def loop_%03X(r, n):" % loop.header, "    e = 0"]
+    source.append("    %s = %s" % (names, items))
+    source.append("    for _ in range(n):")
+    source += ["        " + line for line in body.split("\n")]
+    source.append("    %s = %s" % (items, names))
+    source.append("    return e")
+    return "\n".join(source) + "\n"
+
+
+def loop_unit(loop: CountedLoop, header_unit, codes=None):
+    """
+    Returns a unit for FastChip64 that runs as many whole iterations of loop
+    as the cycle budget allows in one step, and falls back to header_unit to
+    run the header as usual. codes is passed on to chip64_fast.compile_unit().
+    """
+    header_function = header_unit[0]
+    runner = None
+    if loop.kind == "compiled":
+        runner = chip64_fast.compile_unit(
+            loop_source(loop), loop.header, "loop", codes
+        )
+
+    def unit(c, r, m, s, v):
+        k = loop.trips(r[loop.induction])
+        if k:
+            if runner is None:
+                if v[1] + k * loop.max_cycles <= v[2]:
+                    v[1] += summarise(loop, r, k)
+                    return loop.header
+            else:
+                k = min(k, (v[2] - v[1]) // loop.max_cycles)
+                if k:
+                    extra = runner(r, k)
+                    v[1] += k * loop.base_cycles + extra
+                    return loop.header
+        return header_function(c, r, m, s, v)
+
+    return unit, header_unit[1]
@@ -0,0 +1,110 @@
+import chip64_cfg
+import chip64_fast
+import chip64_fast_test
+import chip64_loops
+import pytest
+
+# Counts the set bits of the input into r1, three at a time.
+POPCOUNT = [
+    0xF0, 0x01, 0x42, 0x30, 0x10, 0x10, 0x80, 0x16,
+    0x3F, 0x00, 0x71, 0x03, 0x72, 0x01, 0x10, 0x02,
+    0xD1, 0x01, 0x00, 0x00,
+]
+# Adds r5 to r4 and 7 to r6 while r2 counts up to 0x40 in twos.
+ACCUMULATE = [
+    0x65, 0xFF, 0x6F, 0x01, 0x42, 0x40, 0x10, 0x10,
+    0x84, 0x54, 0x72, 0x02, 0x76, 0x07, 0x10, 0x04,
+    0x00, 0x00,
+]
+# A body with no closed form, it reads the induction register.
+MIXER = [
+    0x61, 0x05, 0x42, 0x20, 0x10, 0x12, 0x81, 0x23,
+    0x81, 0x1E, 0x3F, 0x01, 0x71, 0x09, 0x72, 0x01,
+    0x10, 0x02, 0x00, 0x00,
+]
+
+
+def loops_of(code):
+    """
+    Returns the counted loops found in code.
+    """
+    memory = bytes(code) + bytes(chip64_cfg.MEMORY_SIZE - len(code))
+    return chip64_loops.find_loops(chip64_cfg.analyse(memory))
+
+
+def test_find_loops():
+    """
+    Test that counted loops are found and classified with their trip counts.
+    """
+    (loop,) = loops_of(chip64_fast_test.MULTIPLY).values()
+    assert (loop.header, loop.exit, loop.kind) == (0x08, 0x0A, "multiply")
+    assert (loop.induction, loop.step, loop.limit, loop.trip_count) == (3, 1, 0x40, 64)
+    assert (loop.base_cycles, loop.max_cycles) == (6, 7)
+    assert [loop.kind for loop in loops_of(POPCOUNT).values()] == ["popcount"]
+    (loop,) = loops_of(ACCUMULATE).values()
+    assert (loop.kind, loop.trip_count) == ("accumulate", 32)
+    assert [loop.kind for loop in loops_of(MIXER).values()] == ["compiled"]
+
+
+def test_find_loops_rejects():
+    """
+    Test that loops whose trip count cannot be derived are left alone.
+    """
+    # The induction register is also changed by the ADD.
+    assert loops_of(
+        [0x42, 0x40, 0x10, 0x0A, 0x82, 0x14, 0x72, 0x01, 0x10, 0x00, 0x00, 0x00]
+    ) == {}
+    # The step is guarded by a skip.
+    assert loops_of(
+        [0x42, 0x40, 0x10, 0x0A, 0x3F, 0x00, 0x72, 0x01, 0x10, 0x00, 0x00, 0x00]
+    ) == {}
+    # The body does I/O.
+    assert loops_of(
+        [0x42, 0x40, 0x10, 0x0A, 0xD2, 0x01, 0x72, 0x01, 0x10, 0x00, 0x00, 0x00]
+    ) == {}
+
+
+def test_trips():
+    """
+    Test trip counts for every entry value, including wrapping round.
+    """
+    (loop,) = loops_of(ACCUMULATE).values()
+    assert loop.trips(0) == 32
+    assert loop.trips(0x40) == 0
+    assert loop.trips(0x41) is None
+    assert loop.trips(0x42) == (1 << 63) - 1
+
+
+@pytest.mark.parametrize("code", [POPCOUNT, ACCUMULATE, MIXER])
+@pytest.mark.parametrize("cycles", [None, 1, 5, 33, 80, 150])
+def test_summarised_loops_match(code, cycles):
+    """
+    Test that summarised loops leave the same state as Chip64 for runs that
+    stop before, inside and after them.
+    """
+    (a, b), _ = chip64_fast_test.run_both(code, ["12345678901234567"], cycles)
+    chip64_fast_test.assert_same_state(a, b)
+
+
+def test_summarised_multiply_match():
+    """
+    Test the closed form multiply against Chip64, stopping on either side of
+    the end of the loop.
+    """
+    inputs = [str(0xFEDCBA9876543210), str(0x0123456789ABCDEF)]
+    for cycles in (None, 40, 391, 392, 393):
+        (a, b), (out_a, out_b) = chip64_fast_test.run_both(
+            chip64_fast_test.MULTIPLY, inputs, cycles
+        )
+        chip64_fast_test.assert_same_state(a, b)
+        assert out_a == out_b
+
+
+def test_summarise_loops_off():
+    """
+    Test that loop summarisation can be turned off.
+    """
+    c64 = chip64_fast.FastChip64(ACCUMULATE, summarise_loops=False)
+    c64.execute()
+    assert c64.loops == {}
+    assert int(c64.registers[4]) == (32 * 0xFF)
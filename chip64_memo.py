@@ -0,0 +1,155 @@
+"""
+A cache of the results of deterministic runs.
+A run is keyed by a hash of the program image, its inputs, its cycle budget
+and loop detection, and the seed of its random numbers if it can reach a
+CXNN opcode. Programs are scanned statically first: only those that verify,
+so that every instruction they can run is known, and that cannot reach a
+host call are ever cached, so a stored result is exactly what running the
+program again would give.
+"""
+
+import collections
+import functools
+import hashlib
+import json
+import chip64
+import chip64_cache
+import chip64_cfg
+import chip64_replay
+import chip64_sink
+import chip64_verify
+
+# Raise whenever the meaning of a stored result changes.
+RESULT_VERSION = 1
+
+# What _scan() finds out about a program.
+DETERMINISTIC = "deterministic"
+RANDOM = "random"
+UNCACHEABLE = "uncacheable"
+
+# A stored run, the chip64_sink.RunResult and the chip64_replay.Checkpoint
+# of the state it ended in.
+CachedRun = collections.namedtuple("CachedRun", ["result", "final"])
+
+
+@functools.lru_cache(maxsize=1024)
+def _scan(image: bytes) -> str:
+    """
+    Returns DETERMINISTIC, RANDOM if the result also depends on the CXNN
+    opcode's random numbers, or UNCACHEABLE.
+    """
+    memory = image + bytes(max(0, chip64_cfg.MEMORY_SIZE - len(image)))
+    analysis = chip64_cfg.analyse(memory)
+    if chip64_verify.problems(analysis):
+        return UNCACHEABLE
+    mnemonics = {instruction.mnemonic for instruction in analysis.instructions.values()}
+    if "HOST" in mnemonics:
+        return UNCACHEABLE
+    return RANDOM if "BAR" in mnemonics else DETERMINISTIC
+
+
+def key(code, inputs=(), num_of_cycles=None, detect_loops=False, seed=None):
+    """
+    Returns the cache key of a run of code reading inputs, a sequence of
+    input lines, with its random numbers seeded by seed. Returns None if the
+    run's result cannot be cached.
+    """
+    image = bytes(bytearray(code))
+    kind = _scan(image)
+    if kind == UNCACHEABLE or (kind == RANDOM and seed is None):
+        return None
+    digest = hashlib.sha256()
+    digest.update(b"chip64 results %d %d " % (RESULT_VERSION, len(image)))
+    digest.update(image)
+    digest.update(
+        json.dumps(
+            [list(inputs), num_of_cycles, detect_loops, seed if kind == RANDOM else None]
+        ).encode()
+    )
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    An in-memory cache of CachedRuns holding the max_entries most recently
+    used, in front of an optional chip64_cache.DiskCache in directory bounded
+    to max_bytes. hits and misses count the lookups of load().
+    """
+
+    def __init__(self, directory: str = None, max_entries: int = 1024,
+                 max_bytes: int = 64 << 20):
+        self.memory = chip64_cache.MemoryCache(max_entries)
+        self.disk = None if directory is None else chip64_cache.DiskCache(
+            directory, max_bytes
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, key: str):
+        """
+        Returns the CachedRun stored under key, or None if there is none.
+        """
+        run = self.memory.load_object(key)
+        if run is None and self.disk is not None:
+            run = self.disk.load_object(key)
+            if run is not None:
+                self.memory.store_object(key, run)
+        if run is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return run
+
+    def store(self, key: str, run: CachedRun) -> None:
+        """
+        Stores a CachedRun under key in every tier.
+        The cache is an optimisation, so failing to write the disk is not an
+        error.
+        """
+        self.memory.store_object(key, run)
+        if self.disk is not None:
+            try:
+                self.disk.store_object(key, run)
+            except OSError:
+                pass
+
+
+class _Inputs:
+    """
+    Feeds a run's inputs to a machine in place of the console.
+    """
+
+    def __init__(self, values):
+        self.values = iter(values)
+
+    def read_input(self, prompt: str) -> str:
+        try:
+            return next(self.values)
+        except StopIteration:
+            raise EOFError("the program read more inputs than the job has") from None
+
+
+def run(results, factory, code, inputs=(), num_of_cycles=None, detect_loops=False,
+        seed=None, deadline=None) -> CachedRun:
+    """
+    Returns the CachedRun of code reading inputs, from results, a
+    ResultCache, if it holds it. Otherwise code is run on a machine built by
+    factory(code, detect_loops=detect_loops) with its random numbers seeded
+    by seed until deadline, a time.monotonic() value, and the run is stored
+    if it can be cached. Runs stopped by the deadline never are. results may
+    be None to always run.
+    """
+    k = None if results is None else key(code, inputs, num_of_cycles, detect_loops, seed)
+    if k is not None:
+        cached = results.load(k)
+        if cached is not None:
+            return cached
+    c64 = factory(code, detect_loops=detect_loops)
+    c64.read_input = _Inputs(inputs).read_input
+    if seed is not None:
+        c64.rng.seed(seed)
+    result = chip64_sink.run(c64, num_of_cycles, deadline)
+    cached = CachedRun(result, chip64_replay.checkpoint(c64, c64.cycles, 0))
+    if k is not None and result.halt_reason != chip64.DEADLINE:
+        results.store(k, cached)
+    return cached
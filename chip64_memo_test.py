@@ -0,0 +1,67 @@
+import chip64
+import chip64_fast
+import chip64_fast_test
+import chip64_memo
+import chip64_replay_test
+import chip64_test
+import pytest
+import time
+
+# Reads r0 and jumps to it, so the code it runs cannot be known statically.
+COMPUTED_JUMP = [0xF0, 0x01, 0xB0, 0x04, 0x00, 0x00]
+# Calls host function 1.
+HOST_CALL = [0x00, 0x01, 0x00, 0x00]
+
+
+def test_key():
+    """
+    Test that keys cover the inputs, budget and, for programs using CXNN,
+    the seed, and that programs whose results could differ have none.
+    """
+    key = chip64_memo.key
+    multiply = chip64_fast_test.MULTIPLY
+    assert key(multiply, ["6", "7"]) == key(bytes(multiply), ("6", "7"), seed=3)
+    assert key(multiply, ["6", "7"]) != key(multiply, ["7", "6"])
+    assert key(multiply, ["6", "7"]) != key(multiply, ["6", "7"], 100)
+    assert key(multiply, ["6", "7"]) != key(multiply, ["6", "7"], detect_loops=True)
+    random_sum = chip64_replay_test.RANDOM_SUM
+    assert key(random_sum, ["3"]) is None
+    assert key(random_sum, ["3"], seed=1) != key(random_sum, ["3"], seed=2)
+    assert key(COMPUTED_JUMP, ["4"]) is None
+    assert key(HOST_CALL) is None
+
+
+def test_result_cache(tmp_path):
+    """
+    Test that a repeated run is answered from memory, then from disk by a
+    new cache, without building a machine.
+    """
+    built = []
+
+    def factory(code, **kwargs):
+        built.append(code)
+        return chip64_fast.FastChip64(code, **kwargs)
+
+    results = chip64_memo.ResultCache(str(tmp_path))
+    first = chip64_memo.run(results, factory, chip64_fast_test.MULTIPLY, ["6", "7"])
+    assert first.result.outputs == ((42, 10),)
+    assert first.final.registers[2] == 42 and first.result.cycles == 393
+    assert chip64_memo.run(results, factory, chip64_fast_test.MULTIPLY, ["6", "7"]) == first
+    assert (results.hits, results.misses, len(built)) == (1, 1, 1)
+    results = chip64_memo.ResultCache(str(tmp_path))
+    assert chip64_memo.run(results, factory, chip64_fast_test.MULTIPLY, ["6", "7"]) == first
+    assert len(built) == 1
+    chip64_memo.run(results, factory, chip64_replay_test.RANDOM_SUM, ["3"], seed=None)
+    chip64_memo.run(results, factory, chip64_replay_test.RANDOM_SUM, ["3"], seed=None)
+    assert len(built) == 3
+    seeded = [
+        chip64_memo.run(None, chip64.Chip64, chip64_replay_test.RANDOM_SUM, ["3"], seed=5)
+        for _ in range(2)
+    ]
+    assert seeded[0] == seeded[1]
+    with pytest.raises(EOFError):
+        chip64_memo.run(results, factory, chip64_fast_test.MULTIPLY, ["6"])
+    stopped = chip64_memo.run(results, factory, chip64_test.COUNTING, deadline=time.monotonic())
+    assert stopped.result.halt_reason == chip64.DEADLINE
+    assert chip64_memo.key(chip64_test.COUNTING) is not None
+    assert results.load(chip64_memo.key(chip64_test.COUNTING)) is None
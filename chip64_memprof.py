@@ -0,0 +1,244 @@
+"""
+A profiler of the memory traffic of Chip64 programs.
+For every byte of memory it counts the reads and writes of the memory
+opcodes, SPILL, LOAD, ADDM and SUBM, and for every one of those instructions
+how many registers each execution moved, how memory_ptr moved between its
+executions and how many of the registers it moved were wasted: loaded
+registers overwritten before anything read them and spilled registers
+overwritten in memory before anything loaded them. SMP and MPAR instructions
+have the pointer values and steps they set counted.
+"""
+
+import collections
+import functools
+import numpy as np
+import chip64_cfg
+import chip64_decode as c64d
+
+_TRANSFERS = frozenset(["SPILL", "LOAD", "ADDM", "SUBM"])
+_POINTERS = frozenset(["SMP", "MPAR"])
+
+# A run of bytes that memory opcodes touched, see MemoryProfiler.regions().
+Region = collections.namedtuple("Region", ["start", "end", "reads", "writes"])
+
+
+@functools.lru_cache(maxsize=None)
+def _effects(opcode: int) -> tuple:
+    """
+    Returns (mnemonic, x, used registers, defined registers) for an opcode,
+    the registers as tuples of numbers.
+    """
+    instruction = c64d.decode(opcode)
+    uses, defs = chip64_cfg.uses_and_defs(instruction)
+    return (
+        instruction.mnemonic,
+        instruction.x,
+        tuple(r for r in range(16) if uses >> r & 1),
+        tuple(r for r in range(16) if defs >> r & 1),
+    )
+
+
+class Site:
+    """
+    The memory traffic of one memory or pointer instruction.
+    registers counts executions by the number of registers moved, strides
+    the change in memory_ptr since the previous execution and values the
+    pointers SMP set or the steps MPAR added. used and wasted count the
+    registers moved that were, and were not, needed.
+    """
+
+    def __init__(self, address: int, mnemonic: str):
+        self.address = address
+        self.mnemonic = mnemonic
+        self.executions = 0
+        self.registers = collections.Counter()
+        self.strides = collections.Counter()
+        self.values = collections.Counter()
+        self.used = 0
+        self.wasted = 0
+        self._last = None
+
+    def describe(self) -> str:
+        """
+        Returns a one line summary of the site.
+        """
+        text = "$%03X %s: %d executions" % (self.address, self.mnemonic, self.executions)
+        if self.mnemonic in _POINTERS:
+            kind = "pointers" if self.mnemonic == "SMP" else "steps"
+            common = ", ".join("%d x%d" % item for item in self.values.most_common(3))
+            return "%s, %s %s" % (text, kind, common)
+        moved = sum(n * count for n, count in self.registers.items())
+        text += ", %d registers moved" % moved
+        if self.wasted:
+            text += ", %d wasted" % self.wasted
+        if self.strides:
+            stride, count = self.strides.most_common(1)[0]
+            text += ", stride %+d x%d" % (stride, count)
+        return text
+
+
+class MemoryProfiler:
+    """
+    Profiles the memory traffic of a machine.
+    The machine runs in the interpreter while a profiler is attached, see
+    Chip64.add_hook().
+    """
+
+    def __init__(self, c64=None):
+        """
+        Creates an empty profile. It is attached to c64, if given, on
+        entering a with block and detached on leaving it.
+        """
+        self.machine = c64
+        self._attached = None
+        self.clear()
+
+    def attach(self, c64) -> None:
+        """
+        Starts profiling c64.
+        """
+        self.detach()
+        c64.add_hook("instruction", self._instruction)
+        self._attached = c64
+
+    def detach(self) -> None:
+        """
+        Stops profiling, keeping the profile so far.
+        """
+        c64, self._attached = self._attached, None
+        if c64 is not None:
+            c64.remove_hook("instruction", self._instruction)
+
+    def clear(self) -> None:
+        """
+        Forgets the profile.
+        """
+        self.reads = np.zeros(chip64_cfg.MEMORY_SIZE, np.int64)
+        self.writes = np.zeros(chip64_cfg.MEMORY_SIZE, np.int64)
+        self.sites = {}
+        # The site that last loaded each register and that last spilled each
+        # byte, -1 once it has been read.
+        self._loaded = [-1] * 16
+        self._spilled = np.full(chip64_cfg.MEMORY_SIZE, -1, np.int32)
+
+    def _site(self, address: int, mnemonic: str) -> Site:
+        site = self.sites.get(address)
+        if site is None or site.mnemonic != mnemonic:
+            site = self.sites[address] = Site(address, mnemonic)
+        return site
+
+    def _instruction(self, c64, address: int, opcode: int) -> None:
+        m, x, uses, defs = _effects(opcode)
+        loaded = self._loaded
+        for r in uses:
+            if loaded[r] >= 0:
+                self.sites[loaded[r]].used += 1
+                loaded[r] = -1
+        for r in defs:
+            if loaded[r] >= 0:
+                self.sites[loaded[r]].wasted += 1
+                loaded[r] = -1
+        if m in _TRANSFERS:
+            self._transfer(c64, address, m, x)
+        elif m in _POINTERS:
+            site = self._site(address, m)
+            site.executions += 1
+            site.values[int(c64.registers[x]) if m == "MPAR" else opcode & 0xFFF] += 1
+
+    def _transfer(self, c64, address: int, m: str, x: int) -> None:
+        site = self._site(address, m)
+        site.executions += 1
+        pointer = int(c64.memory_ptr)
+        if site._last is not None:
+            site.strides[pointer - site._last] += 1
+        site._last = pointer
+        if m == "SPILL" or m == "LOAD":
+            count = x + 1
+            read = (pointer, pointer + 8 * count) if m == "LOAD" else None
+            written = (pointer, pointer + 8 * count) if m == "SPILL" else None
+        else:
+            count = 2 * int(c64.registers[x])
+            read = (pointer, pointer + 8 * count)
+            written = (pointer, pointer + 4 * count)
+        site.registers[count] += 1
+        if m == "LOAD":
+            for r in range(count):
+                self._loaded[r] = address
+        if read is not None:
+            self.reads[read[0]:read[1]] += 1
+            self._read(*read)
+        if written is not None:
+            self.writes[written[0]:written[1]] += 1
+            self._overwrite(*written)
+            if m == "SPILL":
+                self._spilled[written[0]:written[1]] = address
+
+    def _read(self, low: int, high: int) -> None:
+        """
+        Marks the spilled registers in [low, high) as used.
+        """
+        self._settle(low, high, "used")
+
+    def _overwrite(self, low: int, high: int) -> None:
+        """
+        Marks the spilled registers in [low, high) that were never read as
+        wasted.
+        """
+        self._settle(low, high, "wasted")
+
+    def _settle(self, low: int, high: int, outcome: str) -> None:
+        spilled = self._spilled[low:high]
+        owners, counts = np.unique(spilled[spilled >= 0], return_counts=True)
+        for owner, count in zip(owners, counts):
+            site = self.sites[int(owner)]
+            # Counted in whole registers, a partly read register counts once.
+            setattr(site, outcome, getattr(site, outcome) + -(-int(count) // 8))
+        spilled[:] = -1
+
+    def regions(self) -> list:
+        """
+        Returns the Regions of consecutive bytes that memory opcodes read or
+        wrote, busiest first.
+        """
+        touched = (self.reads + self.writes) > 0
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], touched.view(np.int8), [0]))))
+        regions = [
+            Region(
+                int(start), int(end),
+                int(self.reads[start:end].sum()), int(self.writes[start:end].sum()),
+            )
+            for start, end in zip(edges[::2], edges[1::2])
+        ]
+        return sorted(regions, key=lambda r: (-(r.reads + r.writes), r.start))
+
+    def report(self, top: int = 10) -> str:
+        """
+        Returns a text report of the top busiest regions and memory sites
+        and of every pointer site.
+        """
+        lines = ["hot regions:"]
+        for region in self.regions()[:top]:
+            lines.append(
+                "  $%03X-$%03X: %d byte reads, %d byte writes"
+                % (region.start, region.end - 1, region.reads, region.writes)
+            )
+        transfers = [s for s in self.sites.values() if s.mnemonic in _TRANSFERS]
+        transfers.sort(key=lambda s: (-sum(n * c for n, c in s.registers.items()), s.address))
+        lines.append("memory sites:")
+        lines += ["  " + site.describe() for site in transfers[:top]]
+        lines.append("pointer sites:")
+        lines += [
+            "  " + site.describe()
+            for site in sorted(self.sites.values(), key=lambda s: s.address)
+            if site.mnemonic in _POINTERS
+        ]
+        return "\n".join(lines)
+
+    def __enter__(self):
+        if self.machine is not None:
+            self.attach(self.machine)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.machine is not None:
+            self.detach()
@@ -0,0 +1,67 @@
+import chip64
+import chip64_memprof
+import chip64_tiered
+import collections
+
+# Sums r0 of four overlapping four register loads from $800, then spills
+# r0 and r1 to $900 twice and loads r0 back.
+TABLE_WALK = [
+    0xA8, 0x00, 0x65, 0x00, 0xE3, 0x65, 0x86, 0x04,
+    0x68, 0x08, 0xE8, 0x1E, 0x75, 0x01, 0x45, 0x04,
+    0x10, 0x14, 0x10, 0x04, 0xA9, 0x00, 0xE1, 0x55,
+    0xE1, 0x55, 0xE0, 0x65, 0x00, 0x00,
+]
+
+
+def profile(c64):
+    """
+    Runs c64 under a MemoryProfiler and returns the profiler.
+    """
+    with chip64_memprof.MemoryProfiler(c64) as profiler:
+        c64.execute()
+    return profiler
+
+
+def test_memory_profiler_sites():
+    """
+    Test that transfers, strides, pointer updates and wasted registers are
+    counted per site.
+    """
+    profiler = profile(chip64.Chip64(TABLE_WALK))
+    load = profiler.sites[0x004]
+    assert (load.mnemonic, load.executions) == ("LOAD", 4)
+    assert load.registers == collections.Counter({4: 4})
+    assert load.strides == collections.Counter({8: 3})
+    assert (load.used, load.wasted) == (5, 9)
+    assert (profiler.sites[0x016].used, profiler.sites[0x016].wasted) == (0, 2)
+    assert (profiler.sites[0x018].used, profiler.sites[0x018].wasted) == (1, 0)
+    assert profiler.sites[0x000].values == collections.Counter({0x800: 1})
+    assert profiler.sites[0x00A].values == collections.Counter({8: 4})
+
+
+def test_memory_profiler_regions():
+    """
+    Test that hot regions are reported busiest first and that the machine
+    goes back to compiled code afterwards.
+    """
+    c64 = chip64_tiered.TieredChip64(TABLE_WALK)
+    profiler = profile(c64)
+    assert not c64._observed
+    assert profiler.regions() == [
+        chip64_memprof.Region(0x800, 0x838, 128, 0),
+        chip64_memprof.Region(0x900, 0x910, 8, 32),
+    ]
+    assert int(profiler.reads[0x818]) == 4
+    report = profiler.report(top=1)
+    assert report.splitlines() == [
+        "hot regions:",
+        "  $800-$837: 128 byte reads, 0 byte writes",
+        "memory sites:",
+        "  $004 LOAD: 4 executions, 16 registers moved, 9 wasted, stride +8 x3",
+        "pointer sites:",
+        "  $000 SMP: 1 executions, pointers 2048 x1",
+        "  $00A MPAR: 4 executions, steps 8 x4",
+        "  $014 SMP: 1 executions, pointers 2304 x1",
+    ]
+    profiler.clear()
+    assert profiler.regions() == [] and profiler.sites == {}
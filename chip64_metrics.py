@@ -0,0 +1,336 @@
+"""
+Throughput and health metrics for long running Chip64 runner processes.
+A Metrics object totals the cycles runs executed and the time they took per
+engine, how they stopped, the values they read and wrote, how many machines
+are running, parked in pools or halted and the hits and misses of the
+decode, compile and result caches, and renders them as Prometheus text.
+Nothing is counted per instruction. Machines count their own cycles and
+caches their own lookups, and those counters are read once per run and
+once per scrape. FileExporter writes the text to a file every few seconds
+and serve() answers scrapes on a localhost port.
+"""
+
+import collections
+import http.server
+import os
+import tempfile
+import threading
+import time
+import weakref
+import chip64
+import chip64_decode as c64d
+import chip64_sink
+
+# Upper bounds in seconds of the run duration histogram's buckets.
+DURATION_BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0, 60.0)
+
+# How often FileExporter rewrites its file, in seconds.
+DEFAULT_INTERVAL = 10.0
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# What a job run elsewhere tells Metrics.record() besides its result:
+# seconds it took, whether it executed or was answered from a cache, the
+# input values it was given, and source and caches for update_caches().
+Usage = collections.namedtuple(
+    "Usage", ["seconds", "executed", "inputs", "source", "caches"]
+)
+
+
+def cache_counters(compile_cache=None, result_cache=None) -> dict:
+    """
+    Returns the (hits, misses) of this process's decode cache and of a
+    chip64_cache compile cache and chip64_memo.ResultCache, if given, keyed
+    by "decode", "compile" and "result".
+    """
+    info = c64d.mnemonic.cache_info()
+    counters = {"decode": (info.hits, info.misses)}
+    for name, cache in (("compile", compile_cache), ("result", result_cache)):
+        if cache is not None:
+            counters[name] = (cache.hits, cache.misses)
+    return counters
+
+
+class _EngineStats:
+    """
+    The totals of the runs on one engine.
+    """
+
+    def __init__(self):
+        self.cycles = 0
+        self.seconds = 0.0
+        self.halt_reasons = collections.Counter()
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.durations = 0.0
+        self.runs = 0
+
+
+def _labels(**labels) -> str:
+    return "{%s}" % ",".join('%s="%s"' % item for item in sorted(labels.items()))
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """
+    The metrics of the machines of one process. Any number of threads may
+    record into one at once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._engines = collections.defaultdict(_EngineStats)
+        self._io = collections.Counter()
+        self._caches = {}
+        self._running = set()
+        self._machines = weakref.WeakSet()
+        self._pools = weakref.WeakSet()
+        # Jobs running out of sight of this process, set by their runner.
+        self.active_jobs = 0
+
+    def record(self, engine: str, result, seconds: float, executed: bool = True,
+               inputs: int = 0) -> None:
+        """
+        Adds a finished run on engine taking seconds to the totals. result
+        is its chip64_sink.RunResult or None if the run raised. Only runs
+        that executed, rather than being answered from a cache, count their
+        cycles and time towards the engine's cycles per second. inputs is
+        the number of values the run read.
+        """
+        with self._lock:
+            stats = self._engines[engine]
+            stats.runs += 1
+            stats.durations += seconds
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    stats.buckets[i] += 1
+            if result is None:
+                stats.halt_reasons[chip64.ERROR] += 1
+                return
+            stats.halt_reasons[result.halt_reason] += 1
+            if executed:
+                stats.cycles += result.cycles
+                stats.seconds += seconds
+            self._io["input"] += inputs
+            self._io["output"] += len(result.outputs)
+
+    def update_caches(self, source, counters: dict) -> None:
+        """
+        Takes the cumulative cache counters of source, any hashable naming a
+        process or the caches it owns, as returned by cache_counters().
+        Counters only grow, so reports arriving out of order are harmless.
+        """
+        with self._lock:
+            for name, (hits, misses) in counters.items():
+                old = self._caches.get((source, name), (0, 0))
+                self._caches[(source, name)] = (max(old[0], hits), max(old[1], misses))
+
+    def watch_pool(self, pool) -> None:
+        """
+        Counts the idle machines of a chip64_pool.Chip64Pool as parked.
+        """
+        with self._lock:
+            self._pools.add(pool)
+
+    def run(self, c64: chip64.Chip64, engine: str = None, num_of_cycles=None,
+            deadline=None) -> chip64_sink.RunResult:
+        """
+        Runs c64 with chip64_sink.run() and records the run. c64 counts as
+        active while it runs and as halted afterwards until it runs again or
+        is reset. engine defaults to the name of c64's class.
+        """
+        engine = type(c64).__name__ if engine is None else engine
+        inputs = [0]
+        read_input = c64.read_input
+
+        def counted(prompt):
+            inputs[0] += 1
+            return read_input(prompt)
+
+        shadowed = "read_input" in vars(c64)
+        c64.read_input = counted
+        with self._lock:
+            self._running.add(c64)
+            self._machines.add(c64)
+        start = time.perf_counter()
+        result = None
+        try:
+            result = chip64_sink.run(c64, num_of_cycles, deadline)
+        finally:
+            seconds = time.perf_counter() - start
+            if shadowed:
+                c64.read_input = read_input
+            else:
+                del c64.read_input
+            with self._lock:
+                self._running.discard(c64)
+            self.record(engine, result, seconds, inputs=inputs[0])
+        return result
+
+    def machines(self) -> dict:
+        """
+        Returns the number of machines in each state: active, running now,
+        parked, idle in a watched pool, and halted, having halted in run()
+        and not run or been reset since.
+        """
+        with self._lock:
+            return {
+                "active": len(self._running) + self.active_jobs,
+                "parked": sum(len(pool) for pool in self._pools),
+                "halted": sum(
+                    1 for c64 in self._machines
+                    if c64 not in self._running and c64.halt_reason == chip64.HALTED
+                ),
+            }
+
+    def text(self) -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        machines = self.machines()
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for suffix, labels, value in samples:
+                lines.append("%s%s%s %s" % (name, suffix, _labels(**labels), _number(value)))
+
+        with self._lock:
+            engines = sorted(self._engines.items())
+            family("chip64_cycles_total", "counter", "Cycles executed.", [
+                ("", {"engine": engine}, stats.cycles) for engine, stats in engines
+            ])
+            family("chip64_cycles_per_second", "gauge",
+                   "Cycles executed per second spent executing.", [
+                       ("", {"engine": engine},
+                        stats.cycles / stats.seconds if stats.seconds else 0.0)
+                       for engine, stats in engines
+                   ])
+            family("chip64_runs_total", "counter", "Runs by how they stopped.", [
+                ("", {"engine": engine, "halt_reason": str(reason)}, count)
+                for engine, stats in engines
+                for reason, count in sorted(stats.halt_reasons.items(), key=str)
+            ])
+            samples = []
+            for engine, stats in engines:
+                for bound, count in zip(DURATION_BUCKETS, stats.buckets):
+                    samples.append(("_bucket", {"engine": engine, "le": repr(bound)}, count))
+                samples.append(("_bucket", {"engine": engine, "le": "+Inf"}, stats.runs))
+                samples.append(("_sum", {"engine": engine}, stats.durations))
+                samples.append(("_count", {"engine": engine}, stats.runs))
+            family("chip64_run_duration_seconds", "histogram", "Run durations.", samples)
+            family("chip64_machines", "gauge", "Machines by state.", [
+                ("", {"state": state}, count) for state, count in sorted(machines.items())
+            ])
+            family("chip64_io_operations_total", "counter",
+                   "Values read by FX0Q and written by DX0Q opcodes.", [
+                       ("", {"direction": direction}, self._io[direction])
+                       for direction in ("input", "output")
+                   ])
+            caches = collections.defaultdict(lambda: [0, 0])
+            for (_, name), (hits, misses) in self._caches.items():
+                caches[name][0] += hits
+                caches[name][1] += misses
+            caches = sorted(caches.items())
+        family("chip64_cache_hits_total", "counter", "Cache lookups that hit.", [
+            ("", {"cache": name}, hits) for name, (hits, _) in caches
+        ])
+        family("chip64_cache_misses_total", "counter", "Cache lookups that missed.", [
+            ("", {"cache": name}, misses) for name, (_, misses) in caches
+        ])
+        family("chip64_cache_hit_ratio", "gauge", "Share of cache lookups that hit.", [
+            ("", {"cache": name}, hits / (hits + misses) if hits + misses else 0.0)
+            for name, (hits, misses) in caches
+        ])
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """
+        Writes the metrics to path, replacing it whole so that a reader
+        never sees half a file.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.text())
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+
+class FileExporter:
+    """
+    Writes metrics to a file every interval seconds from a background
+    thread, and once more when stopped, for node_exporter's textfile
+    collector or anything else that reads files.
+    """
+
+    def __init__(self, metrics: Metrics, path: str, interval: float = DEFAULT_INTERVAL):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """
+        Starts writing the file.
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._export, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the thread and writes the file a last time.
+        """
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        self.metrics.write(self.path)
+
+    def _export(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.metrics.write(self.path)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def serve(metrics: Metrics, port: int = 0, host: str = "127.0.0.1"):
+    """
+    Serves metrics over HTTP on host and port, every path answering with
+    the Prometheus text, from a background thread. Returns the server, whose
+    server_address holds the port chosen if port is 0. Call its shutdown()
+    method to stop it.
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,117 @@
+import chip64
+import chip64_cache
+import chip64_fast
+import chip64_fast_test
+import chip64_metrics
+import chip64_pool
+import chip64_sink
+import urllib.request
+
+
+def machine(cls=chip64_fast.FastChip64, inputs=("6", "7"), **kwargs):
+    """
+    Returns a machine running the multiply program that reads inputs.
+    """
+    c64 = cls(chip64_fast_test.MULTIPLY, **kwargs)
+    values = iter(inputs)
+    c64.read_input = lambda prompt: next(values)
+    return c64
+
+
+def samples(text):
+    """
+    Returns the samples in Prometheus text keyed by name and labels.
+    """
+    return {
+        line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+        for line in text.splitlines()
+        if line and not line.startswith("#")
+    }
+
+
+def test_run():
+    """
+    Test that runs count their cycles, halt reasons, durations and I/O and
+    leave their machines halted until they are reset into a pool.
+    """
+    metrics = chip64_metrics.Metrics()
+    pool = chip64_pool.Chip64Pool(chip64_fast_test.MULTIPLY, factory=chip64_fast.FastChip64)
+    metrics.watch_pool(pool)
+    c64 = machine()
+    result = metrics.run(c64, "fast")
+    assert result.outputs == ((42, 10),)
+    assert "read_input" in vars(c64)
+    metrics.run(machine(chip64.Chip64), "reference", num_of_cycles=10)
+    found = samples(metrics.text())
+    assert found['chip64_cycles_total{engine="fast"}'] == 393
+    assert found['chip64_cycles_total{engine="reference"}'] == 10
+    assert found['chip64_cycles_per_second{engine="fast"}'] > 0
+    assert found['chip64_runs_total{engine="fast",halt_reason="halted"}'] == 1
+    assert found['chip64_runs_total{engine="reference",halt_reason="cycle limit"}'] == 1
+    assert found['chip64_run_duration_seconds_bucket{engine="fast",le="+Inf"}'] == 1
+    assert found['chip64_run_duration_seconds_count{engine="fast"}'] == 1
+    assert found['chip64_io_operations_total{direction="input"}'] == 4
+    assert found['chip64_io_operations_total{direction="output"}'] == 1
+    assert found['chip64_machines{state="halted"}'] == 1
+    assert found['chip64_machines{state="parked"}'] == 0
+    pool.release(c64)
+    assert metrics.machines() == {"active": 0, "parked": 1, "halted": 0}
+
+
+def test_record_errors_and_cached_runs():
+    """
+    Test that failed runs count as errors and runs answered from a cache
+    count without their cycles.
+    """
+    metrics = chip64_metrics.Metrics()
+    metrics.record("fast", None, 0.5)
+    result = chip64_sink.run(machine())
+    metrics.record("fast", result, 0.001, executed=False, inputs=2)
+    found = samples(metrics.text())
+    assert found['chip64_runs_total{engine="fast",halt_reason="error"}'] == 1
+    assert found['chip64_runs_total{engine="fast",halt_reason="halted"}'] == 1
+    assert found['chip64_cycles_total{engine="fast"}'] == 0
+    assert found['chip64_run_duration_seconds_bucket{engine="fast",le="0.001"}'] == 1
+    assert found['chip64_run_duration_seconds_bucket{engine="fast",le="1.0"}'] == 2
+
+
+def test_caches():
+    """
+    Test that cache counters are taken from each source once, however often
+    and in whatever order they are reported.
+    """
+    cache = chip64_cache.MemoryCache()
+    for _ in range(3):
+        chip64_sink.run(machine(cache=cache))
+    assert (cache.hits, cache.misses) == (2, 1)
+    metrics = chip64_metrics.Metrics()
+    counters = chip64_metrics.cache_counters(cache)
+    assert set(counters) == {"decode", "compile"}
+    metrics.update_caches(1, counters)
+    metrics.update_caches(1, {"compile": (1, 1)})
+    metrics.update_caches(2, {"compile": (1, 0)})
+    found = samples(metrics.text())
+    assert found['chip64_cache_hits_total{cache="compile"}'] == 3
+    assert found['chip64_cache_misses_total{cache="compile"}'] == 1
+    assert found['chip64_cache_hit_ratio{cache="compile"}'] == 0.75
+
+
+def test_exporters(tmp_path):
+    """
+    Test that metrics are written to a file and served over HTTP.
+    """
+    metrics = chip64_metrics.Metrics()
+    path = tmp_path / "chip64.prom"
+    with chip64_metrics.FileExporter(metrics, str(path), interval=0.01):
+        metrics.run(machine())
+    assert 'chip64_cycles_total{engine="FastChip64"} 393' in path.read_text()
+    assert [p.name for p in tmp_path.iterdir()] == ["chip64.prom"]
+    server = chip64_metrics.serve(metrics)
+    try:
+        url = "http://127.0.0.1:%d/metrics" % server.server_address[1]
+        with urllib.request.urlopen(url) as response:
+            assert response.headers["Content-Type"] == chip64_metrics.CONTENT_TYPE
+            assert response.read().decode() == metrics.text()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,467 @@
+"""
+An offline bytecode optimiser for Chip64 programs.
+optimise() reads a program and returns a semantically equivalent one that
+takes fewer cycles. Data stays where it is, each run of code is rewritten in
+place and jump targets are relocated to match. Small leaf subroutines are
+first inlined at their call sites, runs growing into the memory after them
+that the program never touches, and calls followed by a return become jumps.
+"""
+
+import chip64_cfg
+import chip64_decode as c64d
+import chip64_verify
+
+GOTO, CALL, RET, HALT = 0x1000, 0x2000, 0x01EE, 0x0000
+# The most instructions, RET excluded, of a subroutine inlined at its calls.
+INLINE_LIMIT = 8
+
+
+class Line:
+    """
+    One instruction of a program being optimised.
+    labels are the original addresses that now resolve to this line, target
+    is the original address a GOTO or CALL jumps to. table is the original
+    address of the jump table a BNNN dispatches into, and pinned marks the
+    GOTOs of jump tables, which must stay GOTOs and stay in place.
+    """
+
+    def __init__(self, address: int, opcode: int):
+        self.address = address
+        self.opcode = opcode
+        self.labels = [address]
+        self.deleted = False
+        self.target = opcode & 0xFFF if opcode >> 12 in (1, 2) else None
+        self.table = None
+        self.pinned = False
+
+    @property
+    def instruction(self) -> c64d.Instruction:
+        return c64d.decode(self.opcode, self.address)
+
+    def replace(self, opcode: int) -> None:
+        """
+        Replaces the instruction on this line, keeping its labels.
+        """
+        self.opcode = opcode
+        self.target = opcode & 0xFFF if opcode >> 12 in (1, 2) else None
+
+
+class Program:
+    """
+    A program split into runs of consecutive code, ready to be rewritten.
+    """
+
+    def __init__(self, memory, analysis: chip64_cfg.Analysis):
+        self.memory = memory
+        self.analysis = analysis
+        code = set(analysis.instructions)
+        for address, instruction in analysis.instructions.items():
+            if instruction.mnemonic in c64d.SKIPS:
+                code.add(address + 2)
+        self.runs = []
+        self.lines = {}
+        self.owner = {}
+        for address in sorted(code):
+            line = Line(address, c64d.fetch(memory, address))
+            if address - 2 not in code:
+                self.runs.append([])
+            self.runs[-1].append(line)
+            self.lines[address] = line
+            self.owner[address] = line
+        self.run_of = {
+            id(line): run for run in self.runs for line in run
+        }
+        self.ends = [run[-1].address + 2 for run in self.runs]
+        self.limits = list(self.ends)
+        self.top = 0
+        for address, table in analysis.jump_tables.items():
+            start = analysis.instructions[address].nnn
+            self.lines[address].table = start
+            for i in range(len(table)):
+                self.lines[start + 2 * i].pinned = True
+
+    def code_bytes(self) -> set:
+        """
+        Returns the byte addresses covered by the code runs.
+        """
+        return {line.address + i for line in self.lines.values() for i in (0, 1)}
+
+    def _neighbour(self, line: Line, step: int):
+        run = self.run_of[id(line)]
+        i = run.index(line) + step
+        while 0 <= i < len(run):
+            if not run[i].deleted:
+                return run[i]
+            i += step
+        return None
+
+    def next_line(self, line: Line):
+        """
+        Returns the line that will follow line once deleted lines are dropped.
+        """
+        return self._neighbour(line, 1)
+
+    def previous_line(self, line: Line):
+        """
+        Returns the line that will precede line once deleted lines are dropped.
+        """
+        return self._neighbour(line, -1)
+
+    def after_skip(self, line: Line) -> bool:
+        """
+        Returns True if line directly follows a skip, such lines cannot be
+        removed without changing what the skip jumps over.
+        """
+        previous = self.previous_line(line)
+        return previous is not None and previous.instruction.mnemonic in c64d.SKIPS
+
+    def delete(self, line: Line, count: int = 1) -> bool:
+        """
+        Deletes line and the count - 1 lines after it, moving their labels on
+        to the next line. Returns False if that would change what a skip jumps
+        over or leave nothing for the labels to move to.
+        """
+        doomed = [line]
+        while len(doomed) < count:
+            nxt = self.next_line(doomed[-1])
+            if nxt is None:
+                return False
+            doomed.append(nxt)
+        successor = self.next_line(doomed[-1])
+        if successor is None or self.after_skip(line):
+            return False
+        for dead in doomed:
+            dead.deleted = True
+            for label in dead.labels:
+                self.owner[label] = successor
+            successor.labels += dead.labels
+            dead.labels = []
+        return True
+
+    def insert_after(self, line: Line, opcode: int) -> Line:
+        """
+        Inserts a new line with no labels after line and returns it.
+        """
+        run = self.run_of[id(line)]
+        new = Line(line.address, opcode)
+        new.labels = []
+        run.insert(run.index(line) + 1, new)
+        self.run_of[id(new)] = run
+        return new
+
+    def grow(self, accessed: set) -> None:
+        """
+        Lets each run grow into the bytes after it up to the next run or
+        the first byte in accessed, the data the program reads and writes.
+        """
+        starts = [run[0].address for run in self.runs[1:]] + [chip64_cfg.MEMORY_SIZE]
+        for i, (end, start) in enumerate(zip(self.ends, starts)):
+            limit = end
+            while limit + 2 <= start and not accessed & {limit, limit + 1}:
+                limit += 2
+            self.limits[i] = limit
+
+    def room(self, line: Line) -> int:
+        """
+        Returns how many lines can still be inserted in the run of line.
+        """
+        i = next(i for i, run in enumerate(self.runs) if run is self.run_of[id(line)])
+        used = sum(not other.deleted for other in self.runs[i])
+        return (self.limits[i] - self.runs[i][0].address) // 2 - used
+
+    def resolve(self, label: int) -> Line:
+        """
+        Returns the line a jump to label arrives at, following chains of GOTOs.
+        """
+        line, seen = self.owner[label], set()
+        while line.opcode >> 12 == 1 and id(line) not in seen:
+            seen.add(id(line))
+            line = self.owner[line.target]
+        return line
+
+    def assemble(self) -> list:
+        """
+        Lays each run out from its original start and returns the new memory
+        image, jump targets relocated and freed bytes set to HALT.
+        """
+        address_of = {}
+        for run in self.runs:
+            address = run[0].address
+            for line in run:
+                if not line.deleted:
+                    for label in line.labels:
+                        address_of[label] = address
+                    address += 2
+        image = [int(byte) for byte in self.memory]
+        image += [0] * (chip64_cfg.MEMORY_SIZE - len(image))
+        for run, end in zip(self.runs, self.ends):
+            address = run[0].address
+            for line in run:
+                if line.deleted:
+                    continue
+                opcode = line.opcode
+                if line.target is not None:
+                    opcode = (opcode & 0xF000) | address_of[line.target]
+                elif line.table is not None:
+                    opcode = (opcode & 0xF000) | address_of[line.table]
+                image[address], image[address + 1] = opcode >> 8, opcode & 0xFF
+                address += 2
+            self.top = max(self.top, address)
+            if address < end:
+                image[address:end] = [0] * (end - address)
+        return image
+
+
+def _fold(program: Program) -> None:
+    """
+    Rewrites instructions whose result is a known constant, removes those that
+    change nothing and resolves skips whose outcome is known.
+    """
+    analysis = program.analysis
+    for address, state in analysis.states.items():
+        line = program.lines[address]
+        instruction = line.instruction
+        m, x, y = instruction.mnemonic, instruction.x, instruction.y
+        after = chip64_cfg.transfer(instruction, state)
+        if m in ("ACR", "ADCR", "AR", "OR", "AND", "XOR"):
+            unchanged = (
+                (m == "ADCR" and instruction.nn == 0)
+                or (m in ("AR", "OR", "AND") and x == y)
+                or (after[x] is not None and after[x] == state[x])
+            )
+            if unchanged:
+                program.delete(line)
+            elif m != "ACR" and after[x] is not None and after[x] <= 0xFF:
+                line.replace(0x6000 | (x << 8) | after[x])
+        elif m == "SMP" and state[chip64_cfg.MP] == instruction.nnn:
+            program.delete(line)
+        elif m == "CPAC" and state[0] is not None:
+            line.replace(GOTO | ((state[0] + instruction.nnn) & 0xFFF))
+        elif m in c64d.SKIPS:
+            taken = chip64_cfg.skip_taken(instruction, state)
+            if taken is False:
+                program.delete(line)
+            elif taken is True and address + 2 not in analysis.instructions:
+                program.delete(line, 2)
+
+
+def _live(program: Program, live_at_halt: int) -> dict:
+    """
+    Returns the locations live after each reachable line.
+    """
+    analysis = program.analysis
+    effects = {}
+    for address in analysis.instructions:
+        line = program.lines[address]
+        if line.deleted:
+            effects[address] = (0, 0)
+        elif line.opcode == HALT:
+            effects[address] = (live_at_halt, 0)
+        else:
+            effects[address] = chip64_cfg.uses_and_defs(line.instruction)
+    live_in = dict.fromkeys(analysis.instructions, 0)
+    live_out = dict.fromkeys(analysis.instructions, 0)
+    changed = True
+    while changed:
+        changed = False
+        for address in sorted(analysis.instructions, reverse=True):
+            out = 0
+            for successor in analysis.successors[address]:
+                out |= live_in.get(successor, 0)
+            uses, defs = effects[address]
+            inn = uses | (out & ~defs)
+            if inn != live_in[address] or out != live_out[address]:
+                live_in[address], live_out[address] = inn, out
+                changed = True
+    return live_out
+
+
+def _eliminate(program: Program, live_at_halt: int) -> bool:
+    """
+    Removes instructions whose results are never read and drops flag
+    computations nobody reads. Returns True if anything changed.
+    """
+    live_out = _live(program, live_at_halt)
+    changed = False
+    for address, out in live_out.items():
+        line = program.lines[address]
+        if line.deleted:
+            continue
+        instruction = line.instruction
+        m, x, y = instruction.mnemonic, instruction.x, instruction.y
+        if m not in chip64_cfg.PURE:
+            continue
+        _, defs = chip64_cfg.uses_and_defs(instruction)
+        if not defs & out:
+            changed |= program.delete(line)
+            continue
+        flag_dead = not out & (1 << 15)
+        if m == "ADD" and flag_dead and 15 not in (x, y) and x != y:
+            state = program.analysis.states[address]
+            after = chip64_cfg.transfer(instruction, state)
+            if after[x] is not None and after[x] <= 0xFF:
+                line.replace(0x6000 | (x << 8) | after[x])
+                changed = True
+            elif state[y] is not None and state[y] <= 0xFF:
+                line.replace(0x7000 | (x << 8) | state[y])
+                changed = True
+    return changed
+
+
+def _thread_jumps(program: Program) -> bool:
+    """
+    Retargets jumps that land on other jumps, turns jumps to RET or HALT into
+    the instruction itself and removes jumps to the next instruction. Jump
+    table entries are only retargeted. Returns True if anything changed.
+    """
+    changed = False
+    for line in program.lines.values():
+        if line.deleted or line.target is None:
+            continue
+        final = program.resolve(line.target)
+        if line.opcode >> 12 == 1 and final.opcode in (RET, HALT) and not line.pinned:
+            line.replace(final.opcode)
+            changed = True
+        elif final is not program.owner[line.target]:
+            line.replace((line.opcode & 0xF000) | final.address)
+            changed = True
+        if line.pinned:
+            continue
+        if line.opcode >> 12 == 1 and program.next_line(line) is program.owner[line.target]:
+            changed |= program.delete(line)
+    return changed
+
+
+def _prune(program: Program) -> None:
+    """
+    Deletes lines that can no longer be reached from the entry point.
+    Jumps to addresses the analysis never reached can only sit in the slot
+    of a skip always taken, they are never run and become HALTs.
+    """
+    reached, worklist = set(), [program.owner[program.analysis.entry]]
+    while worklist:
+        line = worklist.pop()
+        if line is None or id(line) in reached:
+            continue
+        reached.add(id(line))
+        if line.target is not None and line.target not in program.owner:
+            line.replace(HALT)
+        m = line.instruction.mnemonic
+        following = program.next_line(line)
+        if m == "GOTO":
+            worklist.append(program.owner[line.target])
+        elif m == "CALL":
+            worklist += [program.owner[line.target], following]
+        elif m == "CPAC":
+            worklist += [
+                program.owner[a] for a in program.analysis.successors[line.address]
+            ]
+        elif m in c64d.SKIPS:
+            worklist += [following, program.next_line(following)]
+        elif m not in ("RET", "HALT"):
+            worklist.append(following)
+    for line in program.lines.values():
+        if id(line) not in reached:
+            line.deleted = True
+
+
+def _body(program: Program, address: int, limit: int):
+    """
+    Returns the lines of the subroutine at address up to its RET if it is a
+    leaf of at most limit straight line instructions, or None. Skips may
+    only jump over instructions of the body itself.
+    """
+    body, line = [], program.owner[address]
+    while line is not None and line.opcode != RET:
+        m = line.instruction.mnemonic
+        if m in c64d.JUMPS or m == "HOST" or len(body) == limit:
+            return None
+        body.append(line)
+        line = program.next_line(line)
+    if line is None or (body and body[-1].instruction.mnemonic in c64d.SKIPS):
+        return None
+    return body
+
+
+def _inline(program: Program, limit: int) -> bool:
+    """
+    Replaces calls of small leaf subroutines with copies of their bodies
+    where their run has room, and calls followed by a RET with jumps.
+    Returns True if anything changed.
+    """
+    changed = False
+    for address in sorted(program.analysis.instructions):
+        line = program.lines[address]
+        if line.opcode >> 12 != 2:
+            continue
+        body = _body(program, line.target, limit)
+        if (
+            body is not None
+            and not program.after_skip(line)
+            and len(body) - 1 <= program.room(line)
+        ):
+            if not body:
+                changed |= program.delete(line)
+                continue
+            line.replace(body[0].opcode)
+            last = line
+            for other in body[1:]:
+                last = program.insert_after(last, other.opcode)
+            changed = True
+        else:
+            following = program.next_line(line)
+            if following is not None and following.opcode == RET:
+                line.replace(GOTO | line.target)
+                changed = True
+    return changed
+
+
+def optimise(code, live_at_halt=None, assume_reset: bool = False,
+             inline_limit: int = INLINE_LIMIT) -> list:
+    """
+    Returns an optimised copy of the program in code as a list of bytes.
+    live_at_halt lists the registers (and chip64_cfg.MP for memory_ptr) whose
+    values matter when the program halts, by default all of them.
+    If assume_reset is True the program may rely on the registers being zero
+    at start up, as they are on a freshly constructed Chip64.
+    Subroutines of at most inline_limit instructions that call nothing are
+    inlined, 0 turning this off, and a call followed by a RET becomes a jump,
+    so the call stack may be shallower when a program halts.
+    Raises chip64_verify.VerificationError for programs that fail
+    verification or that read their own code as data.
+    """
+    memory = list(code) + [0] * (chip64_cfg.MEMORY_SIZE - len(code))
+    state = chip64_cfg.reset_state() if assume_reset else chip64_cfg.unknown_state()
+    top = len(code)
+    changed = True
+    while changed:
+        analysis = chip64_verify.check(memory, state=state)
+        program = Program(memory, analysis)
+        code_bytes = program.code_bytes()
+        accessed = set()
+        for address, ranges in analysis.accesses.items():
+            for low, high in ranges:
+                accessed.update(range(low, high))
+                if not code_bytes.isdisjoint(range(low, high)):
+                    raise chip64_verify.VerificationError(
+                        [(address, "reads code as data, code cannot be relocated")]
+                    )
+        if not any(i.mnemonic == "HOST" for i in analysis.instructions.values()):
+            # Host functions may read any memory, so runs only grow without them.
+            program.grow(accessed)
+        changed = _inline(program, inline_limit)
+        if changed:
+            _prune(program)
+            memory = program.assemble()
+            top = max(top, program.top)
+    if live_at_halt is None:
+        live_mask = chip64_cfg.ALL_LOCATIONS
+    else:
+        live_mask = sum(1 << location for location in set(live_at_halt))
+    _fold(program)
+    while _eliminate(program, live_mask) | _thread_jumps(program):
+        pass
+    _prune(program)
+    image = program.assemble()
+    end = max(top, max(program.lines) + 2)
+    return image[:end]
@@ -0,0 +1,214 @@
+import chip64
+import chip64_opt
+import chip64_test
+import chip64_util as c64u
+import chip64_verify
+import pytest
+import unittest.mock
+
+# The shift and add multiply from c_mul.py followed by a HALT.
+MULTIPLY = [
+    0xF0, 0x01, 0xF1, 0x01, 0x62, 0x00, 0x63, 0x00,
+    0x43, 0x40, 0x10, 0x18, 0x80, 0x16, 0x3F, 0x00,
+    0x82, 0x14, 0x81, 0x1E, 0x73, 0x01, 0x10, 0x08,
+    0xD2, 0x01, 0x00, 0x00,
+]
+
+# Adds r0:r1 to r5:r4 ten times through a helper library of one line
+# subroutines and outputs the 128 bit sum.
+HELPERS = [
+    0xF0, 0x01, 0xF1, 0x01, 0x64, 0x00, 0x65, 0x00,
+    0x63, 0x00, 0x20, 0x16, 0x20, 0x1C, 0x33, 0x0A,
+    0x10, 0x0A, 0x20, 0x20, 0x00, 0x00, 0x84, 0x04,
+    0x85, 0x18, 0x01, 0xEE, 0x73, 0x01, 0x01, 0xEE,
+    0xD4, 0x01, 0xD5, 0x01, 0x01, 0xEE,
+]
+
+
+def run(code, inputs=()):
+    """
+    Runs code on Chip64 and returns the machine, its outputs and cycle count.
+    """
+    c64u.console_input = unittest.mock.MagicMock(side_effect=list(inputs))
+    c64u.console_output = unittest.mock.MagicMock()
+    c64 = chip64.Chip64(code)
+    cycles = 0
+    while c64.memory[c64.code_ptr] or c64.memory[c64.code_ptr + 1]:
+        c64.execute(1)
+        cycles += 1
+    return c64, c64u.console_output.call_args_list, cycles
+
+
+def test_optimise_constant_propagation():
+    """
+    Test that constants are propagated through ACR and ADCR and that the
+    intermediate writes are removed once dead.
+    """
+    code = [0x60, 0x05, 0x70, 0x03, 0x81, 0x00, 0xD1, 0x01, 0x00, 0x00]
+    optimised = chip64_opt.optimise(code, live_at_halt=[1])
+    assert optimised[:4] == [0x61, 0x08, 0xD1, 0x01]
+    assert run(optimised)[1] == run(code)[1]
+
+
+def test_optimise_keeps_registers_live_at_halt():
+    """
+    Test that by default every register is considered observable at HALT.
+    """
+    code = [0x60, 0x05, 0x70, 0x03, 0x81, 0x00, 0x00, 0x00]
+    optimised = chip64_opt.optimise(code)
+    assert optimised[:6] == [0x60, 0x08, 0x61, 0x08, 0x00, 0x00]
+    assert run(optimised)[0].registers == run(code)[0].registers
+
+
+def test_optimise_drops_unread_flags():
+    """
+    Test that an ADD of a known small value whose carry is never read becomes
+    an ADCR.
+    """
+    code = [0xF0, 0x01, 0x61, 0x07, 0x80, 0x14, 0xD0, 0x01, 0x00, 0x00]
+    optimised = chip64_opt.optimise(code, live_at_halt=[])
+    assert optimised[:6] == [0xF0, 0x01, 0x70, 0x07, 0xD0, 0x01]
+    assert run(optimised, ["5"])[1] == run(code, ["5"])[1]
+
+
+def test_optimise_threads_jumps():
+    """
+    Test that GOTO chains are collapsed, jumps to the next instruction are
+    removed and the code left unreachable is cleared.
+    """
+    code = [
+        0x10, 0x06, 0x00, 0x00, 0x00, 0x00,
+        0x10, 0x0A, 0x00, 0x00,
+        0xD0, 0x01, 0x10, 0x10, 0x00, 0x00,
+        0x10, 0x0E,
+    ]
+    optimised = chip64_opt.optimise(code)
+    assert optimised[:4] == [0x10, 0x0A, 0x00, 0x00]
+    assert optimised[0x0A:0x0E] == [0xD0, 0x01, 0x00, 0x00]
+    assert optimised[6:8] == [0x00, 0x00]
+
+
+def test_optimise_resolves_known_skips():
+    """
+    Test that skips whose outcome is known are removed along with the
+    instruction they always skip.
+    """
+    code = [0x60, 0x01, 0x30, 0x01, 0x61, 0x02, 0xD0, 0x01, 0x00, 0x00]
+    optimised = chip64_opt.optimise(code)
+    assert optimised[:6] == [0x60, 0x01, 0xD0, 0x01, 0x00, 0x00]
+
+
+def test_optimise_relocates_jumps_and_keeps_data():
+    """
+    Test that jumps are relocated when code shrinks and that data keeps its
+    address. Inlining is turned off to keep the call.
+    """
+    code = [
+        0x10, 0x0A, 0x00, 0x00, 0x00, 0x00, 0x00, 0x3D, 0x09, 0x00,
+        0x61, 0x00, 0x61, 0x00, 0xA0, 0x02, 0xE0, 0x65, 0x20, 0x18,
+        0xD0, 0x01, 0x00, 0x00, 0x70, 0x01, 0x01, 0xEE,
+    ]
+    optimised = chip64_opt.optimise(code, live_at_halt=[], inline_limit=0)
+    assert optimised[2:10] == code[2:10]
+    assert optimised[0x0A:0x18] == [
+        0xA0, 0x02, 0xE0, 0x65, 0x20, 0x14, 0xD0, 0x01,
+        0x00, 0x00, 0x70, 0x01, 0x01, 0xEE,
+    ]
+    assert run(optimised)[1] == run(code)[1] == [unittest.mock.call("4000001")]
+
+
+def test_optimise_multiply():
+    """
+    Test that the multiply loop still works and takes no more cycles.
+    """
+    optimised = chip64_opt.optimise(MULTIPLY, live_at_halt=[])
+    before, after = run(MULTIPLY, ["1234", "5678"]), run(optimised, ["1234", "5678"])
+    assert after[1] == before[1]
+    assert after[2] <= before[2]
+
+
+def test_optimise_inlines_subroutines():
+    """
+    Test that small leaf subroutines are inlined at their calls, and only
+    where their run has room to grow without overwriting data.
+    """
+    optimised = chip64_opt.optimise(HELPERS, live_at_halt=[])
+    assert chip64_verify.verify(optimised) == []
+    assert not any(byte >> 4 == 2 for byte in optimised[0:len(optimised):2])
+    for inputs in (["7", "9"], ["18446744073709551615", "3"]):
+        before, after = run(HELPERS, inputs), run(optimised, inputs)
+        assert after[1] == before[1]
+        assert after[2] < before[2] * 0.6
+    # The subroutine's run ends where the data LOAD reads begins.
+    code = [
+        0xA0, 0x0E, 0xE0, 0x65, 0x20, 0x08, 0x00, 0x00,
+        0x61, 0x01, 0x71, 0x02, 0x01, 0xEE, 0x12, 0x34,
+    ]
+    optimised = chip64_opt.optimise(code, live_at_halt=[0, 1])
+    assert optimised[4:6] == [0x20, 0x08]
+    assert optimised[0x0E:0x10] == [0x12, 0x34]
+    assert run(optimised)[0].registers == run(code)[0].registers
+
+
+def test_optimise_tail_calls():
+    """
+    Test that a call followed by a RET becomes a jump, here one to the next
+    instruction once the RET is unreachable, which is then removed.
+    """
+    code = [
+        0x20, 0x06, 0xD0, 0x01, 0x00, 0x00, 0x60, 0x00, 0x20, 0x0C,
+        0x01, 0xEE, 0x70, 0x01, 0x40, 0x05, 0x01, 0xEE, 0x10, 0x0C,
+    ]
+    optimised = chip64_opt.optimise(code)
+    assert optimised[6:10] == [0x60, 0x00, 0x70, 0x01]
+    before, after = run(code), run(optimised)
+    assert after[1] == before[1] == [unittest.mock.call("5")]
+    assert after[2] < before[2]
+
+
+def test_optimise_unreachable_skipped_jump():
+    """
+    Test that a jump in the slot of a skip that is always taken, to code
+    that is never reached, does not stop a program being optimised.
+    """
+    # chip64_fuzz.generate(random.Random(840), tables=False, host_calls=False),
+    # the SNUEC at $00E is always taken from reset and the GOTO $024 after it never runs.
+    code = [
+        0x7D, 0xEB, 0xAB, 0xD8, 0xE6, 0xA4, 0x70, 0x5B,
+        0x20, 0x34, 0xA9, 0x30, 0xE1, 0xA4, 0x4E, 0xA4,
+        0x10, 0x24, 0x20, 0x34, 0x6D, 0x55, 0x6C, 0xF0,
+        0x85, 0xF7, 0x65, 0x0C, 0x95, 0x80, 0x87, 0x2E,
+        0x10, 0x26, 0x20, 0x34, 0x10, 0x0A, 0x47, 0xDC,
+        0x83, 0x99, 0xAC, 0xF0, 0xE3, 0xA5, 0xAA, 0xC0,
+        0xE4, 0xA5, 0x00, 0x00, 0x76, 0xC3, 0x01, 0xEE,
+        0x00, 0x00,
+    ]
+    optimised = chip64_opt.optimise(code, assume_reset=True)
+    assert chip64_verify.verify(optimised) == []
+    inputs = [str(i) for i in range(8)]
+    before, after = run(code, inputs), run(optimised, inputs)
+    assert after[1] == before[1]
+    assert list(after[0].registers) == list(before[0].registers)
+
+
+def test_optimise_keeps_jump_tables():
+    """
+    Test that a jump table moves as a whole with its computed jump
+    retargeted, and that its entries stay GOTOs even when they jump to the
+    next instruction.
+    """
+    code = chip64_test.DISPATCH
+    optimised = chip64_opt.optimise(code, live_at_halt=[2])
+    assert optimised[0x14:0x1E] == [0xB0, 0x16, 0x10, 0x28, 0x10, 0x2C, 0x10, 0x30, 0x10, 0x1E]
+    assert chip64_verify.verify(optimised) == []
+    for steps in ("0", "5", "40"):
+        assert run(optimised, [steps])[1] == run(code, [steps])[1]
+        assert run(optimised, [steps])[2] < run(code, [steps])[2] or steps == "0"
+
+
+def test_optimise_rejects_code_read_as_data():
+    """
+    Test that a program reading its own code is refused.
+    """
+    with pytest.raises(chip64_verify.VerificationError):
+        chip64_opt.optimise([0xA0, 0x00, 0xE0, 0x65, 0x00, 0x00])
@@ -0,0 +1,72 @@
+"""
+A pool of warm Chip64 machines for harnesses that run the same program many
+times over.
+"""
+
+import contextlib
+import chip64
+import random
+
+
+# Methods users override on a machine to supply its inputs, outputs and
+# random bytes.
+IO_METHODS = ("read_input", "write_output", "random_byte")
+
+
+class Chip64Pool:
+    """
+    Hands out ready-to-run Chip64 objects for a single program.
+    Machines are reset, have their program reloaded, lose the hooks,
+    breakpoints, watchpoints, host functions and I/O overrides added to them
+    and get a fresh rng when they are returned to the pool, so acquire() never has to construct or clear
+    anything unless the pool has run dry.
+    """
+
+    def __init__(self, code=[], size=0, factory=chip64.Chip64):
+        """
+        Creates a pool for code, preallocating size machines.
+        factory is the class used to build machines, any Chip64 subclass
+        taking the program as its only argument will do.
+        """
+        self.code = list(code)
+        self.factory = factory
+        self._idle = [factory(self.code) for _ in range(size)]
+
+    def __len__(self) -> int:
+        """
+        Returns the number of idle machines held by the pool.
+        """
+        return len(self._idle)
+
+    def acquire(self) -> chip64.Chip64:
+        """
+        Returns a machine in its power on state with the program loaded.
+        """
+        try:
+            return self._idle.pop()
+        except IndexError:
+            return self.factory(self.code)
+
+    def release(self, c64: chip64.Chip64) -> None:
+        """
+        Resets c64, reloads the program, removes what the last user added to
+        it, gives it a fresh unseeded rng and returns it to the pool.
+        """
+        c64.reset(reload_program=True)
+        c64.remove_observers()
+        c64.host_functions.clear()
+        for name in IO_METHODS:
+            vars(c64).pop(name, None)
+        c64.rng = random.Random()
+        self._idle.append(c64)
+
+    @contextlib.contextmanager
+    def machine(self):
+        """
+        Context manager that acquires a machine and releases it on exit.
+        """
+        c64 = self.acquire()
+        try:
+            yield c64
+        finally:
+            self.release(c64)
@@ -0,0 +1,87 @@
+import chip64
+import chip64_pool
+import numpy as np
+import random
+
+
+def test_pool_preallocates():
+    """
+    Test that the pool builds size machines up front.
+    """
+    pool = chip64_pool.Chip64Pool([0x60, 0x01], size=3)
+    assert len(pool) == 3
+
+
+def test_pool_acquire_creates_when_empty():
+    """
+    Test that acquire() builds a new machine with the program loaded when the
+    pool has no idle machines.
+    """
+    pool = chip64_pool.Chip64Pool([0x60, 0x01])
+    c64 = pool.acquire()
+    assert isinstance(c64, chip64.Chip64)
+    assert c64.memory[:2] == [0x60, 0x01]
+    assert len(pool) == 0
+
+
+def test_pool_release_reloads_program():
+    """
+    Test that a released machine comes back reset with its program reloaded.
+    """
+    pool = chip64_pool.Chip64Pool([0x60, 0x2A, 0x00, 0x00])
+    with pool.machine() as c64:
+        c64.execute()
+        assert c64.registers[0] == 0x2A
+        c64.memory[0] = np.uint8(0)
+    assert len(pool) == 1
+
+    c64 = pool.acquire()
+    assert c64.registers[0] == 0
+    assert c64.code_ptr == 0
+    assert c64.memory[:2] == [0x60, 0x2A]
+    c64.execute()
+    assert c64.registers[0] == 0x2A
+
+
+def test_pool_release_removes_observers():
+    """
+    Test that hooks, breakpoints, watchpoints and host functions added by one
+    user of a machine are gone when the next one acquires it.
+    """
+    # Sets register 0, calls host function 5 and halts.
+    pool = chip64_pool.Chip64Pool([0x60, 0x2A, 0x00, 0x05, 0x00, 0x00])
+    calls = []
+    with pool.machine() as c64:
+        c64.add_hook("instruction", lambda *args: calls.append(args))
+        c64.add_breakpoint(0x004)
+        c64.add_watchpoint(0x000, 0x100)
+        c64.register_host_function(5, lambda registers, memory: calls.append(5))
+
+    c64 = pool.acquire()
+    c64.execute()
+    assert c64.halt_reason == chip64.HALTED
+    assert c64.registers[0] == 0x2A
+    assert c64.host_functions == {}
+    assert calls == []
+
+
+def test_pool_release_removes_io_overrides():
+    """
+    Test that I/O overrides set on a machine are gone and its rng is no
+    longer the seeded one when the next user acquires it.
+    """
+    pool = chip64_pool.Chip64Pool([0xC0, 0xFF, 0x00, 0x00])
+    with pool.machine() as c64:
+        c64.read_input = lambda prompt: "1"
+        c64.write_output = lambda value, base: None
+        c64.random_byte = lambda: 7
+        c64.rng.seed(1)
+        seeded = c64.rng
+
+    c64 = pool.acquire()
+    for name in chip64_pool.IO_METHODS:
+        assert name not in vars(c64)
+    assert c64.rng is not seeded
+    c64.rng.seed(2)
+    c64.execute()
+    assert c64.registers[0] == random.Random(2).randint(0, 255)
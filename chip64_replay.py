@@ -0,0 +1,243 @@
+"""
+Record and replay of Chip64 runs.
+A Recorder logs every input line and random byte a machine consumes, stamped
+with the cycle it was consumed on, and checkpoints the machine's state every
+interval cycles. The resulting Recording replays the run exactly on any
+Chip64 engine, and seek() reaches any cycle by restoring the nearest
+checkpoint and running forward from there.
+"""
+
+import collections
+import pickle
+import zlib
+import numpy as np
+import chip64
+
+DEFAULT_INTERVAL = 100000
+
+# One consumed input line or random byte, kind is "input" or "random".
+Event = collections.namedtuple("Event", ["cycle", "kind", "value"])
+# A machine's state before cycle runs, event is the index of the first event
+# not yet consumed. memory is zlib compressed.
+Checkpoint = collections.namedtuple(
+    "Checkpoint",
+    ["cycle", "event", "code_ptr", "memory_ptr", "registers", "stack", "memory"],
+)
+
+
+class ReplayError(Exception):
+    """
+    Raised when a replayed run does not follow its recording.
+    """
+
+
+def checkpoint(c64: chip64.Chip64, cycle: int, event: int) -> Checkpoint:
+    """
+    Returns a checkpoint of c64's state.
+    """
+    return Checkpoint(
+        cycle,
+        event,
+        int(c64.code_ptr),
+        int(c64.memory_ptr),
+        tuple(int(value) for value in c64.registers),
+        tuple(int(address) for address in c64.stack),
+        zlib.compress(bytes(bytearray(c64.memory))),
+    )
+
+
+def restore(c64: chip64.Chip64, point: Checkpoint) -> None:
+    """
+    Puts c64 in the state saved in a checkpoint.
+    """
+    c64.memory[:] = [np.uint8(byte) for byte in zlib.decompress(point.memory)]
+    c64.registers[:] = [np.uint64(value) for value in point.registers]
+    c64.stack[:] = list(point.stack)
+    c64.code_ptr = point.code_ptr
+    c64.memory_ptr = point.memory_ptr
+
+
+class Recording:
+    """
+    The log of a recorded run.
+    events lists the Events in the order they were consumed, checkpoints the
+    Checkpoints in cycle order, starting with one at cycle 0. cycles is the
+    number of cycles recorded, halted is True if the run ended on a HALT and
+    final is a checkpoint of the state it ended in.
+    """
+
+    def __init__(self, interval: int = DEFAULT_INTERVAL):
+        self.interval = interval
+        self.events = []
+        self.checkpoints = []
+        self.cycles = 0
+        self.halted = False
+        self.final = None
+
+    def save(self, path: str) -> None:
+        """
+        Writes the recording to a file.
+        """
+        with open(path, "wb") as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path: str) -> "Recording":
+        """
+        Reads a recording written by save().
+        """
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    def nearest(self, cycle: int) -> Checkpoint:
+        """
+        Returns the last checkpoint taken at or before cycle.
+        """
+        low, high = 0, len(self.checkpoints)
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self.checkpoints[middle].cycle <= cycle:
+                low = middle
+            else:
+                high = middle
+        return self.checkpoints[low]
+
+
+class Recorder:
+    """
+    Runs a machine one instruction at a time and records the run.
+    run() may be called repeatedly to extend the recording. Input and random
+    bytes come from the machine's own read_input() and random_byte(),
+    including any set on the machine itself, which are left in place.
+    """
+
+    def __init__(self, c64: chip64.Chip64, interval: int = DEFAULT_INTERVAL):
+        self.machine = c64
+        self.recording = Recording(interval)
+        self.recording.checkpoints.append(checkpoint(c64, 0, 0))
+        self.recording.final = self.recording.checkpoints[0]
+        self._sources = {}
+
+    def _read_input(self, prompt: str):
+        value = self._sources["read_input"](prompt)
+        self.recording.events.append(Event(self.recording.cycles, "input", value))
+        return value
+
+    def _random_byte(self) -> int:
+        value = self._sources["random_byte"]()
+        self.recording.events.append(Event(self.recording.cycles, "random", value))
+        return value
+
+    def run(self, num_of_cycles=None) -> Recording:
+        """
+        Runs the machine until it halts, reaches a jump to itself or
+        num_of_cycles cycles have passed and returns the recording so far.
+        The machine's halt_reason and loop_address are set as execute()
+        would set them.
+        """
+        c64, recording = self.machine, self.recording
+        hooks = {"read_input": self._read_input, "random_byte": self._random_byte}
+        overrides = {name: vars(c64)[name] for name in hooks if name in vars(c64)}
+        self._sources = {name: getattr(c64, name) for name in hooks}
+        for name, hook in hooks.items():
+            setattr(c64, name, hook)
+        c64.halt_reason = c64.loop_address = c64.stop_address = None
+        end = None if num_of_cycles is None else recording.cycles + num_of_cycles
+        try:
+            while end is None or recording.cycles < end:
+                cycle = recording.cycles
+                due = cycle % recording.interval == 0
+                if due and cycle != recording.checkpoints[-1].cycle:
+                    recording.checkpoints.append(
+                        checkpoint(c64, cycle, len(recording.events))
+                    )
+                pc, depth = int(c64.code_ptr), len(c64.stack)
+                if not c64.step():
+                    recording.halted = True
+                    c64.halt_reason = chip64.HALTED
+                    break
+                recording.cycles += 1
+                if c64.code_ptr == pc and len(c64.stack) == depth:
+                    c64.halt_reason = chip64.NON_TERMINATING
+                    c64.loop_address = pc
+                    break
+            else:
+                c64.halt_reason = chip64.CYCLE_LIMIT
+        finally:
+            for name in hooks:
+                if name in overrides:
+                    setattr(c64, name, overrides[name])
+                else:
+                    delattr(c64, name)
+            recording.final = checkpoint(c64, recording.cycles, len(recording.events))
+        return recording
+
+
+class _Feed:
+    """
+    Hands a machine the events of a recording in order.
+    """
+
+    def __init__(self, events: list, start: int):
+        self.events = events
+        self.next = start
+
+    def _take(self, kind: str):
+        if self.next >= len(self.events):
+            raise ReplayError("the run consumed more events than were recorded")
+        event = self.events[self.next]
+        if event.kind != kind:
+            raise ReplayError(
+                "expected %s on cycle %d, the run asked for %s"
+                % (event.kind, event.cycle, kind)
+            )
+        self.next += 1
+        return event.value
+
+    def read_input(self, prompt: str):
+        return self._take("input")
+
+    def random_byte(self) -> int:
+        return self._take("random")
+
+
+def _machine(recording: Recording, point: Checkpoint, factory):
+    """
+    Returns a machine in the state of point that draws its input and random
+    bytes from the recording.
+    """
+    c64 = factory([])
+    restore(c64, point)
+    feed = _Feed(recording.events, point.event)
+    c64.read_input = feed.read_input
+    c64.random_byte = feed.random_byte
+    return c64, feed
+
+
+def seek(recording: Recording, cycle: int, factory=chip64.Chip64) -> chip64.Chip64:
+    """
+    Returns a machine built by factory in the state the recorded run was in
+    before cycle, or at the end of the run if cycle is past it.
+    The machine goes on drawing its input and random bytes from the
+    recording if it is executed further.
+    """
+    cycle = min(cycle, recording.cycles)
+    point = recording.nearest(cycle)
+    c64, _ = _machine(recording, point, factory)
+    if cycle > point.cycle:
+        c64.execute(cycle - point.cycle)
+    return c64
+
+
+def replay(recording: Recording, factory=chip64.Chip64, start: int = 0) -> chip64.Chip64:
+    """
+    Replays a recording from its last checkpoint at or before cycle start to
+    the end, raising ReplayError if the run does not end in the recorded
+    state.
+    """
+    point = recording.nearest(start)
+    c64, feed = _machine(recording, point, factory)
+    c64.execute(recording.cycles - point.cycle)
+    if checkpoint(c64, recording.cycles, feed.next) != recording.final:
+        raise ReplayError("the replayed run did not end in the recorded state")
+    return c64
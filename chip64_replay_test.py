@@ -0,0 +1,148 @@
+import chip64
+import chip64_fast
+import chip64_fast_test
+import chip64_replay
+import chip64_tiered
+import chip64_util as c64u
+import pytest
+import unittest.mock
+
+# Reads a count, then adds that many random bytes into r1 and prints it.
+RANDOM_SUM = [
+    0xF2, 0x01, 0x63, 0x00, 0x93, 0x20, 0x10, 0x10,
+    0xC4, 0xFF, 0x81, 0x44, 0x73, 0x01, 0x10, 0x04,
+    0xD1, 0x01, 0x00, 0x00,
+]
+
+
+def record(code, inputs, interval=10, num_of_cycles=None, seed=None):
+    """
+    Records a run of code on a machine whose random numbers are seeded with
+    seed and returns the recording and the machine.
+    """
+    c64u.console_input = unittest.mock.MagicMock(side_effect=list(inputs))
+    c64u.console_output = unittest.mock.MagicMock()
+    c64 = chip64.Chip64(code)
+    c64.rng.seed(seed)
+    recording = chip64_replay.Recorder(c64, interval).run(num_of_cycles)
+    return recording, c64
+
+
+def test_record():
+    """
+    Test that inputs and random bytes are logged with their cycles and that
+    checkpoints are taken every interval cycles.
+    """
+    recording, c64 = record(RANDOM_SUM, ["3"], seed=4)
+    assert recording.halted
+    assert [event.kind for event in recording.events] == ["input"] + ["random"] * 3
+    assert recording.events[0] == chip64_replay.Event(0, "input", "3")
+    assert recording.events[1].cycle == 3
+    assert recording.cycles == 20
+    assert [p.cycle for p in recording.checkpoints] == [0, 10, 20]
+    assert recording.final.registers[1] == int(c64.registers[1])
+    assert "read_input" not in vars(c64)
+
+
+@pytest.mark.parametrize(
+    "factory", [chip64.Chip64, chip64_fast.FastChip64, chip64_tiered.TieredChip64]
+)
+def test_replay(factory):
+    """
+    Test that a recording replays exactly on every engine, without touching
+    the console or the random number generator.
+    """
+    recording, original = record(RANDOM_SUM, ["20"], seed=5)
+    c64u.console_input = unittest.mock.MagicMock(side_effect=AssertionError)
+    c64u.console_output = unittest.mock.MagicMock()
+    c64 = chip64_replay.replay(recording, factory)
+    chip64_fast_test.assert_same_state(original, c64)
+    assert c64u.console_output.call_args_list == [
+        unittest.mock.call(str(original.registers[1]))
+    ]
+    chip64_replay.replay(recording, factory, start=35)
+
+
+def test_seek():
+    """
+    Test that seeking to a cycle gives the state the original run had then.
+    """
+    recording, _ = record(RANDOM_SUM, ["10"], interval=7, seed=6)
+    for cycle in (0, 1, 7, 20, 33, recording.cycles, recording.cycles + 5):
+        c64u.console_input = unittest.mock.MagicMock(side_effect=["10"])
+        expected = chip64.Chip64(RANDOM_SUM)
+        expected.rng.seed(6)
+        expected.execute(min(cycle, recording.cycles))
+        chip64_fast_test.assert_same_state(
+            expected, chip64_replay.seek(recording, cycle)
+        )
+
+
+def test_replay_divergence():
+    """
+    Test that a replay that leaves its recording raises ReplayError.
+    """
+    recording, _ = record(RANDOM_SUM, ["2"], seed=7)
+    recording.events.pop()
+    with pytest.raises(chip64_replay.ReplayError):
+        chip64_replay.replay(recording)
+    recording, _ = record(RANDOM_SUM, ["2"])
+    recording.final = recording.checkpoints[0]
+    with pytest.raises(chip64_replay.ReplayError):
+        chip64_replay.replay(recording)
+
+
+def test_recording_save_and_resume(tmp_path):
+    """
+    Test that a recording can be extended, saved and loaded.
+    """
+    c64u.console_input = unittest.mock.MagicMock(side_effect=["4"])
+    c64 = chip64.Chip64(RANDOM_SUM)
+    c64.rng.seed(8)
+    recorder = chip64_replay.Recorder(c64, 5)
+    recorder.run(12)
+    assert not recorder.recording.halted
+    recorder.run()
+    path = str(tmp_path / "run.c64r")
+    recorder.recording.save(path)
+    loaded = chip64_replay.Recording.load(path)
+    assert loaded.events == recorder.recording.events
+    assert [p.cycle for p in loaded.checkpoints] == [0, 5, 10, 15, 20, 25]
+    chip64_replay.replay(loaded)
+
+
+def test_record_instance_overrides():
+    """
+    Test that a machine's own read_input and random_byte are recorded from
+    and left in place afterwards.
+    """
+    c64u.console_input = unittest.mock.MagicMock(side_effect=RuntimeError)
+    c64 = chip64.Chip64(RANDOM_SUM)
+    read_input = lambda prompt: "2"
+    random_byte = lambda: 7
+    c64.read_input, c64.random_byte = read_input, random_byte
+    c64.write_output = unittest.mock.MagicMock()
+    recording = chip64_replay.Recorder(c64).run()
+    assert recording.halted
+    assert [event.value for event in recording.events] == ["2", 7, 7]
+    assert c64.write_output.call_args[0][0] == 14
+    assert c64.read_input is read_input
+    assert c64.random_byte is random_byte
+    chip64_replay.replay(recording)
+
+
+def test_record_stops_at_jump_to_itself():
+    """
+    Test that recording stops at a jump to itself where execute() does.
+    """
+    code = [0x60, 0x01, 0x10, 0x02]
+    recording, c64 = record(code, [])
+    assert c64.halt_reason == chip64.NON_TERMINATING
+    assert c64.loop_address == 0x002
+    assert recording.cycles == 2
+    assert not recording.halted
+    assert "read_input" not in vars(c64)
+    reference = chip64.Chip64(code)
+    reference.execute()
+    assert reference.cycles == recording.cycles
+    chip64_replay.replay(recording)
@@ -0,0 +1,302 @@
+"""
+Structured results for batch runs.
+run() executes a machine and returns a RunResult holding its outputs and final
+state, captured as values rather than console text. Results can be streamed
+to JSON Lines, to fixed size binary records or to a directory of .npy columns
+that NumPy can memory map without parsing.
+"""
+
+import collections
+import json
+import os
+import numpy as np
+import chip64
+
+# The halt reasons in the order they are numbered in binary records.
+HALT_REASONS = (
+    None,
+    chip64.HALTED,
+    chip64.CYCLE_LIMIT,
+    chip64.NON_TERMINATING,
+    chip64.BREAKPOINT,
+    chip64.WATCHPOINT,
+    chip64.DEADLINE,
+)
+_HALT_CODES = {reason: code for code, reason in enumerate(HALT_REASONS)}
+
+# One result record, the outputs of the i-th result are rows output_start to
+# output_start + output_count of the outputs. loop_address is -1 if unset.
+RESULT_DTYPE = np.dtype(
+    [
+        ("halt_reason", "u1"),
+        ("code_ptr", "<u2"),
+        ("loop_address", "<i2"),
+        ("cycles", "<u8"),
+        ("memory_ptr", "<u8"),
+        ("registers", "<u8", (16,)),
+        ("output_start", "<u8"),
+        ("output_count", "<u4"),
+    ]
+)
+# One value written by a DX0Q opcode and the base it was written in.
+OUTPUT_DTYPE = np.dtype([("value", "<u8"), ("base", "u1")])
+
+# Records held in memory before a binary or columnar sink writes them out.
+DEFAULT_BUFFER = 4096
+# Size reserved for each .npy header so it can be rewritten in place.
+_NPY_HEADER_SIZE = 128
+
+# outputs is a tuple of (value, base) pairs in the order they were written.
+RunResult = collections.namedtuple(
+    "RunResult",
+    [
+        "outputs",
+        "registers",
+        "code_ptr",
+        "memory_ptr",
+        "cycles",
+        "halt_reason",
+        "loop_address",
+    ],
+)
+
+
+def run(c64: chip64.Chip64, num_of_cycles=None, deadline=None) -> RunResult:
+    """
+    Executes c64, see Chip64.execute(), and returns the result of the run.
+    Output is captured instead of being written to the console.
+    """
+    outputs = []
+    cycles = c64.cycles
+    c64.write_output = lambda value, base: outputs.append((int(value), base))
+    try:
+        c64.execute(num_of_cycles, deadline)
+    finally:
+        del c64.write_output
+    return RunResult(
+        tuple(outputs),
+        tuple(int(value) for value in c64.registers),
+        int(c64.code_ptr),
+        int(c64.memory_ptr),
+        c64.cycles - cycles,
+        c64.halt_reason,
+        c64.loop_address,
+    )
+
+
+def output_text(value: int, base: int) -> str:
+    """
+    Returns an output as the console would show it.
+    """
+    return chip64.OUTPUT_FORMATS[base](value)
+
+
+class JsonLinesSink:
+    """
+    Appends results to a file as one JSON object per line, outputs as the
+    text the console would show.
+    """
+
+    def __init__(self, path, buffering: int = 1 << 16):
+        """
+        Opens path for appending. path may also be an open text file, which
+        is flushed rather than closed by close().
+        """
+        self._owned = isinstance(path, (str, os.PathLike))
+        self._file = open(path, "a", buffering=buffering) if self._owned else path
+
+    def write(self, result: RunResult) -> None:
+        """
+        Appends a result.
+        """
+        record = result._asdict()
+        record["outputs"] = [output_text(*output) for output in result.outputs]
+        record["registers"] = list(result.registers)
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def close(self) -> None:
+        """
+        Writes out anything buffered and closes the file.
+        """
+        if self._owned:
+            self._file.close()
+        else:
+            self._file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_json_lines(path: str) -> list:
+    """
+    Returns the results in a file written by JsonLinesSink, outputs as text.
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+class _RecordSink:
+    """
+    Buffers results as RESULT_DTYPE and OUTPUT_DTYPE records and hands them
+    to _append() in batches.
+    """
+
+    def __init__(self, buffer: int, outputs_written: int):
+        self._buffer = buffer
+        self._results = []
+        self._outputs = []
+        self._next_output = outputs_written
+
+    def write(self, result: RunResult) -> None:
+        """
+        Appends a result.
+        """
+        self._results.append(
+            (
+                _HALT_CODES[result.halt_reason],
+                result.code_ptr,
+                -1 if result.loop_address is None else result.loop_address,
+                result.cycles,
+                result.memory_ptr,
+                result.registers,
+                self._next_output,
+                len(result.outputs),
+            )
+        )
+        self._outputs += result.outputs
+        self._next_output += len(result.outputs)
+        if len(self._results) >= self._buffer:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes out the buffered results.
+        """
+        if self._results:
+            self._append(
+                np.array(self._results, dtype=RESULT_DTYPE),
+                np.array(self._outputs, dtype=OUTPUT_DTYPE),
+            )
+            self._results, self._outputs = [], []
+
+    def close(self) -> None:
+        """
+        Writes out the buffered results and closes the files.
+        """
+        self.flush()
+        self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BinarySink(_RecordSink):
+    """
+    Appends results to path as raw RESULT_DTYPE records, and their outputs
+    to path + ".out" as raw OUTPUT_DTYPE records. Both files are plain
+    arrays of fixed size records with no header, read them with
+    read_binary() or np.memmap.
+    """
+
+    def __init__(self, path: str, buffer: int = DEFAULT_BUFFER):
+        """
+        Opens path and its outputs file for appending.
+        """
+        self._file = open(path, "ab")
+        self._output_file = open(path + ".out", "ab")
+        super().__init__(buffer, self._output_file.tell() // OUTPUT_DTYPE.itemsize)
+
+    def _append(self, results: np.ndarray, outputs: np.ndarray) -> None:
+        self._file.write(results.tobytes())
+        self._output_file.write(outputs.tobytes())
+
+    def _close(self) -> None:
+        self._file.close()
+        self._output_file.close()
+
+
+def read_binary(path: str):
+    """
+    Returns the results and outputs written by BinarySink to path as memory
+    mapped arrays.
+    """
+    return tuple(
+        np.memmap(name, dtype, "r") if os.path.getsize(name) else np.zeros(0, dtype)
+        for name, dtype in ((path, RESULT_DTYPE), (path + ".out", OUTPUT_DTYPE))
+    )
+
+
+def _npy_header(dtype: np.dtype, shape: tuple) -> bytes:
+    """
+    Returns a version 1.0 .npy header padded to _NPY_HEADER_SIZE bytes.
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+        np.lib.format.dtype_to_descr(dtype),
+        shape,
+    )
+    return b"\x93NUMPY\x01\x00" + (
+        (_NPY_HEADER_SIZE - 10).to_bytes(2, "little")
+        + header.ljust(_NPY_HEADER_SIZE - 11).encode("latin1")
+        + b"\n"
+    )
+
+
+class ColumnarSink(_RecordSink):
+    """
+    Writes results to a directory as one .npy file per field, outputs as
+    output_value.npy and output_base.npy. The files are complete once the
+    sink is closed and load with np.load(..., mmap_mode="r") or
+    read_columns(). Any earlier columns in the directory are replaced.
+    """
+
+    def __init__(self, directory: str, buffer: int = DEFAULT_BUFFER):
+        """
+        Creates the directory if needed and opens a file for every column.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._columns = {}
+        self._rows = {}
+        for names, dtype in (
+            (RESULT_DTYPE.names, RESULT_DTYPE),
+            (OUTPUT_DTYPE.names, OUTPUT_DTYPE),
+        ):
+            for name in names:
+                column = name if dtype is RESULT_DTYPE else "output_" + name
+                f = open(os.path.join(directory, column + ".npy"), "wb")
+                f.write(bytes(_NPY_HEADER_SIZE))
+                self._columns[column] = (f, dtype, name)
+                self._rows[column] = 0
+        super().__init__(buffer, 0)
+
+    def _append(self, results: np.ndarray, outputs: np.ndarray) -> None:
+        for column, (f, dtype, name) in self._columns.items():
+            array = results if dtype is RESULT_DTYPE else outputs
+            f.write(np.ascontiguousarray(array[name]).tobytes())
+            self._rows[column] += len(array)
+
+    def _close(self) -> None:
+        for column, (f, dtype, name) in self._columns.items():
+            field, shape = dtype.fields[name][0], (self._rows[column],)
+            if field.shape:
+                field, shape = field.base, shape + field.shape
+            f.seek(0)
+            f.write(_npy_header(field, shape))
+            f.close()
+
+
+def read_columns(directory: str) -> dict:
+    """
+    Returns the columns written by ColumnarSink, memory mapped, keyed by
+    name.
+    """
+    return {
+        name[: -len(".npy")]: np.load(os.path.join(directory, name), mmap_mode="r")
+        for name in os.listdir(directory)
+        if name.endswith(".npy")
+    }
@@ -0,0 +1,102 @@
+import chip64
+import chip64_fast
+import chip64_sink
+import chip64_test
+import chip64_util as c64u
+import numpy as np
+import unittest.mock
+
+# Prints 42 in hex and decimal, then halts.
+PRINT = [0x60, 0x2A, 0xD0, 0x00, 0xD0, 0x01, 0x00, 0x00]
+
+
+def results():
+    """
+    Returns the results of a few runs on both engines.
+    """
+    c64u.console_output = unittest.mock.MagicMock()
+    out = []
+    for cls in (chip64.Chip64, chip64_fast.FastChip64):
+        out.append(chip64_sink.run(cls(PRINT)))
+        out.append(chip64_sink.run(cls([0x60, 0x01, 0x10, 0x02])))
+        out.append(chip64_sink.run(cls(chip64_test.REPEATING), 3))
+    return out
+
+
+def test_run():
+    """
+    Test that run() captures outputs and the final state without printing,
+    the same on both engines.
+    """
+    out = results()
+    assert not c64u.console_output.called
+    assert out[:3] == out[3:]
+    assert out[0] == chip64_sink.RunResult(
+        ((42, 16), (42, 10)), (42,) + (0,) * 15, 6, 0, 3, chip64.HALTED, None
+    )
+    assert out[1].halt_reason == chip64.NON_TERMINATING
+    assert out[1].loop_address == 2
+    assert out[2].halt_reason == chip64.CYCLE_LIMIT
+    assert out[2].cycles == 3
+
+
+def test_json_lines_sink(tmp_path):
+    """
+    Test that results are appended as JSON objects with text outputs.
+    """
+    path = str(tmp_path / "results.jsonl")
+    for _ in range(2):
+        with chip64_sink.JsonLinesSink(path) as sink:
+            for result in results():
+                sink.write(result)
+    lines = chip64_sink.read_json_lines(path)
+    assert len(lines) == 12
+    assert lines[0]["outputs"] == ["0x2a", "42"]
+    assert lines[0]["halt_reason"] == chip64.HALTED
+    assert lines[1]["loop_address"] == 2
+
+
+def test_binary_sink(tmp_path):
+    """
+    Test that binary records survive appending across sinks and small
+    buffers.
+    """
+    path = str(tmp_path / "results.bin")
+    with chip64_sink.BinarySink(path, buffer=2) as sink:
+        for result in results():
+            sink.write(result)
+    with chip64_sink.BinarySink(path) as sink:
+        sink.write(results()[0])
+    records, outputs = chip64_sink.read_binary(path)
+    assert len(records) == 7
+    assert list(records["output_start"]) == [0, 2, 2, 2, 4, 4, 4]
+    assert list(records["output_count"]) == [2, 0, 0, 2, 0, 0, 2]
+    assert records[6]["registers"][0] == 42
+    assert chip64_sink.HALT_REASONS[records[1]["halt_reason"]] == chip64.NON_TERMINATING
+    assert records[1]["loop_address"] == 2
+    assert records[0]["loop_address"] == -1
+    assert list(outputs["value"][4:]) == [42, 42]
+    assert list(outputs["base"][4:]) == [16, 10]
+
+
+def test_columnar_sink(tmp_path):
+    """
+    Test that the columns load with numpy and match the binary records.
+    """
+    out = results()
+    with chip64_sink.ColumnarSink(str(tmp_path / "columns"), buffer=4) as sink:
+        for result in out:
+            sink.write(result)
+    path = str(tmp_path / "results.bin")
+    with chip64_sink.BinarySink(path) as sink:
+        for result in out:
+            sink.write(result)
+    records, outputs = chip64_sink.read_binary(path)
+    columns = chip64_sink.read_columns(str(tmp_path / "columns"))
+    assert isinstance(columns["cycles"], np.memmap)
+    assert columns["registers"].shape == (6, 16)
+    for name in chip64_sink.RESULT_DTYPE.names:
+        assert np.array_equal(columns[name], records[name])
+    for name in chip64_sink.OUTPUT_DTYPE.names:
+        assert np.array_equal(columns["output_" + name], outputs[name])
+    assert np.array_equal(np.load(str(tmp_path / "columns" / "cycles.npy")), [3, 2, 3] * 2)
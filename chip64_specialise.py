@@ -0,0 +1,724 @@
+"""
+A specialiser for Chip64 programs.
+specialise() partially evaluates a program for the values of some of its
+inputs and the registers it starts with, returning a residual program that
+only reads the inputs left open. Values that follow from the fixed ones are
+folded through the code, skips they decide are resolved and loops whose trip
+count they fix are unrolled, so a sweep varying one or two inputs can run
+the same residual program for every job.
+
+Each program point is specialised once for every distinct set of values
+known there, up to max_variants copies, after which copies are merged and
+the values that differ between them are computed at run time. Calls are
+inlined. Values needed at run time are built with constant loads, or
+several at once with a LOAD from a block of data where that is cheaper.
+The residual program is laid out afresh in the bytes the original code and
+unused memory occupied, data stays where it is.
+"""
+
+import collections
+import itertools
+import chip64_cfg
+import chip64_decode as c64d
+import chip64_verify
+
+GOTO, HALT = 0x1000, 0x0000
+MP = chip64_cfg.MP
+MASK = chip64_cfg.MASK
+# Copies made of one program point before they are merged.
+MAX_VARIANTS = 256
+
+
+class _TooLarge(Exception):
+    """
+    Raised when the residual program would not fit in memory.
+    """
+
+
+def _bit(location: int) -> int:
+    return 1 << location
+
+
+def _locations(mask: int) -> list:
+    """
+    Returns the locations in a mask, memory_ptr first and register 0xF last,
+    the order they are loaded in so that loading one never undoes another.
+    """
+    order = [MP] + list(range(15)) + [15]
+    return [location for location in order if mask >> location & 1]
+
+
+def input_value(value, base: int) -> int:
+    """
+    Returns the register value an input instruction reading in base gets
+    from value, a string as read from the console or an int.
+    """
+    number = value if isinstance(value, int) else int(value, base)
+    if not 0 <= number <= MASK:
+        raise ValueError("input %r does not fit in a register" % (value,))
+    return number
+
+
+def _cost(location: int, value: int) -> int:
+    """
+    Returns the number of instructions _Specialiser._load() and
+    _materialise() take to give location value.
+    """
+    if location == MP:
+        return 1 if value <= 0xFFF else 2 + _cost(0, value)
+    parts = value.to_bytes(8, "big").lstrip(b"\0") or b"\0"
+    cost = 1 + sum(1 + (part != 0) for part in parts[1:])
+    return cost + (location == 15 and value > 0xFF)
+
+
+def _live_in(analysis, live: int) -> dict:
+    """
+    Returns the locations live before each reachable instruction, live
+    being those that matter when the program halts or spins on a jump to
+    itself.
+    """
+    effects = {}
+    for address, instruction in analysis.instructions.items():
+        m = instruction.mnemonic
+        if m == "HALT" or (m == "GOTO" and instruction.nnn == address):
+            effects[address] = (live, 0)
+        else:
+            effects[address] = chip64_cfg.uses_and_defs(instruction)
+    live_in = dict.fromkeys(analysis.instructions, 0)
+    changed = True
+    while changed:
+        changed = False
+        for address in sorted(analysis.instructions, reverse=True):
+            out = 0
+            for successor in analysis.successors[address]:
+                out |= live_in.get(successor, 0)
+            uses, defs = effects[address]
+            inn = uses | (out & ~defs)
+            if inn != live_in[address]:
+                live_in[address] = inn
+                changed = True
+    return live_in
+
+
+def _in_loops(analysis) -> set:
+    """
+    Returns the addresses of the reachable instructions that may run more
+    than once on one path: those on a cycle of the control flow graph, calls
+    stepping over to their return address, and the subroutines called from
+    them.
+    """
+    instructions = analysis.instructions
+    successors = {}
+    for address, instruction in instructions.items():
+        following = set(analysis.successors[address]) & set(instructions)
+        if instruction.mnemonic == "CALL" and address + 2 in instructions:
+            following.add(address + 2)
+        elif instruction.mnemonic == "RET":
+            following = set()
+        successors[address] = following
+    order, seen = [], set()
+    for root in instructions:
+        if root in seen:
+            continue
+        seen.add(root)
+        stack = [(root, iter(successors[root]))]
+        while stack:
+            node, edges = stack[-1]
+            for nxt in edges:
+                if nxt not in seen:
+                    seen.add(nxt)
+                    stack.append((nxt, iter(successors[nxt])))
+                    break
+            else:
+                order.append(node)
+                stack.pop()
+    predecessors = collections.defaultdict(set)
+    for address, following in successors.items():
+        for nxt in following:
+            predecessors[nxt].add(address)
+    looping, assigned = set(), set()
+    for root in reversed(order):
+        if root in assigned:
+            continue
+        component, worklist = [], [root]
+        assigned.add(root)
+        while worklist:
+            node = worklist.pop()
+            component.append(node)
+            for previous in predecessors[node] - assigned:
+                assigned.add(previous)
+                worklist.append(previous)
+        if len(component) > 1 or root in successors[root]:
+            looping.update(component)
+    worklist = [
+        instructions[address].nnn for address in looping
+        if instructions[address].mnemonic == "CALL"
+    ]
+    while worklist:
+        address = worklist.pop()
+        if address in instructions and address not in looping:
+            looping.add(address)
+            worklist += successors[address]
+    return looping
+
+
+class _Specialiser:
+    """
+    Builds the residual program as a list of [opcode, label] items, label
+    naming the item a GOTO jumps to.
+    Within it a machine state is tracked as known, a list of the value of
+    every register and memory_ptr or None if it is only known at run time,
+    and ready, a mask of the known locations that also hold their value at
+    run time. dead is the mask of locations whose run time values are never
+    read again from the instruction being specialised.
+    """
+
+    def __init__(self, analysis, start: tuple, ready: int, inputs, live: int,
+                 max_variants: int, limit: int, use_blocks: bool = True):
+        self.analysis = analysis
+        self.use_blocks = use_blocks
+        self.start = start
+        self.ready = ready
+        self.inputs = inputs
+        self.live = live
+        self.max_variants = max_variants
+        self.limit = limit
+        self.live_in = _live_in(analysis, live)
+        self.looping = _in_loops(analysis)
+        self.dead = 0
+        self.items = []
+        self.labels = {}
+        # Items that must be laid out together, by the index of the first.
+        self.groups = {}
+        # Blocks of register values for LOAD, as (label, bytes) pairs.
+        self.data = []
+        # The indexes of the first items of those blocks once laid out.
+        self.blocks = set()
+        self.variants = collections.defaultdict(list)
+        self.pending = []
+        self.paths = itertools.count()
+        self.leaders = {analysis.entry}
+        for address, instruction in analysis.instructions.items():
+            m = instruction.mnemonic
+            if m in c64d.JUMPS or m in c64d.SKIPS:
+                self.leaders |= analysis.successors[address]
+            if m in c64d.SKIPS:
+                self.leaders |= {address + 2, address + 4}
+
+    def _emit(self, opcode: int, label=None) -> None:
+        if len(self.items) >= self.limit:
+            raise _TooLarge
+        self.items.append([opcode, label])
+
+    def _scratch(self, known: list, avoid: int) -> int:
+        """
+        Returns a register outside avoid whose run time value is not needed.
+        """
+        for r in range(15):
+            free = known[r] is not None or self.dead >> r & 1
+            if free and not avoid >> r & 1:
+                return r
+        raise ValueError("no register is free to build a constant in")
+
+    def _load(self, x: int, value: int) -> None:
+        """
+        Emits code setting register x to value. Values over 0xFF are built a
+        byte at a time, the shifts writing the flag register.
+        """
+        parts = value.to_bytes(8, "big").lstrip(b"\0") or b"\0"
+        self._emit(0x6000 | x << 8 | parts[0])
+        for part in parts[1:]:
+            self._emit(0x808E | x << 8)
+            if part:
+                self._emit(0x7000 | x << 8 | part)
+
+    def _load_block(self, mask: int, known: list, ready: int):
+        """
+        Emits code loading known registers in mask not in place with a
+        single LOAD from a block of their values, if that is cheaper than
+        building them one by one, and returns the new ready mask, else None.
+        Registers below them whose run time values are needed are first
+        spilled over their slots in the block, so LOAD puts them back, and
+        memory_ptr must be known or dead as it is moved to the block.
+        """
+        if not self.use_blocks or known[MP] is None and not self.dead >> MP & 1:
+            return None
+        pending = [
+            r for r in _locations(mask & ~ready) if r < 15 and known[r] is not None
+        ]
+        if not pending:
+            return None
+        restore = _cost(MP, known[MP]) if mask >> MP & 1 else 0
+        # Building a large value moves a flag still needed out of the way.
+        flag = 2 if mask >> 15 & 1 and not self.dead >> 15 & 1 else 0
+        best = None
+        for top in pending:
+            needed = [
+                r for r in range(top) if known[r] is None and not self.dead >> r & 1
+            ]
+            spill = max(needed, default=-1)
+            served = [r for r in pending if spill < r <= top]
+            saved = sum(_cost(r, known[r]) for r in served) - 2 - (spill >= 0) - restore
+            if not any(known[r] > 0xFF for r in pending if r not in served):
+                saved += flag if any(known[r] > 0xFF for r in served) else 0
+            if saved > 0 and (best is None or saved > best[0]):
+                best = saved, top, spill
+        if best is None:
+            return None
+        _, top, spill = best
+        label = ("data", next(self.paths))
+        self.data.append(
+            (label, b"".join((known[r] or 0).to_bytes(8, "big") for r in range(top + 1)))
+        )
+        self._emit(0xA000, label)
+        if spill >= 0:
+            self._emit(0xE055 | spill << 8)
+        self._emit(0xE065 | top << 8)
+        for r in range(spill + 1, top + 1):
+            if known[r] is not None:
+                ready |= _bit(r)
+        return ready & ~_bit(MP)
+
+    def _materialise(self, mask: int, known: list, ready: int) -> int:
+        """
+        Emits code giving every known location in mask its value at run
+        time and returns the new ready mask.
+        Shifting register 0xF shifts the flag it has just written, so large
+        values for it are built in another register, loaded last or free.
+        If building values overwrites a flag whose run time value is needed,
+        the flag is kept in that register meanwhile, or loaded again if known.
+        Several large values are loaded from memory instead where cheaper.
+        """
+        loaded = self._load_block(mask, known, ready)
+        while loaded is not None:
+            ready = loaded
+            loaded = self._load_block(mask, known, ready)
+        pending = [l for l in _locations(mask & ~ready) if known[l] is not None]
+        registers = [r for r in pending if r != MP]
+        clobbers = any(known[r] > 0xFF for r in registers) or (
+            MP in pending and known[MP] > 0xFFF
+        )
+        if clobbers and mask >> 15 & 1 and known[15] is not None and 15 not in pending:
+            pending.append(15)
+            registers.append(15)
+        keep_flag = clobbers and known[15] is None and not self.dead >> 15 & 1
+        late = None
+        if keep_flag or (15 in pending and known[15] > 0xFF):
+            small = [r for r in registers if r != 15 and known[r] <= 0xFF]
+            free = any(
+                (known[r] is not None or self.dead >> r & 1) and not mask >> r & 1
+                for r in range(15)
+            )
+            held = [r for r in range(15) if known[r] is not None]
+            if small:
+                late = small[-1]
+            elif free or not held:
+                late = self._scratch(known, mask)
+            else:
+                # Borrow a known register in mask and load it again after.
+                late = min(held, key=lambda r: _cost(r, known[r]))
+                if late not in pending:
+                    pending.append(late)
+                    registers.append(late)
+        if keep_flag:
+            self._emit(0x8000 | late << 8 | 15 << 4)
+        for location in pending:
+            value = known[location]
+            if location == late:
+                continue
+            if location == MP:
+                if value <= 0xFFF:
+                    self._emit(0xA000 | value)
+                else:
+                    carriers = [r for r in registers if r not in (15, late)]
+                    carrier = carriers[0] if carriers else self._scratch(
+                        known, mask | (0 if late is None else _bit(late))
+                    )
+                    self._load(carrier, value)
+                    self._emit(0xA000)
+                    self._emit(0xE01E | carrier << 8)
+                    ready &= ~_bit(carrier)
+            elif location == 15 and value > 0xFF:
+                self._load(late, value)
+                self._emit(0x8F00 | late << 4)
+            else:
+                self._load(location, value)
+            if location != 15 and value > 0xFF:
+                ready &= ~_bit(15)
+            ready |= _bit(location)
+        if keep_flag:
+            self._emit(0x8F00 | late << 4)
+        if late is not None:
+            if late in pending:
+                self._load(late, known[late])
+                ready |= _bit(late)
+            else:
+                ready &= ~_bit(late)
+        return ready
+
+    def _path(self, address: int, stack: tuple, counter: int, known: list, ready: int):
+        """
+        Returns a label for a path to be specialised later.
+        """
+        label = ("path", next(self.paths))
+        self.pending.append((label, address, stack, counter, tuple(known), ready))
+        return label
+
+    def _arrive(self, address: int, stack: tuple, counter: int, known: list, ready: int):
+        """
+        Returns the variant to use at a program point reached in a state,
+        emitting any code needed to enter it, and the variant's state.
+        """
+        point = (address, stack, counter)
+        ready &= sum(_bit(l) for l in range(17) if known[l] is not None)
+        key = (point, tuple(known), ready)
+        variants = self.variants[point]
+        if key in variants:
+            return key
+        if len(variants) < self.max_variants:
+            variants.append(key)
+            return key
+        for variant in variants:
+            _, values, expected = variant
+            if all(v is None or v == k for v, k in zip(values, known)):
+                break
+        else:
+            values = list(known)
+            expected = ready
+            for _, other, other_ready in variants:
+                values = chip64_cfg.join(values, other)
+                expected &= other_ready
+            values = tuple(values)
+            expected &= sum(_bit(l) for l in range(17) if values[l] is not None)
+            variant = (point, values, expected)
+            variants.append(variant)
+        needed = expected | sum(_bit(l) for l in range(17) if values[l] is None)
+        self._materialise(needed, known, ready)
+        return variant
+
+    def _strengthen(self, address: int, known: list, ready: int) -> int:
+        """
+        Fills in values the analysis of the original program found to be
+        constant at address, which run time values always hold.
+        """
+        for location, value in enumerate(self.analysis.states[address]):
+            if value is not None and known[location] is None:
+                known[location] = value
+                ready |= _bit(location)
+        return ready
+
+    def run(self) -> None:
+        """
+        Specialises the program from its entry point.
+        """
+        self.pending.append(
+            (("path", next(self.paths)), self.analysis.entry, (), 0, self.start, self.ready)
+        )
+        while self.pending:
+            self._walk(*self.pending.pop())
+        for label, block in self.data:
+            self.labels[label] = len(self.items)
+            self.groups[len(self.items)] = len(block) // 2
+            self.blocks.add(len(self.items))
+            for i in range(0, len(block), 2):
+                self.items.append([block[i] << 8 | block[i + 1], None])
+
+    def _walk(self, label, address, stack, counter, known, ready) -> None:
+        """
+        Specialises the code from address on in one state until it halts or
+        joins code already specialised.
+        """
+        self.labels[label] = len(self.items)
+        known = list(known)
+        instructions = self.analysis.instructions
+        while True:
+            ready = self._strengthen(address, known, ready)
+            self.dead = ~self.live_in[address]
+            if address in self.leaders:
+                key = self._arrive(address, stack, counter, known, ready)
+                if key in self.labels:
+                    self._emit(GOTO, key)
+                    return
+                self.labels[key] = len(self.items)
+                known, ready = list(key[1]), key[2]
+            instruction = instructions[address]
+            m, x = instruction.mnemonic, instruction.x
+            if m == "HALT" or (m == "GOTO" and instruction.nnn == address):
+                self._materialise(self.live, known, ready)
+                if m == "HALT":
+                    self._emit(HALT)
+                else:
+                    spin = ("spin", len(self.items))
+                    self.labels[spin] = len(self.items)
+                    self._emit(GOTO, spin)
+                return
+            if m == "GOTO":
+                address = instruction.nnn
+            elif m == "CALL":
+                stack, address = stack + (address,), instruction.nnn
+            elif m == "RET":
+                stack, address = stack[:-1], stack[-1] + 2
+            elif m == "CPAC" and known[0] is None:
+                # A fresh jump table, each entry going to a path of its own.
+                table = ("table", next(self.paths))
+                self.groups[len(self.items)] = 1 + len(self.analysis.jump_tables[address])
+                self._emit(0xB000, table)
+                self.labels[table] = len(self.items)
+                for target in self.analysis.jump_tables[address]:
+                    self._emit(GOTO, self._path(target, stack, counter, known, ready))
+                return
+            elif m == "CPAC":
+                address = (known[0] + instruction.nnn) & MASK
+            elif m in c64d.SKIPS:
+                taken = chip64_cfg.skip_taken(instruction, known)
+                guarded = instructions.get(address + 2)
+                if taken is None and self._inline_guard(guarded):
+                    ready = self._guard(instruction, guarded, known, ready)
+                    address += 4
+                    continue
+                if taken is None:
+                    uses, _ = chip64_cfg.uses_and_defs(instruction)
+                    ready = self._materialise(uses, known, ready)
+                    self._emit(instruction.opcode)
+                    self._emit(GOTO, self._path(address + 2, stack, counter, known, ready))
+                address += 4 if taken is not False else 2
+            elif m in c64d.INPUTS and counter < len(self.inputs) and (
+                self.inputs[counter] is not None
+            ):
+                known[x] = input_value(self.inputs[counter], c64d.BASES[m])
+                ready &= ~_bit(x)
+                counter += 1
+                address += 2
+            else:
+                if m in c64d.INPUTS:
+                    counter = min(counter + 1, len(self.inputs))
+                ready = self._execute(instruction, known, ready)
+                address += 2
+
+    @staticmethod
+    def _inline_guard(guarded) -> bool:
+        """
+        Returns True if the instruction a skip may jump over can stay right
+        after it in the residual program, as it neither changes the flow of
+        control nor reads an input.
+        """
+        if guarded is None:
+            return False
+        m = guarded.mnemonic
+        return not (m in c64d.JUMPS or m in c64d.SKIPS or m in c64d.INPUTS or m == "HOST")
+
+    def _guard(self, skip: c64d.Instruction, guarded: c64d.Instruction, known: list,
+               ready: int) -> int:
+        """
+        Emits a skip whose outcome is not known followed by the instruction
+        it may jump over, and leaves in known what holds either way. Live
+        locations it writes are given their values first, for when it is
+        skipped. Returns the new ready mask.
+        """
+        skip_uses, _ = chip64_cfg.uses_and_defs(skip)
+        uses, defs = chip64_cfg.uses_and_defs(guarded)
+        live = self.live_in.get(skip.address + 4, chip64_cfg.ALL_LOCATIONS)
+        ready = self._materialise(skip_uses | uses | defs & live, known, ready)
+        self._emit(skip.opcode)
+        self._emit(guarded.opcode)
+        after = chip64_cfg.transfer(guarded, known)
+        joined = chip64_cfg.join(known, after)
+        for location in range(17):
+            if joined[location] is None:
+                ready &= ~_bit(location)
+        known[:] = joined
+        return ready
+
+    def _cheaper_to_run(self, instruction: c64d.Instruction, known: list, ready: int,
+                        after: list) -> bool:
+        """
+        Returns True if running a foldable instruction, after loading those
+        of its operands not in place, costs less than loading the live
+        values it computes later would. Instructions in loops are always
+        folded, a loop unrolled then only loads its results once.
+        """
+        if instruction.address in self.looping:
+            return False
+        uses, defs = chip64_cfg.uses_and_defs(instruction)
+        stale = sum(_bit(l) for l in range(17) if known[l] is not None) & ~ready
+        live = self.live_in.get(instruction.address + 2, 0)
+        folded = sum(
+            _cost(l, after[l]) for l in _locations(defs & live) if after[l] != known[l]
+        )
+        return 1 + sum(_cost(l, known[l]) for l in _locations(uses & stale)) < folded
+
+    def _execute(self, instruction: c64d.Instruction, known: list, ready: int) -> int:
+        """
+        Folds an instruction into known if its results are all known,
+        otherwise emits it. Returns the new ready mask.
+        """
+        after = chip64_cfg.transfer(instruction, known)
+        uses, defs = chip64_cfg.uses_and_defs(instruction)
+        if instruction.mnemonic in chip64_cfg.PURE and all(
+            after[l] is not None for l in _locations(defs)
+        ) and not self._cheaper_to_run(instruction, known, ready, after):
+            for location in range(17):
+                if after[location] != known[location]:
+                    ready &= ~_bit(location)
+            known[:] = after
+            return ready
+        ready = self._materialise(uses, known, ready)
+        self._emit(instruction.opcode)
+        for location in range(17):
+            if defs >> location & 1 or after[location] != known[location]:
+                if after[location] is None:
+                    ready &= ~_bit(location)
+                else:
+                    ready |= _bit(location)
+        known[:] = after
+        return ready
+
+
+def _free_ranges(analysis, code_bytes: set) -> list:
+    """
+    Returns the even aligned [start, end) ranges of memory the residual
+    program may occupy: everything but the data the program accesses, or
+    only the original code if a host function could read any memory.
+    """
+    if any(i.mnemonic == "HOST" for i in analysis.instructions.values()):
+        free = set(code_bytes)
+    else:
+        free = set(range(chip64_cfg.MEMORY_SIZE))
+        for ranges in analysis.accesses.values():
+            for low, high in ranges:
+                free -= set(range(low, high))
+    ranges, start = [], None
+    for address in range(0, chip64_cfg.MEMORY_SIZE, 2):
+        if address in free and address + 1 in free:
+            if start is None:
+                start = address
+        elif start is not None:
+            ranges.append((start, address))
+            start = None
+    if start is not None:
+        ranges.append((start, chip64_cfg.MEMORY_SIZE))
+    return ranges
+
+
+def _assemble(memory: list, items: list, labels: dict, free: list, groups: dict,
+              blocks=frozenset()) -> tuple:
+    """
+    Lays the residual items out over the free ranges, chaining the ranges
+    with GOTOs, and returns the new memory image and the end of the code.
+    groups maps the index of an item to the number of items from it that
+    must be laid out together, a skip and the item it skips always are.
+    blocks holds the indexes of groups that are data, never run.
+    """
+    addresses = []
+    links = []
+    ranges = iter(free)
+    start, end = next(ranges)
+    position, arriving = start, True
+    i = 0
+    while i < len(items):
+        opcode = items[i][0]
+        unit = groups.get(i, 2 if c64d.mnemonic(opcode) in c64d.SKIPS else 1)
+        last = items[i + unit - 1][0]
+        final = i in blocks or (
+            (unit == 1 or i in groups) and (last >> 12 == 1 or last == HALT)
+        )
+        while position + 2 * unit + (0 if final else 2) > end:
+            if arriving:
+                links.append(position)
+            start, end = next(ranges, (None, None))
+            if start is None:
+                raise _TooLarge
+            if arriving:
+                links[-1] = (links[-1], start)
+            position = start
+        for _ in range(unit):
+            addresses.append(position)
+            position += 2
+        i += unit
+        arriving = not final
+    image = list(memory)
+    top = 0
+    for position, target in links:
+        image[position], image[position + 1] = (GOTO | target) >> 8, target & 0xFF
+        top = max(top, position + 2)
+    for (opcode, label), position in zip(items, addresses):
+        if label is not None:
+            opcode = (opcode & 0xF000) | addresses[labels[label]]
+        image[position], image[position + 1] = opcode >> 8, opcode & 0xFF
+        top = max(top, position + 2)
+    return image, top
+
+
+def specialise(code, inputs=(), registers=None, live_at_halt=None,
+               max_variants: int = MAX_VARIANTS) -> list:
+    """
+    Returns a copy of the program in code specialised for fixed inputs and
+    registers, as a list of bytes.
+    inputs lists the values the input instructions read, in the order they
+    are read, as strings or ints, None for the inputs that still vary. The
+    residual program reads only those, and any after the end of inputs.
+    registers maps register numbers to their values at entry, None for
+    values only known at run time, the rest start at zero as on a freshly
+    constructed Chip64. live_at_halt is as for chip64_opt.optimise().
+    The residual program makes the same outputs and, when it halts or
+    reaches a jump to itself, leaves the same values in the live registers
+    and memory. Instructions are folded only where that is no dearer than
+    loading what they compute, so it seldom runs more cycles, but it may be
+    larger as loops are unrolled. Its call stack is not kept, calls are
+    inlined.
+    Raises chip64_verify.VerificationError for programs that fail
+    verification or that read their own code as data, and ValueError if the
+    residual program does not fit in memory.
+    """
+    memory = list(code) + [0] * (chip64_cfg.MEMORY_SIZE - len(code))
+    start = list(chip64_cfg.reset_state())
+    ready = chip64_cfg.ALL_LOCATIONS
+    for register, value in (registers or {}).items():
+        start[register] = value
+        ready &= ~_bit(register)
+    analysis = chip64_verify.check(memory, state=tuple(start))
+    code_bytes = analysis.code_bytes()
+    for address, instruction in analysis.instructions.items():
+        if instruction.mnemonic in c64d.SKIPS:
+            code_bytes |= {address + 2, address + 3}
+    for address, ranges in analysis.accesses.items():
+        for low, high in ranges:
+            if not code_bytes.isdisjoint(range(low, high)):
+                raise chip64_verify.VerificationError(
+                    [(address, "reads code as data, code cannot be relocated")]
+                )
+    if live_at_halt is None:
+        live = chip64_cfg.ALL_LOCATIONS
+    else:
+        live = sum(_bit(location) for location in set(live_at_halt))
+    for address in code_bytes:
+        memory[address] = 0
+    free = _free_ranges(analysis, code_bytes)
+    limit = sum(end - begin for begin, end in free) // 2
+    use_blocks = True
+    while True:
+        specialiser = _Specialiser(
+            analysis, tuple(start), ready, list(inputs), live, max_variants, limit,
+            use_blocks,
+        )
+        try:
+            specialiser.run()
+            image, top = _assemble(
+                memory, specialiser.items, specialiser.labels, free, specialiser.groups,
+                specialiser.blocks,
+            )
+        except _TooLarge:
+            if max_variants == 1:
+                raise ValueError("the residual program does not fit in memory") from None
+            max_variants = max(1, max_variants // 8)
+            continue
+        residual = image[: max(len(code), top)]
+        if specialiser.data:
+            # Registers loaded from a block are unknown to the analysis, which
+            # may then be unable to follow the residual program.
+            try:
+                chip64_verify.check(image, state=tuple(start))
+            except chip64_verify.VerificationError:
+                use_blocks = False
+                continue
+        return residual
@@ -0,0 +1,129 @@
+import chip64
+import chip64_fast
+import chip64_fuzz
+import chip64_specialise
+import chip64_test
+import chip64_util as c64u
+import chip64_verify
+import numpy as np
+import pytest
+import random
+import unittest.mock
+
+# The shift and add multiply from c_mul.py followed by a HALT.
+MULTIPLY = [
+    0xF0, 0x01, 0xF1, 0x01, 0x62, 0x00, 0x63, 0x00,
+    0x43, 0x40, 0x10, 0x18, 0x80, 0x16, 0x3F, 0x00,
+    0x82, 0x14, 0x81, 0x1E, 0x73, 0x01, 0x10, 0x08,
+    0xD2, 0x01, 0x00, 0x00,
+]
+
+
+def run(code, inputs=(), registers=None, cls=chip64.Chip64):
+    """
+    Runs code on cls with registers set and returns the machine, its outputs
+    and cycle count.
+    """
+    c64u.console_input = unittest.mock.MagicMock(side_effect=list(inputs))
+    c64u.console_output = unittest.mock.MagicMock()
+    c64 = cls(code)
+    # The original and residual programs draw the same random bytes.
+    c64.rng.seed(0)
+    for register, value in (registers or {}).items():
+        c64.registers[register] = np.uint64(value)
+    result = c64.execute()
+    assert result.halt_reason == chip64.HALTED
+    return c64, c64u.console_output.call_args_list, result.cycles
+
+
+@pytest.mark.parametrize("second", ["0", "1", "7", "123456789", "18446744073709551615"])
+def test_specialise_multiply(second):
+    """
+    Test that fixing the first input of the multiply unrolls its loop into a
+    shorter run that reads only the second input and ends in the same state.
+    """
+    residual = chip64_specialise.specialise(MULTIPLY, ["6", None])
+    original, outputs, cycles = run(MULTIPLY, ["6", second])
+    specialised, residual_outputs, residual_cycles = run(residual, [second])
+    assert residual_outputs == outputs
+    assert list(specialised.registers) == list(original.registers)
+    assert specialised.memory_ptr == original.memory_ptr
+    assert residual_cycles < cycles // 4
+    fast = run(residual, [second], cls=chip64_fast.FastChip64)
+    assert fast[1] == outputs
+
+
+def test_specialise_every_input():
+    """
+    Test that fixing every input folds the program down to its result.
+    """
+    residual = chip64_specialise.specialise(MULTIPLY, [3, 5], live_at_halt=[])
+    specialised, outputs, cycles = run(residual)
+    assert outputs == run(MULTIPLY, ["3", "5"])[1]
+    assert cycles <= 3
+
+
+def test_specialise_registers():
+    """
+    Test that registers may be fixed, or left to vary, at entry.
+    """
+    # Outputs register 0 plus register 1.
+    code = [
+        0x82, 0x00, 0x82, 0x14, 0xD2, 0x01, 0x00, 0x00,
+    ]
+    residual = chip64_specialise.specialise(code, registers={0: None, 1: 4})
+    for value in (0, 9, 2 ** 64 - 1):
+        original, outputs, _ = run(code, registers={0: value, 1: 4})
+        specialised, residual_outputs, _ = run(residual, registers={0: value})
+        assert residual_outputs == outputs
+        assert list(specialised.registers) == list(original.registers)
+
+
+@pytest.mark.parametrize("steps", ["0", "5", "40"])
+def test_specialise_jump_table(steps):
+    """
+    Test that computed jumps into a jump table on values only known at run
+    time get a jump table of their own in the residual program.
+    """
+    residual = chip64_specialise.specialise(chip64_test.DISPATCH, [None])
+    assert chip64_verify.verify(residual) == []
+    original, outputs, cycles = run(chip64_test.DISPATCH, [steps])
+    specialised, residual_outputs, residual_cycles = run(residual, [steps])
+    assert residual_outputs == outputs
+    assert list(specialised.registers) == list(original.registers)
+    assert residual_cycles < cycles
+
+
+@pytest.mark.parametrize("seed", [33, 40, 59, 349, 410, 507])
+def test_specialise_no_slower(seed):
+    """
+    Test that the residual program of a random program runs no more cycles
+    than the original, with its inputs fixed and left to vary.
+    """
+    program = chip64_fuzz.to_code(
+        chip64_fuzz.generate(random.Random(seed), tables=False, host_calls=False)
+    )
+    rng = random.Random(seed)
+    inputs = [bin(rng.getrandbits(rng.randrange(1, 17)))[2:] for _ in range(200)]
+    original, outputs, cycles = run(program, inputs)
+    for fixed in (inputs, [None] * 3):
+        residual = chip64_specialise.specialise(program, fixed)
+        varying = [value for value, known in zip(inputs, fixed) if known is None]
+        specialised, residual_outputs, residual_cycles = run(
+            residual, varying + inputs[len(fixed):]
+        )
+        assert residual_outputs == outputs
+        assert list(specialised.registers) == list(original.registers)
+        assert residual_cycles <= cycles
+
+
+def test_specialise_errors():
+    """
+    Test that programs that read their own code and inputs that do not fit
+    in a register are refused.
+    """
+    reads_code = [0xA0, 0x00, 0xE0, 0x65, 0xD0, 0x01, 0x00, 0x00]
+    with pytest.raises(chip64_verify.VerificationError):
+        chip64_specialise.specialise(reads_code)
+    with pytest.raises(ValueError):
+        chip64_specialise.specialise(MULTIPLY, [2 ** 64, None])
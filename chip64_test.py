@@ -1,8 +1,11 @@
 import chip64
 import chip64_util as c64u
+import concurrent.futures
 import numpy as np
+import pytest
 import unittest.mock
 import random
+import warnings
 
 
 def test_chip64_reset():
@@ -26,6 +29,31 @@ def test_chip64_reset():
     assert c64.code_ptr == 0
     assert c64.memory_ptr == 0
 
+
+def test_chip64_reset_reload_program():
+    """
+    Test the chip64.reset() method with reload_program set, ensure that the
+    program image is written back and everything else is zeroed.
+    """
+    code = [0x60, 0x2A, 0xD0, 0x01]
+    c64 = chip64.Chip64(code)
+    c64.memory[0] = np.uint8(0xFF)
+    c64.memory[0x100] = np.uint8(0xFF)
+    c64.registers[3] = np.uint64(7)
+    c64.stack.append(0x10)
+    c64.code_ptr = 0x20
+    c64.memory_ptr = 0x30
+
+    c64.reset(reload_program=True)
+
+    assert c64.memory[:4] == code
+    assert c64.memory[4:] == [np.uint8(0) for _ in range(4092)]
+    assert c64.registers == [np.uint64(0) for _ in range(16)]
+    assert c64.stack == []
+    assert c64.code_ptr == 0
+    assert c64.memory_ptr == 0
+
+
 def test_chip64_subroutine_return():
     """
     Tests the chip64.subroutine_return() method.
@@ -43,8 +71,9 @@ def test_chip64_goto():
     """
     c64 = chip64.Chip64()
     c64.code_ptr = 0xABC
-    c64.goto(0xBCD)
+    c64.goto(np.uint16(0xBCD))
     assert c64.code_ptr == 0xBCD
+    assert type(c64.code_ptr) is int
 
 
 def test_chip64_subroutine_call():
@@ -279,6 +308,10 @@ def test_chip64_set_code_ptr_to_acc_plus_const():
     c64.registers[0] = 0xF
     c64.set_code_ptr_to_acc_plus_const(0xFF)
     assert c64.code_ptr == (0xF + 0xFF)
+    assert type(c64.code_ptr) is int
+    c64.registers[0] = np.uint64(chip64.MASK)
+    c64.set_code_ptr_to_acc_plus_const(np.uint16(2))
+    assert c64.code_ptr == 1
 
 
 def test_chip64_bitwise_and_rand():
@@ -286,10 +319,9 @@ def test_chip64_bitwise_and_rand():
     Tests the c64.bitwise_and_rand() method, ensures that given a seeded random number that the correct register is modified.
     """
     c64 = chip64.Chip64()
-    random.seed(1)
+    c64.rng.seed(1)
     c64.bitwise_and_rand(0, 0xF0)
-    random.seed(1)
-    assert c64.registers[0] == (random.randint(0, 255) & 0xF0)
+    assert c64.registers[0] == (random.Random(1).randint(0, 255) & 0xF0)
 
 
 def test_chip64_display_register_hex():
@@ -349,6 +381,8 @@ def test_chip64_add_register_to_memory_ptr():
     c64.registers[0] = 0xAB
     c64.add_register_to_memory_ptr(0)
     assert c64.memory_ptr == 0x1AB
+    c64.load_registers(0)
+    assert c64.registers[0] == 0
 
 
 def test_chip64_spill_registers():
@@ -429,3 +463,318 @@ def test_chip64_input_register_oct():
     c64u.console_input = unittest.mock.MagicMock(return_value=oct(0o1771))
     c64.input_to_register_oct(0)
     assert c64.registers[0] == 0o1771
+
+
+def test_chip64_step():
+    """
+    Tests the c64.step() method.
+    """
+    c64 = chip64.Chip64([0x60, 0x2A, 0x00, 0x00])
+    assert c64.step()
+    assert c64.registers[0] == 0x2A
+    assert c64.code_ptr == 2
+    assert not c64.step()
+    assert c64.code_ptr == 2
+
+
+def test_chip64_host_call():
+    """
+    Tests the c64.host_call() and c64.register_host_function() methods.
+    """
+    c64 = chip64.Chip64()
+
+    def double(r, m):
+        r[1] = 2 * r[0]
+        m[r[0]] = 0xAB
+
+    c64.register_host_function(0x123, double)
+    c64.registers[0] = np.uint64(0x80)
+    c64.host_call(0x123)
+    assert c64.registers[1] == 0x100
+    assert c64.memory[0x80] == 0xAB
+    c64.host_call(0x124)
+    for number in (0x000, 0x1EE, 0x1000):
+        with pytest.raises(ValueError):
+            c64.register_host_function(number, double)
+
+
+def test_chip64_add_with_carry():
+    """
+    Tests the c64.add_with_carry() method.
+    """
+    c64 = chip64.Chip64()
+    c64.registers[0] = np.uint64(0xFFFFFFFFFFFFFFFF)
+    c64.registers[1] = np.uint64(0)
+    c64.registers[0xF] = np.uint64(1)
+    c64.add_with_carry(0, 1)
+    assert c64.registers[0] == 0
+    assert c64.registers[0xF] == 1
+    c64.registers[0xF] = np.uint64(0)
+    c64.add_with_carry(1, 1)
+    assert c64.registers[1] == 0
+    assert c64.registers[0xF] == 0
+
+
+def test_chip64_subtract_with_borrow():
+    """
+    Tests the c64.subtract_with_borrow() method.
+    """
+    c64 = chip64.Chip64()
+    c64.registers[0] = np.uint64(5)
+    c64.registers[1] = np.uint64(5)
+    c64.registers[0xF] = np.uint64(0)
+    c64.subtract_with_borrow(0, 1)
+    assert c64.registers[0] == 0xFFFFFFFFFFFFFFFF
+    assert c64.registers[0xF] == 0
+    c64.registers[0xF] = np.uint64(1)
+    c64.subtract_with_borrow(1, 1)
+    assert c64.registers[1] == 0
+    assert c64.registers[0xF] == 1
+
+
+def test_chip64_add_and_subtract_memory():
+    """
+    Tests the c64.add_memory() and c64.subtract_memory() methods.
+    """
+    c64 = chip64.Chip64()
+    a, b = 2**128 - 1, 2**64 + 1
+    operands = a.to_bytes(24, "big") + b.to_bytes(24, "big")
+    c64.memory[0x100:0x130] = [np.uint8(x) for x in operands]
+    c64.memory_ptr = 0x100
+    c64.registers[2] = np.uint64(3)
+    c64.add_memory(2)
+    assert int.from_bytes(bytearray(c64.memory[0x100:0x118]), "big") == a + b
+    assert c64.registers[0xF] == 0
+    c64.subtract_memory(2)
+    assert int.from_bytes(bytearray(c64.memory[0x100:0x118]), "big") == a
+    assert c64.registers[0xF] == 1
+    c64.registers[2] = np.uint64(1)
+    c64.memory_ptr = 0x118
+    c64.subtract_memory(2)
+    assert c64.registers[0xF] == 0
+    c64.memory_ptr = 0xFF8
+    with pytest.raises(IndexError):
+        c64.add_memory(2)
+
+
+# Sets r1 to 7 over and over, a loop that never changes the state at $002.
+REPEATING = [0x60, 0x00, 0x61, 0x07, 0x10, 0x02]
+# Adds one to a number in memory forever, the registers never change.
+COUNTING = [
+    0xA1, 0x00, 0x64, 0x01, 0x60, 0x01, 0xA1, 0x08,
+    0xE0, 0x55, 0xA1, 0x00, 0xE4, 0xA4, 0x10, 0x0C,
+]
+# A bytecode interpreter in miniature. Runs the number of steps read from
+# the console, step i dispatching on i & 3 through the jump table at $018 to
+# add one to, double, add i to or exclusive or i into r2, which it outputs.
+# The ACR r5 at $014 is never read.
+DISPATCH = [
+    0xF3, 0x01, 0x61, 0x00, 0x62, 0x00, 0x64, 0x03,
+    0x51, 0x30, 0x10, 0x0E, 0x10, 0x38, 0x80, 0x10,
+    0x80, 0x42, 0x80, 0x1E, 0x65, 0x07, 0xB0, 0x18,
+    0x10, 0x28, 0x10, 0x2C, 0x10, 0x30, 0x10, 0x20,
+    0x82, 0x13, 0x10, 0x34, 0x00, 0x00, 0x00, 0x00,
+    0x72, 0x01, 0x10, 0x34, 0x82, 0x1E, 0x10, 0x34,
+    0x82, 0x14, 0x10, 0x34, 0x71, 0x01, 0x10, 0x08,
+    0xD2, 0x01, 0x00, 0x00,
+]
+
+
+def test_chip64_halt_reason():
+    """
+    Tests that execute() records why it stopped.
+    """
+    c64 = chip64.Chip64([0x60, 0x01, 0x00, 0x00])
+    assert c64.halt_reason is None
+    c64.execute()
+    assert c64.halt_reason == chip64.HALTED
+    c64 = chip64.Chip64(REPEATING)
+    c64.execute(10)
+    assert c64.halt_reason == chip64.CYCLE_LIMIT
+    assert c64.loop_address is None
+    c64.reset()
+    assert c64.halt_reason is None
+
+
+def test_chip64_self_jump():
+    """
+    Tests that a jump to itself stops execute() straight away.
+    """
+    c64 = chip64.Chip64([0x60, 0x01, 0x10, 0x02])
+    c64.execute()
+    assert c64.halt_reason == chip64.NON_TERMINATING
+    assert c64.loop_address == 0x002
+    assert c64.code_ptr == 0x002
+    assert c64.registers[0] == 1
+
+
+def test_chip64_detect_loops():
+    """
+    Tests that a loop returning to the same state is only stopped when
+    detect_loops is set, and that loops changing memory or reading random
+    bytes are not stopped.
+    """
+    c64 = chip64.Chip64(REPEATING, detect_loops=True)
+    c64.execute()
+    assert c64.halt_reason == chip64.NON_TERMINATING
+    assert c64.loop_address == 0x002
+    assert c64.registers[1] == 7
+    c64 = chip64.Chip64(COUNTING, detect_loops=True)
+    c64.execute(200)
+    assert c64.halt_reason == chip64.CYCLE_LIMIT
+    c64 = chip64.Chip64([0xC0, 0x00, 0x10, 0x00], detect_loops=True)
+    c64.execute(200)
+    assert c64.halt_reason == chip64.CYCLE_LIMIT
+
+
+def test_repeat_detector():
+    """
+    Tests that RepeatDetector finds a repeat only after the saved state comes
+    round again, and forgets it when cleared.
+    """
+    repeats = chip64.RepeatDetector()
+    states = [0, 1, 2, 0, 1, 2, 0, 1, 2]
+    found = [i for i, state in enumerate(states) if repeats.seen(state, bytes)]
+    assert found == [6]
+    repeats.clear()
+    assert not repeats.seen(0, bytes)
+    assert not repeats.seen(1, lambda: b"\x01")
+    assert repeats.seen(1, lambda: b"\x01")
+    assert not repeats.seen(1, lambda: b"\x02")
+
+
+# Calls a subroutine that spills r0 and r1 to $100, prints r1 and returns.
+SUBROUTINE = [
+    0x60, 0x05, 0x61, 0x07, 0x20, 0x08, 0x00, 0x00,
+    0xA1, 0x00, 0xE1, 0x55, 0xD1, 0x01, 0x01, 0xEE,
+]
+
+
+def test_chip64_hooks():
+    """
+    Tests that hooks see every event and that removing them returns
+    execute() to its unobserved loop.
+    """
+    c64u.console_output = unittest.mock.MagicMock()
+    c64 = chip64.Chip64(SUBROUTINE)
+    events = []
+    hooks = {
+        "instruction": lambda c, address, opcode: events.append(("i", address, opcode)),
+        "call": lambda c, address, target: events.append(("call", address, target)),
+        "return": lambda c, address, target: events.append(("ret", address, target)),
+        "memory_write": lambda c, address, low, high: events.append(("w", low, high)),
+        "io": lambda c, address, kind, value: events.append((kind, address, value)),
+        "halt": lambda c, reason: events.append(("halt", reason)),
+    }
+    for event, hook in hooks.items():
+        c64.add_hook(event, hook)
+    c64.execute()
+    assert [event for event in events if event[0] != "i"] == [
+        ("call", 0x004, 0x008),
+        ("w", 0x100, 0x110),
+        ("output", 0x00C, 7),
+        ("ret", 0x00E, 0x006),
+        ("halt", chip64.HALTED),
+    ]
+    assert [event[1] for event in events if event[0] == "i"] == [
+        0x000, 0x002, 0x004, 0x008, 0x00A, 0x00C, 0x00E, 0x006
+    ]
+    assert c64.cycles == 7
+    c64u.console_output.assert_called_once_with("7")
+    for event, hook in hooks.items():
+        c64.remove_hook(event, hook)
+    assert not c64._observed
+    with pytest.raises(ValueError):
+        c64.add_hook("jump", print)
+
+
+def test_chip64_breakpoints_and_watchpoints():
+    """
+    Tests that breakpoints stop before an instruction, execution resumes
+    from them, and watchpoints stop after a write to their range.
+    """
+    c64u.console_output = unittest.mock.MagicMock()
+    c64 = chip64.Chip64(SUBROUTINE)
+    c64.add_breakpoint(0x00C)
+    c64.execute()
+    assert c64.halt_reason == chip64.BREAKPOINT
+    assert c64.stop_address == c64.code_ptr == 0x00C
+    assert not c64u.console_output.called
+    c64.execute()
+    assert c64.halt_reason == chip64.HALTED
+    assert c64.stop_address is None
+    c64.remove_breakpoint(0x00C)
+    c64.reset(reload_program=True)
+    c64.add_watchpoint(0x10F, 0x110)
+    c64.execute()
+    assert c64.halt_reason == chip64.WATCHPOINT
+    assert c64.stop_address == 0x00A
+    assert c64.code_ptr == 0x00C
+    c64.remove_watchpoint(0x10F, 0x110)
+    c64.add_watchpoint(0x110, 0x120)
+    c64.execute()
+    assert c64.halt_reason == chip64.HALTED
+
+
+def test_chip64_remove_observers():
+    """
+    Tests that remove_observers() removes every hook, breakpoint and
+    watchpoint at once.
+    """
+    c64 = chip64.Chip64(SUBROUTINE)
+    c64.add_hook("instruction", print)
+    c64.add_hook("halt", print)
+    c64.add_breakpoint(0x00C)
+    c64.add_watchpoint(0x100, 0x110)
+    c64.remove_observers()
+    assert not c64._observed
+    c64u.console_output = unittest.mock.MagicMock()
+    c64.execute()
+    assert c64.halt_reason == chip64.HALTED
+    c64u.console_output.assert_called_once_with("7")
+
+
+def test_chip64_reentrant():
+    """
+    Tests that machines keep their random numbers to themselves, run in
+    threads and leave the process's warning filters alone.
+    """
+    code = [0x71, 0xFF, 0x81, 0x14, 0xC0, 0xFF, 0x10, 0x00]
+
+    def run(seed):
+        c64 = chip64.Chip64(code)
+        c64.rng.seed(seed)
+        c64.execute(3000)
+        return [int(value) for value in c64.registers]
+
+    filters = list(warnings.filters)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        expected = [run(seed) for seed in range(4)]
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            assert list(executor.map(run, range(4))) == expected
+    assert expected[0] != expected[1]
+    assert warnings.filters == filters
+
+
+def test_chip64_tables():
+    """
+    Tests that tables are loaded in the layout the memory opcodes use and
+    read back in any unsigned integer type.
+    """
+    c64 = chip64.Chip64([0xA1, 0x08, 0xE1, 0x65, 0x00, 0x00])
+    table = np.array([3, 0xDEADBEEF, 2**64 - 1], dtype=np.uint64)
+    c64.load_table(0x100, table)
+    c64.execute()
+    assert c64.registers[0] == 0xDEADBEEF and c64.registers[1] == 2**64 - 1
+    assert list(c64.extract_table(0x100, 3)) == list(table)
+    assert list(c64.extract_table(0x100, 6, np.uint32)) == [
+        0, 3, 0, 0xDEADBEEF, 0xFFFFFFFF, 0xFFFFFFFF
+    ]
+    c64.load_table(0xFFE, [7, 8], np.uint8)
+    assert list(c64.extract_table(0xFFC, 4, np.uint8)) == [0, 0, 7, 8]
+    assert type(c64.memory[0xFFF]) is np.uint8
+    with pytest.raises(IndexError):
+        c64.load_table(0xFFC, [1], np.uint64)
+    with pytest.raises(IndexError):
+        c64.extract_table(0xFF8, 2)
@@ -0,0 +1,270 @@
+"""
+A tiered execution manager for Chip64.
+Every program starts in the plain interpreter, Chip64.step(). Addresses that
+execution enters other than by falling through, branch and call targets and
+the points where a compiled block handed back control, are counted, and once
+one has been entered threshold times the block starting there is compiled.
+Unlike FastChip64 the program does not have to be verified and may modify
+its own code.
+"""
+
+import collections
+import time
+import numpy as np
+import chip64
+import chip64_cfg
+import chip64_decode as c64d
+import chip64_fast
+
+# Entries before an address is compiled, low enough that loops are promoted
+# within their first few iterations.
+DEFAULT_THRESHOLD = 16
+# Compiled code that keeps being overwritten is left to the interpreter.
+MAX_DEOPTIMISATIONS = 4
+# Instructions compiled blocks stop before, so the next address is an entry.
+_RESUMES = c64d.INPUTS | {"SPILL", "LOAD", "ADDM", "SUBM", "HOST"}
+_WRITERS = frozenset(["SPILL", "ADDM", "SUBM"])
+
+
+class _JumpTables:
+    """
+    Finds the jump table of a BNNN in memory as a block is compiled,
+    remembering the tables found.
+    """
+
+    def __init__(self, memory):
+        self.memory = memory
+        self.found = []
+
+    def get(self, address: int) -> tuple:
+        nnn = c64d.decode_at(self.memory, address).nnn
+        table = chip64_cfg.jump_table(self.memory, nnn)
+        self.found.append((nnn, table))
+        return table
+
+
+class TieredChip64(chip64.Chip64):
+    """
+    A Chip64 that compiles its hot code as it runs.
+    hits counts entries to each address that is not yet compiled. Compiled
+    blocks are discarded when a SPILL, ADDM, SUBM or host function run by the
+    machine overwrites any of their bytes, memory changed from outside the
+    machine needs a call to invalidate().
+    """
+
+    def __init__(self, code=[], threshold=DEFAULT_THRESHOLD, detect_loops=False):
+        """
+        The default constructor for the class.
+        """
+        super().__init__(code, detect_loops)
+        self.threshold = threshold
+        self.hits = collections.Counter()
+        self.deoptimisations = collections.Counter()
+        self._units = {}
+        self._owners = collections.defaultdict(set)
+        self._cold = set()
+        self._nondeterministic = set()
+
+    @property
+    def compiled(self) -> list:
+        """
+        Returns the sorted addresses of the blocks currently compiled.
+        """
+        return sorted(self._units)
+
+    def reset(self, reload_program=False) -> None:
+        """
+        Resets the machine and discards compiled code and hit counts.
+        """
+        super().reset(reload_program)
+        self.invalidate()
+        self.hits.clear()
+        self.deoptimisations.clear()
+
+    def invalidate(self) -> None:
+        """
+        Discards all compiled code.
+        """
+        self._units.clear()
+        self._owners.clear()
+        self._cold.clear()
+
+    def _promote(self, address: int):
+        """
+        Compiles the block at address, returning None if it cannot be.
+        """
+        built = None
+        tables = _JumpTables(self.memory)
+        # A jump to itself is left to the interpreter, which stops on it.
+        if self.deoptimisations[address] < MAX_DEOPTIMISATIONS and not (
+            chip64_fast.self_jump(self.memory, address)
+        ):
+            built = chip64_fast.block_source(
+                self.memory, address, checked=True, tables=tables
+            )
+        if built is None:
+            self._cold.add(address)
+            return None
+        source, length = built
+        unit = (chip64_fast.compile_unit(source, address), length)
+        self._units[address] = unit
+        for byte in range(address, address + 2 * length):
+            self._owners[byte].add(address)
+        # Blocks dispatching through a jump table depend on its entries too.
+        for start, table in tables.found:
+            for byte in range(start, start + 2 * len(table)):
+                self._owners[byte].add(address)
+        if chip64_fast.block_nondeterministic(self.memory, address, length):
+            self._nondeterministic.add(address)
+        else:
+            self._nondeterministic.discard(address)
+        del self.hits[address]
+        return unit
+
+    def host_call(self, number) -> None:
+        """
+        Calls a host function, discarding compiled blocks it overwrites.
+        """
+        if not self._owners:
+            super().host_call(number)
+            return
+        before = np.array(self.memory, dtype=np.uint8)
+        super().host_call(number)
+        for i in np.flatnonzero(np.array(self.memory, dtype=np.uint8) != before):
+            self._written(int(i), int(i) + 1)
+
+    def load_table(self, address: int, values, dtype=np.uint64) -> None:
+        """
+        Writes a table to memory, discarding compiled blocks it overwrites.
+        """
+        super().load_table(address, values, dtype)
+        self._written(address, address + len(values) * np.dtype(dtype).itemsize)
+
+    def _written_range(self, m: str, x: int):
+        """
+        Returns the [low, high) range of memory the instruction m with
+        register operand x is about to write, None if it writes none or no
+        code is compiled.
+        """
+        if m not in _WRITERS or not self._owners:
+            return None
+        return self._write_range(m, x)
+
+    def _written(self, low: int, high: int) -> None:
+        """
+        Discards compiled blocks covering any byte in [low, high).
+        """
+        for byte in range(low, high):
+            for address in self._owners.pop(byte, ()):
+                if self._units.pop(address, None) is not None:
+                    self.deoptimisations[address] += 1
+            self._cold.discard(byte)
+
+    def _run_compiled(self, limit: int, repeats=None) -> int:
+        """
+        Runs compiled blocks from code_ptr for at most limit cycles, until one
+        hands control to an address that is not compiled. Returns the number
+        of cycles run.
+        Back edges are checked with repeats, a chip64.RepeatDetector, if it
+        is given, stopping the machine if one comes back to an earlier state.
+        """
+        units = self._units
+        r = [int(value) for value in self.registers]
+        s = [int(address) for address in self.stack]
+        v = [int(self.memory_ptr), 0, limit]
+        pc = int(self.code_ptr)
+        try:
+            while True:
+                unit = units.get(pc)
+                if unit is None or v[1] + unit[1] > limit:
+                    break
+                address = pc
+                pc = unit[0](self, r, None, s, v)
+                if repeats is None:
+                    continue
+                if address in self._nondeterministic:
+                    repeats.clear()
+                elif pc <= address and repeats.seen(
+                    (pc, v[0], tuple(r), tuple(s)), self._memory_copy
+                ):
+                    self._stop_loop(pc)
+                    break
+        except chip64_fast._Spin as spin:
+            pc = spin.args[0]
+            self._stop_loop(pc)
+        finally:
+            self.code_ptr = pc
+            self.memory_ptr = v[0]
+            self.registers[:] = [np.uint64(value) for value in r]
+            self.stack[:] = s
+            self.cycles += v[1]
+        return v[1]
+
+    @chip64.measured
+    def execute(self, num_of_cycles=None, deadline=None) -> chip64.ExecutionResult:
+        """
+        The main execution loop of the emulator.
+        num_of_cycles gives the number of cycles you'd like the emulator to run for.
+        If no parameter is passed then the emulator will cycle indefinitely.
+        deadline is a time.monotonic() value to stop at, checked once every
+        chip64.DEADLINE_INTERVAL cycles.
+        Stops at loops that cannot halt as Chip64.execute() does.
+        """
+        if self._observed:
+            # Memory written while observed is not tracked, so compiled code
+            # is discarded rather than trusted afterwards.
+            self.invalidate()
+            self._execute_observed(num_of_cycles, deadline)
+            return
+        self.halt_reason = self.loop_address = self.stop_address = None
+        repeats = chip64.RepeatDetector() if self.detect_loops else None
+        remaining = chip64_fast.UNLIMITED if num_of_cycles is None else num_of_cycles
+        # The deadline is next checked once remaining falls to check_at.
+        check_at = remaining
+        entered = True
+        while remaining > 0:
+            if deadline is not None and remaining <= check_at:
+                if time.monotonic() >= deadline:
+                    self.halt_reason = chip64.DEADLINE
+                    return
+                check_at = remaining - chip64.DEADLINE_INTERVAL
+            pc = int(self.code_ptr)
+            if entered:
+                unit = self._units.get(pc)
+                if unit is None and pc not in self._cold:
+                    self.hits[pc] += 1
+                    if self.hits[pc] >= self.threshold:
+                        unit = self._promote(pc)
+                if unit is not None:
+                    ran = self._run_compiled(
+                        remaining if deadline is None else remaining - check_at, repeats
+                    )
+                    if self.halt_reason is not None:
+                        return
+                    if ran:
+                        remaining -= ran
+                        continue
+            opcode = (int(self.memory[pc]) << 8) | int(self.memory[pc + 1])
+            m = c64d.mnemonic(opcode)
+            written = self._written_range(m, (opcode >> 8) & 0xF)
+            depth = len(self.stack)
+            if not self._step():
+                self.halt_reason = chip64.HALTED
+                return
+            self.cycles += 1
+            remaining -= 1
+            if written is not None:
+                self._written(*written)
+            code_ptr = int(self.code_ptr)
+            entered = code_ptr != pc + 2 or m in _RESUMES
+            if code_ptr == pc and len(self.stack) == depth:
+                self._stop_loop(pc)
+                return
+            if repeats is None:
+                continue
+            if m in c64d.NONDETERMINISTIC:
+                repeats.clear()
+            elif code_ptr < pc and repeats.seen(self._state(), self._memory_copy):
+                self._stop_loop(code_ptr)
+                return
+        self.halt_reason = chip64.CYCLE_LIMIT
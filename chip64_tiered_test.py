@@ -0,0 +1,170 @@
+import chip64
+import chip64_fast_test
+import chip64_test
+import chip64_tiered
+import chip64_util as c64u
+import numpy as np
+import pytest
+import unittest.mock
+
+# Sums 0 to 15 into r1 by rewriting the ADCR at $020 on every iteration.
+SELF_MODIFYING = [
+    0xA0, 0x1A, 0x63, 0x00, 0x61, 0x00, 0x43, 0x10,
+    0x10, 0x26, 0x60, 0x71, 0x80, 0x8E, 0x80, 0x31,
+    0xE0, 0x55, 0x10, 0x20, 0x00, 0x00, 0x00, 0x00,
+    0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
+    0x71, 0x00, 0x73, 0x01, 0x10, 0x06, 0xD1, 0x01,
+    0x00, 0x00,
+]
+
+
+def run_both(code, inputs=(), num_of_cycles=None, threshold=2):
+    """
+    Runs code on Chip64 and TieredChip64, checks they end in the same state
+    with the same output and returns the TieredChip64.
+    """
+    machines, outputs = [], []
+    for c64 in (chip64.Chip64(code), chip64_tiered.TieredChip64(code, threshold)):
+        c64u.console_input = unittest.mock.MagicMock(side_effect=list(inputs))
+        c64u.console_output = unittest.mock.MagicMock()
+        c64.execute(num_of_cycles)
+        machines.append(c64)
+        outputs.append(c64u.console_output.call_args_list)
+    chip64_fast_test.assert_same_state(*machines)
+    assert outputs[0] == outputs[1]
+    return machines[1]
+
+
+def test_tiered_promotion():
+    """
+    Test that hot branch targets are compiled and cold code is not.
+    """
+    c64 = run_both(chip64_fast_test.MULTIPLY, ["123456789", "987654321"])
+    assert 0x08 in c64.compiled
+    assert 0x00 not in c64.compiled
+    cold = run_both(chip64_fast_test.MULTIPLY, ["3", "5"], threshold=1000)
+    assert cold.compiled == []
+    assert cold.hits[0x08] == 64
+
+
+@pytest.mark.parametrize("cycles", [0, 1, 10, 57, 100, 391, 392])
+def test_tiered_cycle_limit(cycles):
+    """
+    Test that execute() stops after exactly num_of_cycles cycles.
+    """
+    run_both(chip64_fast_test.MULTIPLY, ["7", "65535"], cycles)
+
+
+def test_tiered_jump_table():
+    """
+    Test that computed jumps dispatch through jump tables in compiled code,
+    fall back to the interpreter outside them and that rewriting a table
+    discards the blocks that dispatch through it.
+    """
+    for cycles in (11, 12, 100):
+        run_both(chip64_test.DISPATCH, ["40"], cycles, threshold=1)
+    c64 = run_both(chip64_test.DISPATCH, ["40"], threshold=1)
+    assert 0x0E in c64.compiled
+    c64.load_table(0x1A, [0x1028], np.uint16)
+    assert 0x0E not in c64.compiled
+    code = [
+        0xF0, 0x01, 0xB0, 0x06, 0x00, 0x00, 0x10, 0x0A,
+        0x10, 0x0E, 0xD0, 0x01, 0x00, 0x00, 0x00, 0x00,
+    ]
+    for value in ("2", "4"):
+        c64 = run_both(code, [value], threshold=1)
+        assert 0x02 in c64.compiled
+
+
+def test_tiered_goto_into_goto():
+    """
+    Test that a GOTO to another GOTO is not taken for a jump table, so that
+    rewriting the second discards only the blocks holding it.
+    """
+    code = [
+        0x60, 0x00, 0x10, 0x06, 0x00, 0x00, 0x70, 0x01,
+        0x30, 0x0A, 0x10, 0x02, 0xD0, 0x01, 0x00, 0x00,
+    ]
+    c64 = run_both(code, threshold=1)
+    assert c64.compiled == [0x00, 0x02, 0x06, 0x0A, 0x0C]
+    c64.load_table(0x02, [0x1006], np.uint16)
+    assert c64.compiled == [0x06, 0x0A, 0x0C]
+
+
+def test_tiered_deoptimisation():
+    """
+    Test that blocks overwritten by SPILL are discarded, and given up on
+    once they have been overwritten too often.
+    """
+    c64 = run_both(SELF_MODIFYING)
+    assert c64.registers[1] == 120
+    assert c64.deoptimisations[0x20] == chip64_tiered.MAX_DEOPTIMISATIONS
+    assert 0x20 not in c64.compiled
+    for cycles in range(0, 200, 9):
+        run_both(SELF_MODIFYING, num_of_cycles=cycles)
+
+
+def test_tiered_return_with_empty_stack():
+    """
+    Test that a compiled RET with an empty call stack faults like Chip64.
+    """
+    code = [0x60, 0x01, 0x01, 0xEE]
+    c64 = chip64_tiered.TieredChip64(code, threshold=1)
+    with pytest.raises(IndexError):
+        c64.execute()
+    assert c64.code_ptr == 2
+    assert c64.registers[0] == 1
+
+
+def test_tiered_reset():
+    """
+    Test that reset() discards compiled code.
+    """
+    c64 = run_both(chip64_fast_test.MULTIPLY, ["3", "5"])
+    assert c64.compiled
+    c64.reset(reload_program=True)
+    assert c64.compiled == []
+    assert not c64.hits
+
+
+def test_tiered_multi_precision():
+    """
+    Test that a loop around ADDM gives the same state and output as Chip64.
+    """
+    c64 = run_both(chip64_fast_test.MULTI_PRECISION, [str(2**64 - 1)])
+    assert 0x12 in c64.compiled
+
+
+def test_tiered_detect_loops():
+    """
+    Test that loops that cannot halt are stopped in compiled code as well as
+    in the interpreter.
+    """
+    c64 = chip64_tiered.TieredChip64([0x60, 0x01, 0x10, 0x02], threshold=1)
+    c64.execute()
+    assert c64.halt_reason == chip64.NON_TERMINATING
+    assert c64.loop_address == 0x002
+    for threshold in (1, 1000):
+        c64 = chip64_tiered.TieredChip64(
+            chip64_test.REPEATING, threshold, detect_loops=True
+        )
+        c64.execute()
+        assert c64.halt_reason == chip64.NON_TERMINATING
+        assert c64.loop_address == 0x002
+        assert c64.registers[1] == 7
+    c64 = chip64_tiered.TieredChip64(chip64_test.COUNTING, 1, detect_loops=True)
+    c64.execute(500)
+    assert c64.halt_reason == chip64.CYCLE_LIMIT
+
+
+def test_tiered_load_table():
+    """
+    Test that loading a table over compiled code discards the code.
+    """
+    c64 = chip64_tiered.TieredChip64([0x71, 0x01, 0x00, 0x00], threshold=1)
+    c64.execute()
+    assert c64.compiled == [0x000]
+    c64.load_table(0x000, [0x7102], np.uint16)
+    c64.code_ptr = 0
+    c64.execute()
+    assert c64.registers[1] == 3
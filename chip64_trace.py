@@ -0,0 +1,151 @@
+"""
+A ring buffer trace of the last instructions a machine ran.
+Each entry holds the address and opcode of an instruction and the register it
+wrote along with the value it left there. Entries are stored in preallocated
+arrays, nothing is decoded until the trace is read, and a run that raises
+inside a Tracer context has the trace added to the exception as a note.
+"""
+
+import array
+import collections
+import functools
+import chip64_cfg
+import chip64_decode as c64d
+
+DEFAULT_SIZE = 1024
+
+# register is -1 for instructions that write no register.
+TraceEntry = collections.namedtuple(
+    "TraceEntry", ["address", "opcode", "register", "value"]
+)
+
+
+@functools.lru_cache(maxsize=None)
+def destination(opcode: int) -> int:
+    """
+    Returns the register opcode writes, -1 if none. The flag register is
+    only given for instructions that write no other register, and LOAD gives
+    r0.
+    """
+    defs = chip64_cfg.uses_and_defs(c64d.decode(opcode))[1]
+    for register in range(15):
+        if defs >> register & 1:
+            return register
+    return 15 if defs >> 15 & 1 else -1
+
+
+class Tracer:
+    """
+    Records the last size instructions run by a machine.
+    The machine runs in the interpreter while a tracer is attached, see
+    Chip64.add_hook().
+    """
+
+    def __init__(self, c64=None, size: int = DEFAULT_SIZE):
+        """
+        Creates an empty trace of size entries. It is attached to c64, if
+        given, on entering a with block and detached on leaving it.
+        """
+        self.machine = c64
+        self.size = size
+        self.count = 0
+        self._addresses = array.array("H", bytes(2 * size))
+        self._opcodes = array.array("H", bytes(2 * size))
+        self._registers = array.array("b", bytes(size))
+        self._values = array.array("Q", bytes(8 * size))
+        self._attached = None
+
+    def attach(self, c64) -> None:
+        """
+        Starts tracing c64.
+        """
+        self.detach()
+        c64.add_hook("instruction", self._instruction)
+        c64.add_hook("halt", self._halt)
+        self._attached = c64
+
+    def detach(self) -> None:
+        """
+        Stops tracing, keeping the entries recorded so far.
+        """
+        c64, self._attached = self._attached, None
+        if c64 is not None:
+            self._finish(c64)
+            c64.remove_hook("instruction", self._instruction)
+            c64.remove_hook("halt", self._halt)
+
+    def clear(self) -> None:
+        """
+        Forgets every entry.
+        """
+        self.count = 0
+
+    def _instruction(self, c64, address: int, opcode: int) -> None:
+        self._finish(c64)
+        i = self.count % self.size
+        self._addresses[i] = address
+        self._opcodes[i] = opcode
+        self._registers[i] = destination(opcode)
+        self.count += 1
+
+    def _halt(self, c64, reason) -> None:
+        self._finish(c64)
+
+    def _finish(self, c64) -> None:
+        """
+        Records the value the last instruction left in its register.
+        """
+        if self.count:
+            i = (self.count - 1) % self.size
+            if self._registers[i] >= 0:
+                self._values[i] = int(c64.registers[self._registers[i]])
+
+    def entries(self) -> list:
+        """
+        Returns the recorded TraceEntries, oldest first.
+        """
+        if self._attached is not None:
+            self._finish(self._attached)
+        entries = []
+        for i in range(max(0, self.count - self.size), self.count):
+            i %= self.size
+            register = self._registers[i]
+            entries.append(
+                TraceEntry(
+                    self._addresses[i],
+                    self._opcodes[i],
+                    register,
+                    self._values[i] if register >= 0 else 0,
+                )
+            )
+        return entries
+
+    def dump(self) -> str:
+        """
+        Returns a disassembly of the recorded instructions, oldest first,
+        with the value each left in the register it wrote.
+        """
+        lines = []
+        for entry in self.entries():
+            line = "$%03X  %04X  %-16s" % (
+                entry.address,
+                entry.opcode,
+                c64d.disassemble(c64d.decode(entry.opcode, entry.address)),
+            )
+            if entry.register >= 0:
+                line += "r%X = 0x%X" % (entry.register, entry.value)
+            lines.append(line.rstrip())
+        return "\n".join(lines)
+
+    def __enter__(self):
+        if self.machine is not None:
+            self.attach(self.machine)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_value is not None and hasattr(exc_value, "add_note"):
+            exc_value.add_note(
+                "last %d instructions:\n%s" % (min(self.count, self.size), self.dump())
+            )
+        if self.machine is not None:
+            self.detach()
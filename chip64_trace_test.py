@@ -0,0 +1,68 @@
+import chip64
+import chip64_fast
+import chip64_fast_test
+import chip64_trace
+import chip64_util as c64u
+import pytest
+import unittest.mock
+
+
+def test_destination():
+    """
+    Test that the register an opcode writes is worked out from its decoding.
+    """
+    assert chip64_trace.destination(0x6A2A) == 0xA
+    assert chip64_trace.destination(0x8127) == 2
+    assert chip64_trace.destination(0xE3A4) == 15
+    assert chip64_trace.destination(0xD001) == -1
+    assert chip64_trace.destination(0xE265) == 0
+
+
+def test_tracer_ring_buffer():
+    """
+    Test that only the last size instructions are kept, with the values they
+    wrote, and that detaching returns the machine to compiled code.
+    """
+    c64u.console_input = unittest.mock.MagicMock(side_effect=["6", "7"])
+    c64u.console_output = unittest.mock.MagicMock()
+    c64 = chip64_fast.FastChip64(chip64_fast_test.MULTIPLY)
+    with chip64_trace.Tracer(c64, size=4) as tracer:
+        c64.execute(390)
+    assert tracer.entries()[-2] == chip64_trace.TraceEntry(0x14, 0x7301, 3, 64)
+    with tracer:
+        c64.execute()
+    assert tracer.count == 394
+    assert tracer.entries() == [
+        chip64_trace.TraceEntry(0x08, 0x4340, -1, 0),
+        chip64_trace.TraceEntry(0x0A, 0x1018, -1, 0),
+        chip64_trace.TraceEntry(0x18, 0xD201, -1, 0),
+        chip64_trace.TraceEntry(0x1A, 0x0000, -1, 0),
+    ]
+    assert not c64._observed
+
+
+def test_tracer_dump_on_exception():
+    """
+    Test that an exception raised in a traced run carries a disassembly of
+    the last instructions.
+    """
+    c64 = chip64.Chip64([0x60, 0x05, 0xAF, 0xF8, 0xE1, 0x65])
+    with pytest.raises(IndexError) as error:
+        with chip64_trace.Tracer(c64):
+            c64.execute()
+    note = error.value.__notes__[0]
+    assert note.splitlines() == [
+        "last 3 instructions:",
+        "$000  6005  ACR r0, 0x05    r0 = 0x5",
+        "$002  AFF8  SMP $FF8",
+        "$004  E165  LOAD r1         r0 = 0x0",
+    ]
+    c64 = chip64.Chip64([0x01, 0xEE])
+    tracer = chip64_trace.Tracer(size=2)
+    tracer.attach(c64)
+    with pytest.raises(IndexError):
+        c64.execute()
+    tracer.detach()
+    assert tracer.dump() == "$000  01EE  RET"
+    tracer.clear()
+    assert tracer.entries() == []
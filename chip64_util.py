@@ -69,6 +69,38 @@ def build_uint64(byte_list: list) -> np.uint64:
     return rv
 
 
+def _big_endian(dtype) -> np.dtype:
+    """
+    Returns the big endian form of an unsigned integer dtype.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind != "u":
+        raise ValueError("%s is not an unsigned integer type" % dtype)
+    return dtype.newbyteorder(">")
+
+
+def split_array(values, dtype=np.uint64) -> np.ndarray:
+    """
+    Splits an array of values of an unsigned integer dtype into their bytes,
+    each value big endian as split() does, and returns them as one uint8
+    array.
+    """
+    return np.ascontiguousarray(values, dtype=_big_endian(dtype)).view(np.uint8)
+
+
+def build_array(byte_array, dtype=np.uint64) -> np.ndarray:
+    """
+    Builds an array of values of an unsigned integer dtype from big endian
+    bytes, the inverse of split_array(). byte_array may be a bytes like
+    object or an array of bytes.
+    """
+    if isinstance(byte_array, (bytes, bytearray, memoryview)):
+        data = np.frombuffer(byte_array, np.uint8)
+    else:
+        data = np.ascontiguousarray(byte_array, dtype=np.uint8)
+    return data.view(_big_endian(dtype)).astype(dtype)
+
+
 # ANSI character escape sequence for making the terminal output emulator output
 # in green.
 GREEN = "\033[92m"
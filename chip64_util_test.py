@@ -1,5 +1,6 @@
 import chip64_util as c64u
 import numpy as np
+import pytest
 
 
 def test_high_byte():
@@ -59,4 +60,19 @@ def test_build_uint64():
     Test the build_uint64() util function.
     """
     assert c64u.build_uint64([0, 0, 0, 0, 0xAB, 0xCD, 0xEF, 0x12]) == 0xABCDEF12
-    assert c64u.build_uint64([0x0, 0x0, 0x0, 0x0, 0x0, 0x3d, 0x09, 0x0]) == 0x3D0900
\ No newline at end of file
+    assert c64u.build_uint64([0x0, 0x0, 0x0, 0x0, 0x0, 0x3d, 0x09, 0x0]) == 0x3D0900
+
+def test_split_and_build_array():
+    """
+    Test that the array codecs lay values out as split() does and read them
+    back as build_uint64() does.
+    """
+    values = np.array([0x0102030405060708, 2**64 - 1, 0], dtype=np.uint64)
+    data = c64u.split_array(values)
+    assert list(data) == [b for value in values for b in c64u.split(value)]
+    assert c64u.build_array(data)[0] == c64u.build_uint64(list(data[:8]))
+    assert list(c64u.build_array(data)) == list(values)
+    assert list(c64u.split_array([0xABCD, 1], np.uint32)) == [0, 0, 0xAB, 0xCD, 0, 0, 0, 1]
+    assert c64u.build_array(bytes([1, 2, 3, 4]), np.uint32).dtype == np.uint32
+    with pytest.raises(ValueError):
+        c64u.split_array([1], np.int64)
@@ -0,0 +1,93 @@
+"""
+A static verifier for Chip64 programs.
+A program that passes cannot execute an undefined opcode, jump to an odd or
+out of range address, return with an empty call stack, read or write memory
+out of bounds or overwrite its own code when run from a freshly constructed
+Chip64, so it can run on engines that leave those checks out. The one check
+left to run time is that of computed jumps into jump tables, see
+chip64_cfg.jump_table().
+"""
+
+import chip64_cfg
+
+
+class VerificationError(Exception):
+    """
+    Raised when a program fails verification, problems holds the
+    (address, message) pairs that were found.
+    """
+
+    def __init__(self, problems: list):
+        self.problems = problems
+        super().__init__(
+            "\n".join("$%03X: %s" % (address, message) for address, message in problems)
+        )
+
+
+def problems(analysis: chip64_cfg.Analysis, host_functions=None) -> list:
+    """
+    Returns the sorted (address, message) problems found in an analysis.
+    If host_functions is given, host calls to numbers not in it are problems.
+    """
+    found = list(analysis.faults)
+    for address, instruction in analysis.instructions.items():
+        if instruction.mnemonic is None:
+            found.append(
+                (address, "undefined opcode 0x%04X" % instruction.opcode)
+            )
+        elif (
+            instruction.mnemonic == "HOST"
+            and host_functions is not None
+            and instruction.nnn not in host_functions
+        ):
+            found.append(
+                (address, "host function 0x%03X is not registered" % instruction.nnn)
+            )
+    code = analysis.code_bytes()
+    for address, ranges in analysis.accesses.items():
+        instruction = analysis.instructions[address]
+        mnemonic = instruction.mnemonic
+        for span in ranges:
+            if span is None:
+                unknown = "memory pointer" if mnemonic in ("SPILL", "LOAD") else "memory range"
+                found.append(
+                    (address, "%s cannot be determined statically" % unknown)
+                )
+                continue
+            written = chip64_cfg.written_range(instruction, span)
+            if span[1] > chip64_cfg.MEMORY_SIZE:
+                found.append(
+                    (address, "%s of $%03X-$%03X runs past the end of memory"
+                     % (mnemonic, span[0], span[1] - 1))
+                )
+            elif written and not code.isdisjoint(range(*written)):
+                found.append(
+                    (address, "%s of $%03X-$%03X overwrites code"
+                     % (mnemonic, written[0], written[1] - 1))
+                )
+    return sorted(set(found))
+
+
+def verify(memory, entry: int = 0, state: tuple = None, host_functions=None) -> list:
+    """
+    Verifies the program in memory and returns the list of problems found,
+    the list is empty if the program passed.
+    state is the abstract state at entry, see chip64_cfg.analyse().
+    host_functions is the collection of registered host function numbers,
+    see problems().
+    """
+    return problems(chip64_cfg.analyse(memory, entry, state), host_functions)
+
+
+def check(
+    memory, entry: int = 0, state: tuple = None, host_functions=None
+) -> chip64_cfg.Analysis:
+    """
+    Verifies the program in memory and returns its analysis, raising
+    VerificationError if any problems were found.
+    """
+    analysis = chip64_cfg.analyse(memory, entry, state)
+    found = problems(analysis, host_functions)
+    if found:
+        raise VerificationError(found)
+    return analysis
@@ -0,0 +1,61 @@
+import chip64_verify
+import pytest
+
+
+def test_verify_passes():
+    """
+    Test that a well formed program verifies without problems.
+    """
+    code = [0xA0, 0x08, 0xE1, 0x65, 0xD0, 0x01, 0x00, 0x00] + [0] * 16
+    assert chip64_verify.verify(code) == []
+
+
+def test_verify_undefined_opcode():
+    """
+    Test that a reachable undefined opcode is reported.
+    """
+    assert chip64_verify.verify([0x81, 0x2A, 0x00, 0x00]) == [
+        (0, "undefined opcode 0x812A")
+    ]
+
+
+def test_verify_odd_jump_target():
+    """
+    Test that a jump to an odd address is reported.
+    """
+    assert chip64_verify.verify([0x10, 0x03, 0x00, 0x00]) == [
+        (0, "jump target $003 is odd")
+    ]
+
+
+def test_verify_memory_bounds():
+    """
+    Test that SPILL and LOAD ranges are checked where the memory pointer is
+    known and reported where it is not.
+    """
+    code = [0xAF, 0xF8, 0xE1, 0x55, 0x00, 0x00]
+    assert chip64_verify.verify(code) == [
+        (2, "SPILL of $FF8-$1007 runs past the end of memory")
+    ]
+    code = [0xF0, 0x01, 0xE0, 0x1E, 0xE0, 0x65, 0x00, 0x00]
+    assert chip64_verify.verify(code) == [
+        (4, "memory pointer cannot be determined statically")
+    ]
+
+
+def test_verify_self_modifying_code():
+    """
+    Test that a SPILL over reachable code is reported.
+    """
+    code = [0xA0, 0x00, 0xE0, 0x55, 0x00, 0x00]
+    assert chip64_verify.verify(code) == [(2, "SPILL of $000-$007 overwrites code")]
+
+
+def test_check():
+    """
+    Test that check() raises VerificationError listing the problems.
+    """
+    with pytest.raises(chip64_verify.VerificationError) as error:
+        chip64_verify.check([0x01, 0xEE])
+    assert error.value.problems == [(0, "RET with an empty call stack")]
+    assert str(error.value) == "$000: RET with an empty call stack"